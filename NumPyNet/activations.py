@@ -12,6 +12,9 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 class Activations (object):
 
+  inplace  = False # the activation provides the fused in-place functions (activate_inplace, gradient_inplace)
+  use_mask = False # the fused gradient needs the boolean mask stored by activate_inplace
+
   def __init__ (self, name):
     self._name = name
 
@@ -23,6 +26,22 @@ class Activations (object):
   def gradient (x, copy=False):
     raise NotImplementedError
 
+  @staticmethod
+  def activate_inplace (x, mask=None):
+    '''
+    Fused epilogue of the layers: activate x in place. If use_mask is True
+    and a boolean array is given as mask, it stores what the gradient needs.
+    '''
+    raise NotImplementedError
+
+  @staticmethod
+  def gradient_inplace (delta, y, mask=None, workspace=None):
+    '''
+    Multiply in place delta by the gradient, evaluated on the activated output y
+    or on the stored mask. The workspace (an array like y) holds the temporary values.
+    '''
+    raise NotImplementedError
+
   @property
   def name (self):
     return self._name
@@ -36,6 +55,8 @@ class Logistic (Activations):
   def __init__ (self):
     super(Logistic, self).__init__('Logistic')
 
+  inplace = True
+
   @staticmethod
   def activate (x, copy=False):
     return 1. / (1. + np.exp(-x))
@@ -44,6 +65,20 @@ class Logistic (Activations):
   def gradient (x, copy=False):
     return (1. - x) * x
 
+  @staticmethod
+  def activate_inplace (x, mask=None):
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1.
+    return np.reciprocal(x, out=x)
+
+  @staticmethod
+  def gradient_inplace (delta, y, mask=None, workspace=None):
+    workspace = np.subtract(1., y, out=workspace)
+    workspace *= y
+    delta *= workspace
+    return delta
+
 
 class Loggy (Activations):
 
@@ -64,6 +99,9 @@ class Relu (Activations):
   def __init__ (self):
     super(Relu, self).__init__('Relu')
 
+  inplace  = True
+  use_mask = True # mask of the positive inputs
+
   @staticmethod
   def activate (x, copy=False):
     if copy: y = x.copy()
@@ -81,6 +119,18 @@ class Relu (Activations):
     y[x <= 0.] = 0.
     return y
 
+  @staticmethod
+  def activate_inplace (x, mask=None):
+    if mask is not None:
+      np.greater(x, 0., out=mask)
+
+    return np.maximum(x, 0., out=x)
+
+  @staticmethod
+  def gradient_inplace (delta, y, mask=None, workspace=None):
+    delta *= mask if mask is not None else y > 0.
+    return delta
+
 
 class Elu (Activations):
 
@@ -152,13 +202,23 @@ class Linear (Activations):
   def __init__ (self):
     super(Linear, self).__init__('Linear')
 
+  inplace = True
+
   @staticmethod
   def activate(x, copy=False):
     return x
 
   @staticmethod
   def gradient(x, copy=False):
-    return np.ones_like(a=x, dtype=float)
+    return np.ones_like(a=x)
+
+  @staticmethod
+  def activate_inplace (x, mask=None):
+    return x
+
+  @staticmethod
+  def gradient_inplace (delta, y, mask=None, workspace=None):
+    return delta
 
 
 class Tanh (Activations):
@@ -166,6 +226,8 @@ class Tanh (Activations):
   def __init__ (self):
     super(Tanh, self).__init__('Tanh')
 
+  inplace = True
+
   @staticmethod
   def activate(x, copy=False):
     return np.tanh(x)
@@ -174,6 +236,17 @@ class Tanh (Activations):
   def gradient(x, copy=False):
     return 1. - x * x
 
+  @staticmethod
+  def activate_inplace (x, mask=None):
+    return np.tanh(x, out=x)
+
+  @staticmethod
+  def gradient_inplace (delta, y, mask=None, workspace=None):
+    workspace = np.multiply(y, y, out=workspace)
+    np.subtract(1., workspace, out=workspace)
+    delta *= workspace
+    return delta
+
 
 class Plse (Activations):
 
@@ -205,6 +278,9 @@ class Leaky (Activations):
 
   LEAKY_COEF  = 1e-1
 
+  inplace  = True
+  use_mask = True # mask of the non-positive inputs, scaled by LEAKY_COEF
+
   def __init__ (self):
     super(Leaky, self).__init__('Leaky')
 
@@ -225,6 +301,16 @@ class Leaky (Activations):
     y[x <= 0.] = Leaky.LEAKY_COEF
     return y
 
+  @staticmethod
+  def activate_inplace (x, mask=None):
+    mask = np.less_equal(x, 0., out=mask)
+    return np.multiply(x, Leaky.LEAKY_COEF, out=x, where=mask)
+
+  @staticmethod
+  def gradient_inplace (delta, y, mask=None, workspace=None):
+    mask = mask if mask is not None else y <= 0.
+    return np.multiply(delta, Leaky.LEAKY_COEF, out=delta, where=mask)
+
 
 class Stair (Activations):
 
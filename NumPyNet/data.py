@@ -5,38 +5,449 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import mmap
 import time
+import hashlib
 import numpy as np
+import multiprocessing as mp
 from glob import glob
+from threading import Lock
 from threading import Thread
 from functools import partial
+from collections import deque
+from collections import OrderedDict
 
 from NumPyNet.image import Image
+from NumPyNet.utils import BoundedQueue
+from NumPyNet.parallel import shared_memory
+from NumPyNet.shards import ShardReader
+from NumPyNet.profiler import span
 
 __author__ = ['Mattia Ceccarelli', 'Nico Curti']
 __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 
+# state of the loader processes (ref. _init_loader)
+_loader = {}
+
+
+def _init_loader (load_func, seed):
+  '''
+  Initialize a loader process, with a seed given by its index in the pool
+  '''
+  _loader['load_func'] = load_func
+
+  index = mp.current_process()._identity
+  np.random.seed((seed + (index[-1] if index else 0)) % 2**32)
+
+
+def _load_sample (args):
+  '''
+  Load a sample in the loader process. The random generator is seeded with
+  the seed of the sample, so the result does not depend on the process.
+  '''
+  seed, sample = (args[0], args[1:])
+  np.random.seed(seed)
+
+  return _loader['load_func'](*sample)
+
+
+def _fill_sample (args):
+  '''
+  Load a sample in the loader process and write it in place in its slot of the
+  shared ring (ref. BatchRing), seeded as in _load_sample
+  '''
+  seed, layout, slot, position, sample = (args[0], args[1], args[2], args[3], args[4:])
+  np.random.seed(seed)
+
+  rings = _loader.setdefault('rings', {})
+
+  if layout not in rings:
+    rings[layout] = BatchRing.attach(layout)
+
+  loaded = _loader['load_func'](*sample)
+  BatchRing.write(rings[layout][1], slot, position, loaded if len(sample) > 1 else (loaded, None))
+
+
+def _load_shard (reader, load_func, index, label=None):
+  '''
+  Load the sample of the given index of the sharded dataset, processed by the
+  load function (the label is read with the sample: its index is not used)
+  '''
+  sample = reader[int(index)]
+
+  if load_func is None:
+    return sample
+
+  return load_func(*sample) if reader.labeled else load_func(sample)
+
+
+def _as_array (sample):
+  '''
+  Numpy array of a loaded sample (array-like or Image object)
+  '''
+  return sample.get() if isinstance(sample, Image) else np.asarray(sample)
+
+
+class BatchRing (object):
+
+  def __init__ (self, slots, batch, data, label=None, shared=False):
+    '''
+    Ring of preallocated contiguous batches of data and labels, filled in place
+    by the loaders and used without copies. A slot is acquired by the loader,
+    it is filled and handed to the consumer, which releases it when the batch
+    is not used anymore.
+
+    Parameters
+    ----------
+      slots : int
+        Number of batches of the ring
+
+      batch : int
+        Number of samples of each batch
+
+      data : array
+        A data sample, which gives the shape and the type of the data
+
+      label : array (default = None)
+        A label sample, which gives the shape and the type of the labels
+
+      shared : bool (default = False)
+        Allocate the ring in shared memory, so the loader processes fill it in place
+    '''
+    if shared and shared_memory is None:
+      raise NotImplementedError('Shared memory requires python >= 3.8')
+
+    self.arrays = []
+    self._shms = []
+    layout = []
+
+    for sample in (data, label):
+
+      if sample is None:
+        self.arrays.append(None)
+        layout.append(None)
+        continue
+
+      shape = (slots, batch) + sample.shape
+      size = max(int(np.prod(shape)) * sample.dtype.itemsize, 1)
+
+      if shared:
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        self._shms.append(shm)
+        self.arrays.append(np.ndarray(shape=shape, dtype=sample.dtype, buffer=shm.buf))
+        layout.append((shm.name, shape, sample.dtype.str))
+
+      else:
+        self.arrays.append(np.empty(shape=shape, dtype=sample.dtype))
+        layout.append(None)
+
+    # names, shapes and types of the shared arrays
+    self.layout = tuple(layout) if shared else None
+
+    self._free = BoundedQueue(maxsize=slots)
+
+    for slot in range(slots):
+      self._free.put(slot)
+
+  @staticmethod
+  def attach (layout):
+    '''
+    Map the shared arrays of the given layout: return the (shared memory blocks, arrays)
+    '''
+    shms = [shared_memory.SharedMemory(name=entry[0]) if entry is not None else None for entry in layout]
+    arrays = [np.ndarray(shape=entry[1], dtype=entry[2], buffer=shm.buf) if entry is not None else None
+              for entry, shm in zip(layout, shms)]
+
+    return (shms, arrays)
+
+  @staticmethod
+  def write (arrays, slot, position, sample):
+    '''
+    Write the (data, label) sample in the position of the slot of the ring arrays
+    '''
+    for array, value in zip(arrays, sample):
+      if array is not None:
+        array[slot, position] = _as_array(value)
+
+  def acquire (self):
+    '''
+    Return a free slot, waiting until a slot is released (None if the ring is cancelled)
+    '''
+    slot, _ = self._free.get()
+    return slot
+
+  def release (self, slot):
+    '''
+    Give back a slot to the ring
+    '''
+    self._free.put(slot)
+
+  def cancel (self):
+    '''
+    Wake up the loaders waiting for a slot
+    '''
+    self._free.close()
+
+  def batch (self, slot):
+    '''
+    Return the (data, labels) arrays of the slot
+    '''
+    return tuple(array[slot] if array is not None else None for array in self.arrays)
+
+  def close (self):
+    '''
+    Release the shared memory: the arrays still used are mapped until they are deleted
+    '''
+    for shm in self._shms:
+      try:
+        shm.close()
+      except BufferError: # arrays still in use
+        pass
+
+      shm.unlink()
+
+    self._shms = []
+
+
+def _func_key (func):
+  '''
+  Description of the function and of its bound parameters, stable across the
+  runs (it keys the cached samples of the function, ref. SampleCache)
+  '''
+  if isinstance(func, partial):
+    args = [_func_key(arg) if callable(arg) else repr(arg) for arg in func.args]
+    args += ['{}={}'.format(key, _func_key(value) if callable(value) else repr(value))
+             for key, value in sorted(func.keywords.items())]
+    return '{}({})'.format(_func_key(func.func), ', '.join(args))
+
+  return '{}.{}'.format(getattr(func, '__module__', None), getattr(func, '__qualname__', repr(func)))
+
+
+class SampleCache (object):
+
+  def __init__ (self, max_bytes, path=None):
+    '''
+    Least recently used cache of the loaded samples (ref. DataGenerator), bounded
+    by a memory budget: when the budget is exceeded the least recently used
+    samples are evicted (and spilled to the disk cache, if given).
+    The samples are keyed by the source, the label and the load function with
+    its parameters, so the load function must be deterministic (the random
+    augmentations must be applied after the cache).
+
+    Parameters
+    ----------
+      max_bytes : int
+        Memory budget of the cached samples in bytes
+
+      path : str (default = None)
+        Directory of the disk cache of the evicted samples (not bounded).
+        The files are named by the hash of the keys, so the disk cache can be
+        reused by the next runs: it must be cleared if the load function changes
+    '''
+    if max_bytes < 0:
+      raise ValueError('SampleCache : max_bytes must be non-negative. Given {}'.format(max_bytes))
+
+    self.max_bytes = max_bytes
+    self.path = path
+
+    if path is not None and not os.path.exists(path):
+      os.makedirs(path)
+
+    self._samples = OrderedDict()
+    self._lock = Lock()
+    self.nbytes = 0
+
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__ (self):
+    return len(self._samples)
+
+  @staticmethod
+  def _arrays (sample):
+    return sample if isinstance(sample, tuple) else (sample, )
+
+  def _filename (self, key):
+    return os.path.join(self.path, hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+
+  def get (self, key):
+    '''
+    Return the cached sample of the key (None if it is not cached), looked up
+    in memory and then in the disk cache
+    '''
+    with self._lock:
+
+      sample = self._samples.get(key)
+
+      if sample is not None:
+        self._samples.move_to_end(key)
+        self.hits += 1
+        return sample
+
+      if self.path is not None and os.path.exists(self._filename(key)):
+
+        with np.load(self._filename(key)) as arrays:
+          sample = tuple(arrays['arr_{:d}'.format(i)] for i in range(len(arrays.files)))
+
+        sample = sample if len(sample) > 1 else sample[0]
+        self.disk_hits += 1
+        self._insert(key, sample)
+        return sample
+
+      self.misses += 1
+      return None
+
+  def put (self, key, sample):
+    '''
+    Store the sample (an array or a tuple of arrays), evicting the least recently used ones
+    '''
+    with self._lock:
+      if key not in self._samples:
+        self._insert(key, sample)
+
+  def _insert (self, key, sample):
+    '''
+    Insert the sample in memory and evict the samples over the budget
+    '''
+    nbytes = sum(array.nbytes for array in self._arrays(sample))
+
+    if nbytes > self.max_bytes:
+      self._spill(key, sample)
+      return
+
+    self._samples[key] = sample
+    self.nbytes += nbytes
+
+    while self.nbytes > self.max_bytes:
+      evicted_key, evicted = self._samples.popitem(last=False)
+      self.nbytes -= sum(array.nbytes for array in self._arrays(evicted))
+      self.evictions += 1
+      self._spill(evicted_key, evicted)
+
+  def _spill (self, key, sample):
+    '''
+    Write the evicted sample in the disk cache (if any)
+    '''
+    if self.path is None:
+      return
+
+    filename = self._filename(key)
+
+    if not os.path.exists(filename):
+      # the complete file is moved in place, so an interrupted write is not read
+      temporary = filename + '.{:d}.tmp'.format(os.getpid())
+
+      with open(temporary, 'wb') as fp:
+        np.savez(fp, *self._arrays(sample))
+
+      os.replace(temporary, filename)
+
+  def clear (self):
+    '''
+    Remove the samples in memory (the disk cache is kept)
+    '''
+    with self._lock:
+      self._samples.clear()
+      self.nbytes = 0
+
+  def stats (self):
+    '''
+    Return the dictionary of the hits (in memory and on disk), misses and evictions,
+    the hit rate and the number and bytes of the samples in memory
+    '''
+    lookups = self.hits + self.disk_hits + self.misses
+
+    return {'hits'      : self.hits,
+            'disk_hits' : self.disk_hits,
+            'misses'    : self.misses,
+            'evictions' : self.evictions,
+            'hit_rate'  : (self.hits + self.disk_hits) / lookups if lookups else 0.,
+            'samples'   : len(self._samples),
+            'nbytes'    : self.nbytes,
+            }
+
+
 class DataGenerator (object):
 
   def __init__ (self, load_func, batch_size, source_path=None, source_file=None, label_path=None, label_file=None,
-                      source_extension='', label_extension='', seed=123,
-                      **load_func_kwargs):
+                      source_extension='', label_extension='', seed=123, prefetch=2, num_workers=0, ring=False,
+                      source_shards=None, cache=None, **load_func_kwargs):
     '''
     Data generator in detached thread.
+    The thread loads the next batches while the previous ones are used: at most
+    prefetch batches ready to use are stored in a bounded queue, and the thread
+    waits as soon as the queue is full.
+
+    With num_workers processes the samples of the batches are loaded in parallel
+    (the load function must be picklable with the spawn start method), while the
+    next batch is already dispatched. The batches keep the order of the serial
+    loading and the random generator of each sample is seeded by the seed and the
+    position of the sample in the stream, so the preprocessing is reproducible
+    whatever the number of workers (the thread loading included).
+
+    With ring the batches are contiguous arrays (batch, w, h, c) of a ring of
+    preallocated buffers (ref. BatchRing), allocated from the shapes of the first
+    batch (in shared memory with the loader processes): the loaders write the
+    samples in place and load_data returns the arrays of a slot without copies.
+    The shared memory requires python >= 3.8: with older versions the batches
+    loaded by the processes are copied in the ring.
+    The slot is reused after the next call of load_data.
 
     Parameters
     ----------
       load_func : function or lambda of preprocessing on a single data/label pair
 
       source_path :
+
+      source_shards : str or ShardReader (default = None)
+        Sharded dataset (ref. NumPyNet.shards) used in place of the source and
+        label files: the load function receives the decoded sample and label,
+        if it is None the samples are used as they are stored
+
+      cache : SampleCache or int (default = None)
+        Cache of the loaded samples (or its memory budget in bytes), so the
+        samples already loaded are not loaded again (ref. SampleCache):
+        the load function must be deterministic
+
+      prefetch : int (default = 2)
+        Maximum number of loaded batches waiting to be used
+
+      num_workers : int (default = 0)
+        Number of loader processes. If 0 the samples are loaded by the thread,
+        if -1 all the cpus are used
+
+      ring : bool (default = False)
+        Load the batches in place in a ring of contiguous arrays. The samples
+        must have the same shape
     '''
+    if prefetch < 1:
+      raise ValueError('Prefetch must be a positive integer. Given {}'.format(prefetch))
+
+    if cache is not None and not isinstance(cache, SampleCache):
+      cache = SampleCache(max_bytes=cache)
+
+    if num_workers < 0:
+      num_workers = os.cpu_count() or 1
+
     np.random.seed(seed)
 
-    if source_path is None and source_file is None:
-      raise ValueError('Source path and Source file can not be both null. Please give one of them')
+    if source_path is None and source_file is None and source_shards is None:
+      raise ValueError('Source path, Source file and Source shards can not be all null. Please give one of them')
+
+    if load_func is None and source_shards is None:
+      raise ValueError('The load function can be null only with Source shards')
 
-    if source_path is not None:
+    reader = None
+
+    if source_shards is not None:
+
+      reader = source_shards if isinstance(source_shards, ShardReader) else ShardReader(source_shards)
+      source_files = np.arange(len(reader))
+
+    elif source_path is not None:
 
       if not os.path.exists(source_path):
         raise ValueError('Source path does not exist')
@@ -50,7 +461,11 @@ class DataGenerator (object):
 
     source_files = np.asarray(source_files)
 
-    if label_path is not None:
+    if reader is not None:
+      # the labels are stored with the samples: they are read by the same indexes
+      label_files = source_files.copy() if reader.labeled else None
+
+    elif label_path is not None:
 
       if not os.path.exists(label_path):
         raise ValueError('Labels path does not exist')
@@ -71,25 +486,48 @@ class DataGenerator (object):
       label_files = None
 
     self._num_data = source_files.size
+    self._labeled = label_files is not None
 
     source_files, label_files = self._randomize(source_files, label_files)
 
-    load_func = partial(load_func, **load_func_kwargs)
+    load_func = partial(load_func, **load_func_kwargs) if load_func is not None else None
+
+    if reader is not None:
+      load_func = partial(_load_shard, reader, load_func)
+
     self.load_func = load_func
     self._batch = batch_size
 
-    self._thread = Thread(target=self._update, args=(source_files, label_files))
+    self.cache = cache
+    self._cache_key = _func_key(load_func) if cache is not None else None
+
+    self._seed = seed
+    self._num_workers = num_workers
+    self._pool = None
+    self._num_samples = 0 # samples dispatched to the loaders
+
+    self._use_ring = ring
+    self._ring = None
+    self._slot = None # slot used by the consumer
+    self._prefetch = prefetch
+
+    self._thread = Thread(target=self._update, args=(source_files, label_files), name='DataGenerator')
     self._thread.daemon = True
 
     self._current_batch = 0
 
     self._stopped = False
-    self._data, self._label = (None, None)
+    self._queue = BoundedQueue(maxsize=prefetch)
+    self.load_time = 0.
 
   @property
   def num_data (self):
     return self._num_data
 
+  @property
+  def labeled (self):
+    return self._labeled
+
   def _randomize (self, source, label=None):
     '''
     Randomize the source and labels arrays
@@ -120,48 +558,239 @@ class DataGenerator (object):
 
     return (source, label)
 
-  def _load (self, sources, labels=None):
+  def _keys (self, sources, labels=None):
+    '''
+    Cache keys of the samples: the source, the label and the load function
+    with its parameters (None without the cache)
+    '''
+    if self.cache is None:
+      return [None] * len(sources)
+
+    labels = labels if labels is not None else [None] * len(sources)
+
+    return [(str(source), str(label), self._cache_key) for source, label in zip(sources, labels)]
+
+  def _store (self, key, loaded):
+    '''
+    Store the loaded sample in the cache (as arrays) and return it
+    '''
+    if self.cache is None:
+      return loaded
+
+    loaded = tuple(map(_as_array, loaded)) if self._labeled else _as_array(loaded)
+    self.cache.put(key, loaded)
+
+    return loaded
+
+  def _cached_load (self, key, seed, *sample):
+    '''
+    Load the sample (source and label), or get it from the cache.
+    The random generator is seeded with the seed of the sample, as in the
+    loader processes (ref. _load_sample), and its state is restored after the load
+    '''
+    loaded = self.cache.get(key) if self.cache is not None else None
+
+    if loaded is None:
+      state = np.random.get_state()
+      np.random.seed(seed)
+
+      try:
+        loaded = self._store(key, self.load_func(*sample))
+
+      finally:
+        np.random.set_state(state)
+
+    return loaded
+
+  def _load (self, sources, labels=None, seeds=None):
     '''
     Map the loading function over the sources and labels
     '''
+    keys = self._keys(sources, labels)
+    seeds = seeds if seeds is not None else self._seeds(len(sources))
 
     if labels is not None:
       try:
-        self._data, self._label = zip(*map(self.load_func, sources, labels))
+        data, label = zip(*map(self._cached_load, keys, seeds, sources, labels))
+
+      except Exception as e:
+
+        self._stopped = True
+        raise e
+
+      return (data, label)
+
+    else:
+
+      try:
+        data = tuple(map(self._cached_load, keys, seeds, sources))
 
       except Exception as e:
 
         self._stopped = True
         raise e
 
-      return (self._data, self._label)
+      return (data, None)
+
+
+  def _seeds (self, size):
+    '''
+    Seeds of the next samples, given by the seed of the generator and by the
+    position of the samples in the stream
+    '''
+    seeds = [np.random.RandomState((self._seed, self._num_samples + i)).randint(2**31 - 1)
+             for i in range(size)]
+    self._num_samples += size
+
+    return seeds
+
+  def _submit (self, sources, labels=None):
+    '''
+    Dispatch the loading of a batch to the loader processes (or defer it to the
+    thread) and return the function which waits and returns the loaded batch
+    (the slot of the ring with ring). Return None if the generator is stopped.
+    '''
+    # without shared memory the loader processes can not fill the ring in place
+    if self._ring is not None and (self._pool is None or self._ring.layout is not None):
+      return self._submit_slot(sources, labels)
+
+    if self._pool is None:
+      load = partial(self._load, sources, labels, self._seeds(len(sources)))
 
     else:
+      seeds = self._seeds(len(sources))
+      samples = list(zip(seeds, sources, labels) if labels is not None else zip(seeds, sources))
+
+      # only the samples not cached are dispatched
+      keys = self._keys(sources, labels)
+      loaded = [self.cache.get(key) if key is not None else None for key in keys]
+      missing = [i for i, sample in enumerate(loaded) if sample is None]
+      result = self._pool.map_async(_load_sample, [samples[i] for i in missing])
+
+      def load ():
+        try:
+          for i, sample in zip(missing, result.get()):
+            loaded[i] = self._store(keys[i], sample)
+
+        except Exception as e:
+
+          self._stopped = True
+          raise e
 
+        if labels is not None:
+          data, label = zip(*loaded)
+          return (data, label)
+
+        return (tuple(loaded), None)
+
+    if not self._use_ring:
+      return load
+
+    # the first batches size the ring and they are copied in it
+    return lambda : self._to_ring(load())
+
+  def _submit_slot (self, sources, labels=None):
+    '''
+    Dispatch the loading of a batch in place in a free slot of the ring
+    '''
+    slot = self._acquire()
+
+    if slot is None:
+      return None
+
+    keys = self._keys(sources, labels)
+    seeds = self._seeds(len(sources))
+    samples = list(zip(sources, labels) if labels is not None else zip(sources))
+
+    if self._pool is None:
+
+      def fill ():
+        try:
+          for position, (key, seed, sample) in enumerate(zip(keys, seeds, samples)):
+            loaded = self._cached_load(key, seed, *sample)
+            BatchRing.write(self._ring.arrays, slot, position, loaded if labels is not None else (loaded, None))
+
+        except Exception as e:
+
+          self._stopped = True
+          raise e
+
+        return slot
+
+      return fill
+
+    layout = self._ring.layout
+    missing = []
+
+    # the cached samples are written by the thread, the other ones by the loaders
+    for position, key in enumerate(keys):
+      loaded = self.cache.get(key) if key is not None else None
+
+      if loaded is None:
+        missing.append(position)
+      else:
+        BatchRing.write(self._ring.arrays, slot, position, loaded if labels is not None else (loaded, None))
+
+    result = self._pool.map_async(_fill_sample, [(seeds[position], layout, slot, position) + samples[position]
+                                                 for position in missing])
+
+    def wait ():
       try:
-        self._data = zip(*map(self.load_func, sources))
+        result.get()
 
       except Exception as e:
 
         self._stopped = True
         raise e
 
-      return (self._data, None)
+      # the loaded samples are copied from the ring in the cache
+      for position in missing if self.cache is not None else ():
+        data, label = (array[slot, position].copy() if array is not None else None for array in self._ring.arrays)
+        self.cache.put(keys[position], (data, label) if labels is not None else data)
+
+      return slot
+
+    return wait
+
+  def _to_ring (self, batch):
+    '''
+    Copy a loaded batch in a free slot of the ring, allocated by the first batch
+    '''
+    data, label = batch
+
+    if self._ring is None:
+      # a slot for each ready batch, for the consumer and for the batches in loading
+      slots = self._prefetch + 3
+      self._ring = BatchRing(slots, self._batch, _as_array(data[0]), _as_array(label[0]) if label is not None else None,
+                             shared=self._pool is not None and shared_memory is not None)
+
+    slot = self._acquire()
 
+    if slot is not None:
+      for position, sample in enumerate(zip(data, label) if label is not None else zip(data)):
+        BatchRing.write(self._ring.arrays, slot, position, sample if label is not None else (sample[0], None))
 
+    return slot
+
+  def _acquire (self):
+    '''
+    Wait a free slot of the ring (return None if the generator is stopped)
+    '''
+    return self._ring.acquire() if not self._stopped else None
 
   def _update (self, source_files, label_files):
     '''
     Infinite loop of batch reading.
-    Each batch is read only if necessary (the previous is already used).
+    Each batch is read as soon as there is a free slot in the queue.
+    With the loader processes the next batch is dispatched before
+    waiting for the current one.
     '''
+    pending = deque()
+    ahead = 2 if self._pool is not None else 1
 
-    start_time = time.time()
-    elapsed = 1.
-
-    while not self._stopped:
+    try:
 
-      if self._data is None:
+      while not self._stopped:
 
         # we reach the end of batch
         if self._current_batch + self._batch >= self._num_data:
@@ -171,29 +800,61 @@ class DataGenerator (object):
           self._current_batch = 0
 
         if label_files is not None:
-          self._data, self._label = self._load(source_files[self._current_batch : self._current_batch + self._batch],
-                                               label_files[self._current_batch : self._current_batch + self._batch])
+          load = self._submit(source_files[self._current_batch : self._current_batch + self._batch],
+                              label_files[self._current_batch : self._current_batch + self._batch])
 
         else:
-          self._data, self._label = self._load(source_files[self._current_batch : self._current_batch + self._batch])
+          load = self._submit(source_files[self._current_batch : self._current_batch + self._batch])
 
-        self._current_batch += self._batch
+        if load is None: # stopped
+          break
 
-        elapsed = time.time() - start_time
-        print('Elapsed {:.3f} sec.'.format(elapsed))
+        pending.append(load)
+        self._current_batch += self._batch
 
-      else:
+        if len(pending) < ahead:
+          continue
 
-        time.sleep(elapsed + .05)
         start_time = time.time()
 
+        with span('load_batch', 'data'):
+          batch = pending.popleft()()
+
+        self.load_time = time.time() - start_time
+
+        # wait for a free place (False if stopped)
+        if batch is None or not self._queue.put(batch):
+          break
+
+    finally:
+
+      # wake up the consumer: the loaded batches can still be used
+      self._queue.close()
+
+      if self._pool is not None:
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+
+      if self._ring is not None:
+        self._ring.close()
+
 
   def start (self):
     '''
-    Start the thread
+    Start the thread (and the loader processes)
     '''
+    if self._num_workers:
+
+      if self._use_ring and shared_memory is not None:
+        # the ring is allocated after the fork: the loaders must share the tracker of the shared memory
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+
+      self._pool = mp.Pool(processes=self._num_workers, initializer=_init_loader,
+                           initargs=(self.load_func, self._seed))
+
     self._thread.start()
-    time.sleep(1.)
     return self
 
   def stop (self):
@@ -201,21 +862,223 @@ class DataGenerator (object):
     Stop the thread
     '''
     self._stopped = True
+    self._queue.close()
+
+    if self._ring is not None:
+      self._ring.cancel()
+
     self._thread.join()
 
   def load_data (self):
     '''
-    Get a batch of images and labels
+    Get a batch of images and labels, waiting until it is loaded.
+    The last flag is False (and the batch is None) if the generator is stopped
+    and there are not loaded batches. With ring the arrays are overwritten
+    after the next call.
     '''
-    data, label = (self._data, self._label)
-    self._data = None
+    data, label = (None, None)
+    grabbed = False
 
-    if label is not None:
-      return (data, label, not self._stopped)
+    # the previous batch is not used anymore
+    if self._slot is not None:
+      self._ring.release(self._slot)
+      self._slot = None
+
+    batch, grabbed = self._queue.get()
+
+    if grabbed and self._ring is not None:
+      self._slot = batch
+      data, label = self._ring.batch(batch)
+
+    elif grabbed:
+      data, label = batch
+
+    if self._labeled:
+      return (data, label, grabbed)
     else:
-      return (data, not self._stopped)
+      return (data, grabbed)
+
+
+class MemmapDataset (object):
+
+  def __init__ (self, data, labels=None, shuffle=False, block_size=4096, readahead=True):
+    '''
+    Dataset of samples (and labels) stored in .npy files, memory-mapped so
+    datasets larger than the memory are read from disk one batch at a time
+    (ref. Network.fit, Network.predict). The batches are contiguous reads of
+    the files: without shuffle they are views of the memmaps, with shuffle the
+    dataset is read in contiguous blocks of samples, visited in random order,
+    and the samples of each block are permuted in memory (block shuffling).
+
+    Parameters
+    ----------
+      data : str or array
+        Filename of the .npy file of the samples (opened as read-only memmap),
+        or an array (e.g. np.memmap of a raw binary file)
+
+      labels : str or array (default = None)
+        Filename of the .npy file of the labels, or an array
+
+      shuffle : bool (default = False)
+        Default block shuffling of the batches
+
+      block_size : int (default = 4096)
+        Number of samples of a shuffled block (rounded to a multiple of the batch):
+        larger blocks give a better shuffling and longer contiguous reads, with the
+        memory of a block
+
+      readahead : bool (default = True)
+        Advise the OS (if it supports madvise) of the sequential access and
+        read ahead the next block (or batch), while the current one is processed
+
+    Examples
+    --------
+
+    >>> X = np.lib.format.open_memmap('data.npy', mode='w+', dtype=np.float32, shape=(num_data, 28, 28, 1))
+    >>> y = np.lib.format.open_memmap('labels.npy', mode='w+', dtype=np.float32, shape=(num_data, 1, 1, 10))
+    >>> # fill and flush X, y
+    >>> dataset = MemmapDataset('data.npy', 'labels.npy', shuffle=True)
+    >>> model.fit(dataset, max_iter=10)
+    '''
+    if block_size <= 0:
+      raise ValueError('MemmapDataset : block_size must be positive. Given {}'.format(block_size))
+
+    self.data = self._open(data)
+    self.labels = self._open(labels) if labels is not None else None
+
+    if self.labels is not None and len(self.labels) != len(self.data):
+      raise ValueError('MemmapDataset : data and labels have different number of samples. Given {:d} and {:d}'.format(len(self.data), len(self.labels)))
+
+    self.shuffle = shuffle
+    self.block_size = block_size
+    self.readahead = readahead
+
+    # buffers of the shuffled blocks and batches, allocated once (ref. batches)
+    self._buffers = {}
+
+    if readahead:
+      for array in self._arrays:
+        self._advise(array, 'MADV_SEQUENTIAL', 0, len(array))
+
+  @staticmethod
+  def _open (source):
+    '''
+    Memory-map the .npy file (or return the given array)
+    '''
+    if isinstance(source, str):
+      return np.load(source, mmap_mode='r')
+
+    return source
+
+  @property
+  def _arrays (self):
+    return [array for array in (self.data, self.labels) if array is not None]
+
+  def __len__ (self):
+    return len(self.data)
+
+  @staticmethod
+  def _advise (array, advice, start, stop):
+    '''
+    Give the advice on the access of the samples [start, stop) of the memmap
+    to the OS (nothing if the array is not a memmap or madvise is not available)
+    '''
+    advice = getattr(mmap, advice, None)
+    buffer = getattr(array, '_mmap', None)
+
+    if advice is None or buffer is None or not hasattr(buffer, 'madvise') or not array.flags.c_contiguous:
+      return
+
+    # the data of the memmap start at the offset in the mapped buffer (ref. np.memmap)
+    head = array.offset % mmap.ALLOCATIONGRANULARITY
+    sample = array.itemsize * int(np.prod(array.shape[1:]))
+
+    begin = head + min(start, len(array)) * sample
+    begin -= begin % mmap.PAGESIZE
+    end = min(head + min(stop, len(array)) * sample, len(buffer))
+
+    if end > begin:
+      try:
+        buffer.madvise(advice, begin, end - begin)
+      except (OSError, ValueError):
+        pass
+
+  def _buffer (self, name, array, size, copy=False):
+    '''
+    Buffer of size samples of the array, allocated once (a new array if copy)
+    '''
+    shape = (size, ) + array.shape[1:]
+
+    if copy:
+      return np.empty(shape=shape, dtype=array.dtype)
+
+    buffer = self._buffers.get(name)
+
+    if buffer is None or buffer.shape != shape:
+      buffer = self._buffers[name] = np.empty(shape=shape, dtype=array.dtype)
+
+    return buffer
+
+  def batches (self, size, shuffle=None, copy=False):
+    '''
+    Generator of the batches (data, labels) of size samples (the last one can
+    be smaller), with labels None if the dataset has no labels.
+
+    Parameters
+    ----------
+      size : int
+        Number of samples of the batches
+
+      shuffle : bool (default = None)
+        Block shuffling of the batches, by default the one of the dataset
+
+      copy : bool (default = False)
+        If False the shuffled batches are written in buffers reused by the next
+        batch, if True each batch is a new array (so the batches can be kept)
+    '''
+    shuffle = self.shuffle if shuffle is None else shuffle
+    num_data = len(self)
+
+    if not shuffle:
+
+      for start in range(0, num_data, size):
+        stop = min(start + size, num_data)
+
+        if self.readahead:
+          for array in self._arrays:
+            self._advise(array, 'MADV_WILLNEED', stop, stop + size)
+
+        yield (self.data[start : stop],
+               self.labels[start : stop] if self.labels is not None else None)
+
+      return
+
+    block = max(self.block_size // size, 1) * size
+    starts = np.random.permutation(np.arange(0, num_data, block))
+
+    blocks = [self._buffer(('block', i), array, min(block, num_data)) for i, array in enumerate(self._arrays)]
+
+    for k, start in enumerate(starts):
+
+      stop = min(start + block, num_data)
+
+      if self.readahead and k + 1 < len(starts):
+        for array in self._arrays:
+          self._advise(array, 'MADV_WILLNEED', starts[k + 1], starts[k + 1] + block)
+
+      # contiguous read of the block, then the samples are permuted in memory
+      with span('read_block', 'data'):
+        for buffer, array in zip(blocks, self._arrays):
+          buffer[:stop - start] = array[start : stop]
+
+      order = np.random.permutation(stop - start)
 
+      for i in range(0, len(order), size):
+        idx = order[i : i + size]
+        batch = [np.take(buffer, idx, axis=0, out=self._buffer(('batch', j), buffer, len(idx), copy=copy))
+                 for j, buffer in enumerate(blocks)]
 
+        yield (batch[0], batch[1] if self.labels is not None else None)
 
 
 def load_super_resolution (hr_image_filename, patch_size=(48, 48), scale=4):
@@ -39,7 +39,18 @@ class Activation_layer(BaseLayer):
     return 'activ                  {0:>4d} x{1:>4d} x{2:>4d} x{3:>4d}   ->  {0:>4d} x{1:>4d} x{2:>4d} x{3:>4d}'.format(
            batch, out_width, out_height, out_channels)
 
-  def forward(self, inpt, copy=True):
+  def _activate (self, inpt, output):
+    '''
+    Activate the input in the output array (the activations which do not
+    work in place return a new array, which is copied)
+    '''
+    output[:] = inpt
+    result = self.activation(output, copy=False)
+
+    if result is not output:
+      output[:] = result
+
+  def forward(self, inpt, copy=True, trainable=True):
     '''
     Forward of the activation layer, apply the selected activation function to
     the input.
@@ -49,6 +60,7 @@ class Activation_layer(BaseLayer):
       inpt: numpy array. Input images to be activated.
       copy: bolean, default True. If True make a copy of the input before
             applying the activation.
+      trainable: bolean, default True. If False (inference) the delta is not allocated.
 
     Returns
     ----------
@@ -57,8 +69,18 @@ class Activation_layer(BaseLayer):
 
     self._check_dims(shape=self.out_shape, arr=inpt, func='Forward')
 
-    self.output = self.activation(inpt, copy=copy)
-    self.delta = np.zeros(shape=self.out_shape, dtype=float)
+    if copy:
+      # the copy of the input is written in the output buffer and activated
+      self.output = self._buffer('output', inpt.shape)
+      self._map_batch(lambda s : self._activate(inpt[s], self.output[s]), len(inpt))
+
+    else:
+      self.output = self.activation(inpt, copy=False)
+
+    if trainable:
+      self.delta = self._buffer('delta', self.out_shape, fill=0.)
+    else:
+      self._release_cache()
 
     return self
 
@@ -78,8 +100,11 @@ class Activation_layer(BaseLayer):
     check_is_fitted(self, 'delta')
     self._check_dims(shape=self.out_shape, arr=delta, func='Backward')
 
-    self.delta *= self.gradient(self.output, copy=copy)
-    delta[:] = self.delta
+    def kernel (s):
+      self.delta[s] *= self.gradient(self.output[s], copy=copy)
+      delta[s] = self.delta[s]
+
+    self._map_batch(kernel, len(delta))
 
     return self
 
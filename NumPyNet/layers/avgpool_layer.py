@@ -134,7 +134,7 @@ class Avgpool_layer(BaseLayer):
     self.pad_left   = pad_h >> 1
     self.pad_right  = pad_h - self.pad_left
 
-  def _pad(self, inpt):
+  def _pad(self, inpt, name='pad'):
     '''
     Padd every image in a batch with np.nan following keras SAME padding
     See also:
@@ -143,17 +143,24 @@ class Avgpool_layer(BaseLayer):
     Parameters
     ----------
       inpt : input images in the format (batch, width, height, channels).
+      name : name of the persistent buffer which stores the padded array.
 
     Returns
     ----------
     A padded batch of images, following keras SAME padding.
     '''
 
-    # return the nan-padded image, in the same format as inpt (batch, width + pad_w, height + pad_h, channels)
-    return np.pad(inpt, pad_width=((0, 0), (self.pad_top, self.pad_bottom), (self.pad_left, self.pad_right), (0, 0)),
-                  mode='constant', constant_values=(np.nan, np.nan))
+    # the padded image, in the same format as inpt (batch, width + pad_w, height + pad_h, channels), is a
+    # persistent buffer of the layer: the nan border is set only when it is allocated
+    b, w, h, c = inpt.shape
+    shape = (b, w + self.pad_top + self.pad_bottom, h + self.pad_left + self.pad_right, c)
 
-  def forward(self, inpt):
+    mat_pad = self._buffer(name, shape, init=np.nan)
+    mat_pad[:, self.pad_top : self.pad_top + w, self.pad_left : self.pad_left + h, :] = inpt
+
+    return mat_pad
+
+  def forward(self, inpt, trainable=True):
     '''
     Forward function of the average pool layer: it slide a kernel of size (kx,ky) = size
     and with step (st1, st2) = strides over every image in the batch. For every sub-matrix
@@ -163,6 +170,7 @@ class Avgpool_layer(BaseLayer):
     Parameters.
     ----------
       inpt : input batch of image, with the shape (batch, input_w, input_h, input_c).
+      trainable : boolean, default True. If False (inference) the delta is not allocated.
 
     Returns.
     ----------
@@ -173,7 +181,7 @@ class Avgpool_layer(BaseLayer):
     kx, ky = self.size
     sx, sy = self.stride
     _, w, h, _ = self.input_shape
-    inpt = inpt.astype('float64')
+    inpt = inpt.astype(self.dtype, copy=False)
 
     # Padding
     if self.pad:
@@ -186,8 +194,13 @@ class Avgpool_layer(BaseLayer):
     view = self._asStride(mat_pad)
 
     # Mean of every sub matrix, computed without considering the padd(np.nan)
-    self.output = np.nanmean(view, axis=(4, 5))
-    self.delta  = np.zeros(shape=self.out_shape, dtype=float)
+    self.output = self._buffer('output', view.shape[:4])
+    self._map_batch(lambda s : np.nanmean(view[s], axis=(4, 5), out=self.output[s]), len(view))
+
+    if trainable:
+      self.delta = self._buffer('delta', self.out_shape, fill=0.)
+    else:
+      self._release_cache()
 
     return self
 
@@ -207,13 +220,12 @@ class Avgpool_layer(BaseLayer):
 
     check_is_fitted(self, 'delta')
     self._check_dims(shape=self.input_shape, arr=delta, func='Backward')
-    delta[:] = delta.astype('float64')
 
     # kx, ky = self.size
 
     # Padding delta for a coherent _asStrided dimension
     if self.pad:
-      mat_pad = self._pad(delta)
+      mat_pad = self._pad(delta, name='delta_pad')
     else :
       mat_pad = delta
 
@@ -228,20 +240,22 @@ class Avgpool_layer(BaseLayer):
     # modifing the same memory address more times at once doesn't produce the correct result
 
     # norm = 1. / (kx*ky)
-    norm = self.delta * (1. / np.count_nonzero(~np.isnan(net_delta_view), axis=(4, 5)))
     net_delta_review = np.moveaxis(net_delta_view, source=[1, 2, 3], destination=[0, 1, 2])
+    _, w_pad, h_pad, _ = mat_pad.shape
 
-    for (i, j, k), n in zip(np.ndindex(w, h, c), np.nditer(norm)):
-      net_delta_review[i, j, k, ...] += n
-    # net_delta_view *= norm
+    def kernel (s):
+      norm = self.delta[s] * (1. / np.count_nonzero(~np.isnan(net_delta_view[s]), axis=(4, 5)))
 
-    # Here delta is updated correctly
-    if self.pad:
-      _, w_pad, h_pad, _ = mat_pad.shape
-      # Excluding the padded part of the image
-      delta[:] = mat_pad[:, self.pad_top : w_pad - self.pad_bottom, self.pad_left : h_pad - self.pad_right, :]
-    else:
-      delta[:] = mat_pad
+      for i, j, k in np.ndindex(w, h, c):
+        net_delta_review[i, j, k, s] += norm[:, i, j, k, np.newaxis, np.newaxis]
+      # net_delta_view *= norm
+
+      # Here delta is updated correctly
+      if self.pad:
+        # Excluding the padded part of the image
+        delta[s] = mat_pad[s, self.pad_top : w_pad - self.pad_bottom, self.pad_left : h_pad - self.pad_right, :]
+
+    self._map_batch(kernel, len(mat_pad))
 
     return self
 
@@ -4,6 +4,7 @@
 from __future__ import division
 from __future__ import print_function
 
+import numpy as np
 from NumPyNet.exception import LayerError
 
 __author__ = ['Mattia Ceccarelli', 'Nico Curti']
@@ -12,6 +13,10 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 class BaseLayer (object):
 
+  dtype = float # floating point precision of the layer arrays (set by the Network dtype policy)
+  _backward_cache = () # arrays stored by the forward only for the backward step
+  _pool = None # intra-op thread pool (set by the Network, ref. NumPyNet.parallel.ThreadPool)
+
   def __init__ (self, input_shape=None):
     '''
     Base Layer object
@@ -40,6 +45,80 @@ class BaseLayer (object):
       raise ValueError('{0} {1}. Incorrect input shape. Expected {2} and given {3}'.format(func, class_name, shape[1:], arr.shape[1:]))
 
 
+  def __getstate__ (self):
+    '''
+    The thread pool is not dumped with the layer
+    '''
+    state = self.__dict__.copy()
+    state.pop('_pool', None)
+    return state
+
+  def _map_batch (self, func, size):
+    '''
+    Apply the kernel func(s) to the slices s of the batch axis (of length size):
+    the chunks are processed concurrently by the thread pool, if set, otherwise
+    func is called once on the whole batch.
+    '''
+    if self._pool is None:
+      func(slice(None))
+    else:
+      self._pool.map_batch(func, size)
+
+  def _release_cache (self):
+    '''
+    Release the delta and the arrays stored only for the backward step:
+    used by the forward in inference mode (trainable=False).
+    The persistent buffers are kept, so the next training step does not
+    allocate them again.
+    '''
+    self.delta = None
+
+    for attr in self._backward_cache:
+      setattr(self, attr, None)
+
+  def _buffer (self, name, shape, dtype=None, init=None, fill=None):
+    '''
+    Return the persistent buffer of the layer with the given name.
+    The buffer is allocated at the first request (or when the shape changes)
+    and it is reused by the next batches, so the caller must write it in place.
+
+    Parameters
+    ----------
+      name : str
+        Name of the buffer
+
+      shape : tuple
+        Shape of the buffer
+
+      dtype : numpy dtype (default = None)
+        Type of the buffer, by default the layer dtype
+
+      init : float (default = None)
+        Value set only when the buffer is allocated (e.g. the padding borders)
+
+      fill : float (default = None)
+        Value set at every request (e.g. the deltas)
+
+    Returns
+    -------
+      buffer : numpy array
+    '''
+    dtype = self.dtype if dtype is None else dtype
+    buffers = self.__dict__.setdefault('_buffers', {})
+    buffer = buffers.get(name)
+
+    if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+      buffer = np.empty(shape=shape, dtype=dtype)
+      buffers[name] = buffer
+
+      if init is not None:
+        buffer.fill(init)
+
+    if fill is not None:
+      buffer.fill(fill)
+
+    return buffer
+
   def __call__(self, previous_layer):
     '''
     Overload operator ()
@@ -63,7 +142,7 @@ class BaseLayer (object):
     '''
     return self.input_shape
 
-  def forward (self, input, *args, **kwargs):
+  def forward (self, input, trainable=True, *args, **kwargs):
     '''
     Forward function
     '''
@@ -14,9 +14,13 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 class BatchNorm_layer(BaseLayer):
 
+  _backward_cache = ('x', 'x_norm', 'mean', 'var')
+
   epsil = 1e-8
+  momentum = .99 # weight of the past batches in the rolling statistics (as darknet)
+  rolling = False # inference with the batch statistics (as the models saved without this option)
 
-  def __init__(self, scales=None, bias=None, input_shape=None, **kwargs):
+  def __init__(self, scales=None, bias=None, input_shape=None, rolling=False, **kwargs):
 
     '''
     BatchNormalization Layer: It performs a Normalization over the Batch axis
@@ -28,11 +32,18 @@ class BatchNorm_layer(BaseLayer):
       scales : scale to be multiplied to the normalized input, of shape (w, h, c)
       bias   : bias to be added to the multiplication of scale and normalized input of shape (w, h, c)
       input_shape : tuple of 4 integers: input shape of the layer.
+      rolling : bool, default False. If True the inference uses the rolling statistics
+        of the training batches (required by Network.optimize_for_inference),
+        otherwise the statistics of the inference batch.
     '''
 
     self.scales = scales
     self.bias = bias
 
+    # Rolling statistics of the training batches, used at inference if rolling
+    self.rolling = rolling
+    self.rolling_mean, self.rolling_var = (None, None)
+
     # Updates
     self.scales_update, self.bias_update = (None, None)
     self.optimizer = None
@@ -69,7 +80,18 @@ class BatchNorm_layer(BaseLayer):
     '''
     return np.concatenate([self.bias.ravel(), self.scales.ravel()], axis=0).tolist()
 
-  def forward(self, inpt):
+  @staticmethod
+  def _normalize (inpt, mean, factor, output, shift=None):
+    '''
+    Compute in the output array (inpt - mean) * factor (+ shift)
+    '''
+    np.subtract(inpt, mean, out=output)
+    output *= factor
+
+    if shift is not None:
+      output += shift
+
+  def forward(self, inpt, trainable=True):
     '''
     Forward function of the BatchNormalization layer. It computes the output of
     the layer, the formula is :
@@ -81,36 +103,73 @@ class BatchNorm_layer(BaseLayer):
                     input_norm = (input - mean) / sqrt(var + epsil)
 
     where mean and var are the mean and the variance of the input batch of
-    images computed over the first axis (batch)
+    images computed over the first axis (batch).
+    In training they also update the rolling statistics, which replace the
+    batch ones at inference if the layer is built with rolling=True.
 
     Parameters:
       inpt  : numpy array, batch of input images in the format (batch, w, h, c)
+      trainable : boolean, default True. If False (inference) the normalized input
+        and the delta are not stored
     '''
 
     self._check_dims(shape=self.input_shape, arr=inpt, func='Forward')
 
+    # Init scales and bias if they are not initialized (ones and zeros)
+    if self.scales is None:
+      self.scales = np.ones(shape=self.out_shape[1:], dtype=self.dtype)
+
+    if self.bias is None:
+      self.bias = np.zeros(shape=self.out_shape[1:], dtype=self.dtype)
+
+    if not trainable:
+      # Inference: the same normalization without the arrays used by the Backward,
+      # with the rolling statistics if required and the layer has been trained
+      if self.rolling and self.rolling_mean is not None:
+        mean, var = (self.rolling_mean, self.rolling_var)
+      else:
+        mean, var = (inpt.mean(axis=0), inpt.var(axis=0))
+
+      factor = self.scales / np.sqrt(var + self.epsil)
+
+      self.output = self._buffer('output', inpt.shape)
+      self._map_batch(lambda s : self._normalize(inpt[s], mean, factor, self.output[s], shift=self.bias), len(inpt))
+      self._release_cache()
+
+      return self
+
     # Copy input, compute mean and inverse variance with respect the batch axis
-    self.x    = inpt.copy()
+    self.x    = self._buffer('x', inpt.shape)
+    self.x[:] = inpt
     self.mean = self.x.mean(axis=0)                             # shape = (w, h, c)
-    self.var  = 1. / np.sqrt((self.x.var(axis=0)) + self.epsil) # shape = (w, h, c)
+    variance  = self.x.var(axis=0)                              # shape = (w, h, c)
+    self.var  = 1. / np.sqrt(variance + self.epsil)             # shape = (w, h, c)
     # epsil is used to avoid divisions by zero
 
-    # Compute the normalized input
-    self.x_norm = (self.x - self.mean) * self.var # shape (batch, w, h, c)
-    self.output = self.x_norm.copy() # made a copy to store x_norm, used in Backward
+    # Rolling statistics, initialized with the first batch
+    if self.rolling_mean is None:
+      self.rolling_mean, self.rolling_var = (self.mean.copy(), variance)
+    else:
+      self.rolling_mean *= self.momentum
+      self.rolling_mean += (1. - self.momentum) * self.mean
+      self.rolling_var  *= self.momentum
+      self.rolling_var  += (1. - self.momentum) * variance
 
-    # Init scales and bias if they are not initialized (ones and zeros)
-    if self.scales is None:
-      self.scales = np.ones(shape=self.out_shape[1:])
+    # Compute the normalized input (x_norm is stored in its own buffer, used in Backward)
+    self.x_norm = self._buffer('x_norm', inpt.shape) # shape (batch, w, h, c)
+    self.output = self._buffer('output', inpt.shape)
 
-    if self.bias is None:
-      self.bias = np.zeros(shape=self.out_shape[1:])
+    def kernel (s):
+      self._normalize(self.x[s], self.mean, self.var, self.x_norm[s])
 
-    # Output = scale * x_norm + bias
-    self.output = self.output * self.scales + self.bias
+      # Output = scale * x_norm + bias
+      np.multiply(self.x_norm[s], self.scales, out=self.output[s])
+      self.output[s] += self.bias
+
+    self._map_batch(kernel, len(inpt))
 
     # output_shape = (batch, w, h, c)
-    self.delta = np.zeros(shape=self.out_shape, dtype=float)
+    self.delta = self._buffer('delta', self.out_shape, fill=0.)
 
     return self
 
@@ -144,12 +203,15 @@ class BatchNorm_layer(BaseLayer):
                      (-.5 * self.var * self.var * self.var))     # dvar
 
     # Here, delta is the derivative of the output w.r.t. input
-    self.delta = (self.delta * self.var +
-                  self.var_delta * 2 * (self.x - self.mean) * invN +
-                  self.mean_delta * invN)
+    # (the reductions above need the whole batch, this part is split along it)
+    def kernel (s):
+      self.delta[s] *= self.var
+      self.delta[s] += self.var_delta * 2 * (self.x[s] - self.mean) * invN + self.mean_delta * invN
+
+      if delta is not None:
+        delta[s] += self.delta[s]
 
-    if delta is not None:
-      delta[:] += self.delta
+    self._map_batch(kernel, len(self.delta))
 
     return self
 
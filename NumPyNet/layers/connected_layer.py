@@ -17,6 +17,9 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 class Connected_layer(BaseLayer):
 
+  _backward_cache = ('mask', )
+  _fused = None
+
   def __init__(self, outputs, activation=Activations, input_shape=None, weights=None, bias=None, **kwargs):
     '''
     Connected layer
@@ -46,6 +49,10 @@ class Connected_layer(BaseLayer):
     self.activation = activation.activate
     self.gradient   = activation.gradient
 
+    # Fused bias + activation epilogue (if the activation supports it)
+    self._fused = activation if activation.inplace else None
+    self.mask   = None
+
     super(Connected_layer, self).__init__(input_shape=input_shape)
 
     if input_shape is not None:
@@ -68,13 +75,20 @@ class Connected_layer(BaseLayer):
     return 'connected              {0:4d} x{1:4d} x{2:4d} x{3:4d}   ->  {0:4d} x{4:4d}'.format(
             b, w, h, c, self.outputs)
 
+  @property
+  def flops(self):
+    '''
+    Floating point operations of the forward of a single sample
+    '''
+    return 2 * self.inputs * self.outputs
+
   def _build(self):
     if self.weights is None:
       scale = np.sqrt(2. / self.inputs)
-      self.weights = np.random.uniform(low=-scale, high=scale, size=(self.inputs, self.outputs))
+      self.weights = np.random.uniform(low=-scale, high=scale, size=(self.inputs, self.outputs)).astype(self.dtype)
 
     if self.bias is None:
-      self.bias = np.zeros(shape=(self.outputs,), dtype=float)
+      self.bias = np.zeros(shape=(self.outputs,), dtype=self.dtype)
 
   def __call__(self, previous_layer):
 
@@ -112,7 +126,7 @@ class Connected_layer(BaseLayer):
     return np.concatenate([self.bias.ravel(), self.weights.ravel()], axis=0).tolist()
 
 
-  def forward(self, inpt, copy=False):
+  def forward(self, inpt, copy=False, trainable=True):
     '''
     Forward function of the connected layer. It computes the matrix product
       between inpt and weights, add bias and activate the result with the
@@ -123,6 +137,7 @@ class Connected_layer(BaseLayer):
       inpt : numpy array with shape (batch, w, h, c). Input batch of images of the layer
       copy : boolean, default False. States if the activation function have to return a copy of the
              input or not.
+      trainable : boolean, default True. If False (inference) the delta is not allocated.
 
     Returns
     -------
@@ -133,12 +148,22 @@ class Connected_layer(BaseLayer):
     inpt = inpt.reshape(inpt.shape[0], -1)
     self._check_dims(shape=(self.input_shape[0], self.inputs), arr=inpt, func='Forward')
 
-    # shape (batch, outputs)
-    z = np.einsum('ij, jk -> ik', inpt, self.weights, optimize=True) + self.bias
+    # shape (batch, outputs), computed in place in the output buffer
+    z = np.matmul(inpt, self.weights, out=self._buffer('output', (inpt.shape[0], self.outputs)))
+    z += self.bias
 
     # shape (batch, outputs), activated
-    self.output = self.activation(z, copy=copy).reshape(-1, 1, 1, self.outputs)
-    self.delta  = np.zeros(shape=self.out_shape, dtype=float)
+    if self._fused is not None:
+      z = z.reshape(-1, 1, 1, self.outputs)
+      self.mask   = self._buffer('mask', z.shape, dtype=bool) if trainable and self._fused.use_mask else None
+      self.output = self._fused.activate_inplace(z, mask=self.mask)
+    else:
+      self.output = self.activation(z, copy=copy).reshape(-1, 1, 1, self.outputs)
+
+    if trainable:
+      self.delta = self._buffer('delta', self.out_shape, fill=0.)
+    else:
+      self._release_cache()
 
     return self
 
@@ -166,7 +191,11 @@ class Connected_layer(BaseLayer):
     self._check_dims(shape=(self.input_shape[0], self.inputs), arr=inpt, func='Backward')
     # out  = self.output.reshape(-1, self.outputs)
 
-    self.delta *= self.gradient(self.output, copy=copy)
+    if self._fused is not None:
+      workspace = None if self._fused.use_mask else self._buffer('workspace', self.output.shape)
+      self._fused.gradient_inplace(self.delta, self.output, mask=self.mask, workspace=workspace)
+    else:
+      self.delta *= self.gradient(self.output, copy=copy)
     self.delta = self.delta.reshape(-1, self.outputs)
 
     self.bias_update = self.delta.sum(axis=0)   # shape : (outputs,)
@@ -18,6 +18,9 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 class Convolutional_layer(BaseLayer):
 
+  _backward_cache = ('view', 'mask')
+  _fused = None
+
   def __init__(self, filters, size, stride=None, input_shape=None,
                weights=None, bias=None,
                pad=False,
@@ -81,6 +84,10 @@ class Convolutional_layer(BaseLayer):
     self.activation = activation.activate
     self.gradient   = activation.gradient
 
+    # Fused bias + activation epilogue (if the activation supports it)
+    self._fused = activation if activation.inplace else None
+    self.mask   = None
+
     # Padding
     self.pad = pad
     self.pad_left, self.pad_right, self.pad_bottom, self.pad_top = (0, 0, 0, 0)
@@ -101,10 +108,10 @@ class Convolutional_layer(BaseLayer):
 
     if self.weights is None:
       scale = np.sqrt(2 / (self.size[0] * self.size[1] * c))
-      self.weights = np.random.normal(loc=scale, scale=1., size=(self.size[0], self.size[1], c, self.channels_out))
+      self.weights = np.random.normal(loc=scale, scale=1., size=(self.size[0], self.size[1], c, self.channels_out)).astype(self.dtype)
 
     if self.bias is None:
-      self.bias = np.zeros(shape=(self.channels_out, ), dtype=float)
+      self.bias = np.zeros(shape=(self.channels_out, ), dtype=self.dtype)
 
     if self.pad:
       self._evaluate_padding()
@@ -119,7 +126,15 @@ class Convolutional_layer(BaseLayer):
            out_c, self.size[0], self.size[1], self.stride[0],
            batch, w, h, c,
            out_w, out_h, out_c,
-           (2 * self.weights.size * out_h * out_w) * 1e-9)
+           self.flops * 1e-9)
+
+  @property
+  def flops(self):
+    '''
+    Floating point operations of the forward of a single sample
+    '''
+    _, out_w, out_h, _ = self.out_shape
+    return 2 * self.weights.size * out_h * out_w
 
   def __call__(self, previous_layer):
 
@@ -224,24 +239,31 @@ class Convolutional_layer(BaseLayer):
     self.pad_left   = pad_h >> 1
     self.pad_right  = pad_h - self.pad_left
 
-  def _pad(self, inpt):
+  def _pad(self, inpt, name='pad'):
     '''
     Padd every image in a batch with zeros, following keras SAME padding.
 
     Parameters
     ----------
       inpt : input images in the format (batch, in_w, in_h, in_c).
+      name : name of the persistent buffer which stores the padded array.
 
     Returns
     ----------
       padded input array, following keras SAME padding.
     '''
 
-    # return the zeros-padded image, in the same format as inpt (batch, in_w + pad_w, in_h + pad_h, in_c)
-    return np.pad(inpt, pad_width=((0, 0), (self.pad_top, self.pad_bottom), (self.pad_left, self.pad_right), (0, 0)),
-                  mode='constant', constant_values=(0., 0.))
+    # the padded image, in the same format as inpt (batch, in_w + pad_w, in_h + pad_h, in_c), is a
+    # persistent buffer of the layer: the zero border is set only when it is allocated
+    b, w, h, c = inpt.shape
+    shape = (b, w + self.pad_top + self.pad_bottom, h + self.pad_left + self.pad_right, c)
+
+    mat_pad = self._buffer(name, shape, init=0.)
+    mat_pad[:, self.pad_top : self.pad_top + w, self.pad_left : self.pad_left + h, :] = inpt
 
-  def forward(self, inpt, copy=False):
+    return mat_pad
+
+  def forward(self, inpt, copy=False, trainable=True):
     '''
     Forward function of the Convolutional Layer: it convolves an image with 'channels_out'
       filters with dimension (kx,ky, channels_in). In doing so, it creates a view of the image
@@ -253,6 +275,8 @@ class Convolutional_layer(BaseLayer):
       inpt : input batch of images in format (batch, in_w, in_h, in _c)
       copy : boolean, default is False. If False the activation function
              modifies it's input, if True make a copy instead
+      trainable : boolean, default is True. If False (inference) the strided view
+             of the input and the delta are not stored
 
     Returns:
     ----------
@@ -264,7 +288,7 @@ class Convolutional_layer(BaseLayer):
     kx, ky = self.size
     sx, sy = self.stride
     _, w, h, _ = self.input_shape
-    inpt = inpt.astype('float64')
+    inpt = inpt.astype(self.dtype, copy=False)
 
     # Padding
     if self.pad :
@@ -274,14 +298,30 @@ class Convolutional_layer(BaseLayer):
       mat_pad = inpt[:, : (w - kx) // sx*sx + kx, : (h - ky) // sy*sy + ky, ...]
 
     # Create the view of the array with shape (batch, out_w ,out_h, kx, ky, in_c)
-    self.view = self._asStride(mat_pad)
+    view = self._asStride(mat_pad)
+
+    # the reshape of the view is a copy (im2col): it is written in a persistent workspace
+    # and the matrix product is computed in place in the output buffer
+    b, out_w, out_h = view.shape[:3]
+    cols = self._buffer('cols', (b, out_w, out_h, kx, ky, self.weights.shape[2]))
+    cols[:] = view
 
-    # the choice of numpy.einsum is due to reshape of self.view is a copy and not a view
-    z = np.einsum('lmnijk, ijko -> lmno', self.view, self.weights, optimize=True) + self.bias
+    z = self._buffer('output', (b, out_w, out_h, self.channels_out))
+    np.matmul(cols.reshape(b * out_w * out_h, -1), self.weights.reshape(-1, self.channels_out), out=z.reshape(-1, self.channels_out))
+    z += self.bias
 
     # (batch, out_w, out_h, out_c)
-    self.output = self.activation(z, copy=copy)
-    self.delta  = np.zeros(shape=self.out_shape, dtype=float)
+    if self._fused is not None:
+      self.mask   = self._buffer('mask', z.shape, dtype=bool) if trainable and self._fused.use_mask else None
+      self.output = self._fused.activate_inplace(z, mask=self.mask)
+    else:
+      self.output = self.activation(z, copy=copy)
+
+    if trainable:
+      self.view  = view
+      self.delta = self._buffer('delta', self.out_shape, fill=0.)
+    else:
+      self._release_cache()
 
     return self
 
@@ -302,18 +342,22 @@ class Convolutional_layer(BaseLayer):
 
     check_is_fitted(self, 'delta')
     self._check_dims(shape=self.input_shape, arr=delta, func='Backward')
-    delta[:] = delta.astype('float64')
 
     # delta padding to match dimension with padded input when computing the view
+    # (its border collects only the contributions outside the image, which are discarded)
     if self.pad:
-      mat_pad = self._pad(delta) # padded with same values as input
+      mat_pad = self._pad(delta, name='delta_pad') # padded with same values as input
     else:
       mat_pad = delta
 
     # View on delta, I can use this to modify it
     delta_view = self._asStride(mat_pad)
 
-    self.delta *= self.gradient(self.output, copy=copy)
+    if self._fused is not None:
+      workspace = None if self._fused.use_mask else self._buffer('workspace', self.output.shape)
+      self._fused.gradient_inplace(self.delta, self.output, mask=self.mask, workspace=workspace)
+    else:
+      self.delta *= self.gradient(self.output, copy=copy)
 
     # this operation should be +=, as darknet suggest (?)
     self.weights_update = np.einsum('ijklmn, ijko -> lmno', self.view, self.delta)
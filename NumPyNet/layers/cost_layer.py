@@ -44,12 +44,12 @@ class Cost_layer(BaseLayer):
 
     # Need an empty initialization to work out _smooth_l1 and _wgan
     super(Cost_layer, self).__init__(input_shape=input_shape)
-    self.loss   = np.empty(shape=self.out_shape)
+    self.loss   = np.empty(shape=self.out_shape, dtype=self.dtype)
 
   def __str__(self):
     return 'cost                   {0:>4d} x{1:>4d} x{2:>4d} x{3:>4d}   ->  {0:>4d} x{1:>4d} x{2:>4d} x{3:>4d}'.format(*self.out_shape)
 
-  def forward(self, inpt, truth=None):
+  def forward(self, inpt, truth=None, trainable=True):
     '''
     Forward function for the cost layer. Using the chosen
     cost function, computes output, delta and cost.
@@ -58,12 +58,18 @@ class Cost_layer(BaseLayer):
       inpt: the output of the previous layer.
       truth: truth values, it should have the same
         dimension as inpt.
+      trainable: if False (inference) and no truth is given, the delta is not allocated.
     '''
     self._check_dims(shape=self.input_shape, arr=inpt, func='Forward')
 
-    self.delta  = np.empty(shape=self.out_shape)
     self.output = inpt[:]
 
+    if trainable or truth is not None:
+      # the delta is also the workspace of the cost functions
+      self.delta = self._buffer('delta', self.out_shape)
+    else:
+      self._release_cache()
+
     if truth is not None:
 
       if self.smoothing: truth = self._smoothing(truth)                         # smooth is applied on truth
@@ -15,6 +15,8 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 class Dropout_layer(BaseLayer):
 
+  _backward_cache = ('rnd', )
+
   def __init__(self, prob, input_shape=None, **kwargs):
     '''
     Dropout Layer: drop a random selection of Inputs. This helps avoid overfitting.
@@ -45,7 +47,7 @@ class Dropout_layer(BaseLayer):
            self.probability,
            batch, out_width , out_height , out_channels)
 
-  def forward(self, inpt):
+  def forward(self, inpt, trainable=True):
     '''
     Forward function of the Dropout layer: it create a random mask for every input
       in the batch and set to zero the chosen values. Other pixels are scaled
@@ -54,6 +56,8 @@ class Dropout_layer(BaseLayer):
     Parameters
     ----------
       inpt : numpy array of shape (batch, w, h, c), input of the layer
+      trainable : boolean, default True. If False (inference) the layer is the identity:
+        no mask is drawn and no delta is allocated.
 
     Returns
     ----------
@@ -61,9 +65,17 @@ class Dropout_layer(BaseLayer):
     '''
     self._check_dims(shape=self.out_shape, arr=inpt, func='Forward')
 
-    self.rnd = np.random.uniform(low=0., high=1., size=self.out_shape) >= self.probability
-    self.output = self.rnd * inpt * self.scale
-    self.delta  = np.zeros(shape=inpt.shape)
+    if not trainable:
+      # the surviving inputs are already rescaled in training (inverted dropout)
+      self.output = inpt
+      self._release_cache()
+      return self
+
+    self.rnd = np.greater_equal(np.random.uniform(low=0., high=1., size=self.out_shape), self.probability,
+                                out=self._buffer('rnd', self.out_shape, dtype=bool))
+    self.output = np.multiply(self.rnd, inpt, out=self._buffer('output', inpt.shape))
+    self.output *= self.scale
+    self.delta  = self._buffer('delta', inpt.shape, fill=0.)
 
     return self
 
@@ -17,6 +17,8 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 class GRU_layer (object):
 
+  dtype = float
+
   def __init__ (self, outputs, steps, input_shape=None, weights=None, bias=None):
 
     if isinstance(outputs, int) and outputs > 0:
@@ -69,11 +71,11 @@ class GRU_layer (object):
     return np.swapaxes(X, 0, 1)
 
 
-  def forward(self, inpt):
+  def forward(self, inpt, trainable=True):
 
-    inpt = inpt.astype('float64')
+    inpt = inpt.astype(self.dtype, copy=False)
     _input = self._as_Strided(inpt)
-    state  = np.zeros(shape=(_input.shape[1], self.outputs))
+    state  = np.zeros(shape=(_input.shape[1], self.outputs), dtype=self.dtype)
 
     self.output = np.zeros_like(state)
 
@@ -97,7 +99,7 @@ class GRU_layer (object):
     # implementation "no sequence"
     self.output = state
 
-    self.delta = np.zeros_like(self.output)
+    self.delta = np.zeros_like(self.output) if trainable else None
 
   def backward(self, delta):
     pass
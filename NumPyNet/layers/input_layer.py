@@ -32,13 +32,14 @@ class Input_layer(BaseLayer):
     batch, w, h, c = self.input_shape
     return 'input                  {0:>4d} x{1:>4d} x{2:>4d} x{3:>4d}   ->  {0:>4d} x{1:>4d} x{2:>4d} x{3:>4d}'.format(batch, w, h, c)
 
-  def forward(self, inpt):
+  def forward(self, inpt, trainable=True):
     '''
     Simply store the input array.
 
     Parameters
     ----------
       inpt: numpy array, input array of the layer.
+      trainable: bool, default True. If False (inference) the delta is not allocated.
 
     Returns
     -------
@@ -48,7 +49,11 @@ class Input_layer(BaseLayer):
     self._check_dims(shape=self.out_shape, arr=inpt, func='Forward')
 
     self.output = inpt
-    self.delta  = np.zeros(shape=self.out_shape, dtype=float)
+
+    if trainable:
+      self.delta = self._buffer('delta', self.out_shape, fill=0.)
+    else:
+      self._release_cache()
 
     return self
 
@@ -14,6 +14,8 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 class L1Norm_layer(BaseLayer):
 
+  _backward_cache = ('scales', )
+
   def __init__(self, input_shape=None, axis=None, **kwargs):
     '''
     L1Norm layer
@@ -34,7 +36,7 @@ class L1Norm_layer(BaseLayer):
     return 'l1norm                 {0:>4d} x{1:>4d} x{2:>4d} x{3:>4d}   ->  {0:>4d} x{1:>4d} x{2:>4d} x{3:>4d}'.format(
            batch, w, h, c)
 
-  def forward(self, inpt):
+  def forward(self, inpt, trainable=True):
     '''
     Forward of the l1norm layer, apply the l1 normalization over
     the input along the given axis
@@ -42,6 +44,8 @@ class L1Norm_layer(BaseLayer):
     Parameters
     ----------
       inpt: numpy array, the input to be normalized.
+      trainable: bool, default True. If False (inference) the scales and the delta
+        used by the backward are not stored.
 
     Returns
     -------
@@ -53,8 +57,12 @@ class L1Norm_layer(BaseLayer):
     norm = np.abs(inpt).sum(axis=self.axis, keepdims=True)
     norm = 1. / (norm + 1e-8)
     self.output = inpt * norm
-    self.scales = -np.sign(self.output)
-    self.delta  = np.zeros(shape=self.out_shape, dtype=float)
+
+    if trainable:
+      self.scales = -np.sign(self.output)
+      self.delta  = self._buffer('delta', self.out_shape, fill=0.)
+    else:
+      self._release_cache()
 
     return self
 
@@ -34,7 +34,7 @@ class Logistic_layer(BaseLayer):
     return 'logistic x entropy                                  {:>4d} x{:>4d} x{:>4d} x{:>4d}' .format(
            batch, out_width, out_height, out_channels)
 
-  def forward(self, inpt, truth=None) :
+  def forward(self, inpt, truth=None, trainable=True) :
     '''
     Forward function of the logistic layer, now the output should be consistent with darknet
 
@@ -42,6 +42,7 @@ class Logistic_layer(BaseLayer):
       inpt : output of the network with shape (batch, w, h, c)
       truth : arrat of same shape as input (without the batch dimension),
         if given, the function computes the binary cross entropy
+      trainable : if False (inference) and no truth is given, the delta is not allocated
     '''
 
     self._check_dims(shape=self.out_shape, arr=inpt, func='Forward')
@@ -59,8 +60,10 @@ class Logistic_layer(BaseLayer):
       self.delta = (truth - out) * out_upd
       # self.cost = np.mean(self.loss)
       self.cost = np.sum(self.loss) # as for darknet
+    elif trainable :
+      self.delta = self._buffer('delta', self.out_shape, fill=0.)
     else :
-      self.delta = np.zeros(shape=self.out_shape, dtype=float)
+      self._release_cache()
 
     return self
 
@@ -18,6 +18,8 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 class LSTM_layer(object):
 
+  dtype = float
+
   def __init__(self, outputs, steps, input_shape=None, weights=None, bias=None, **kwargs):
     '''
     LSTM layer
@@ -92,8 +94,8 @@ class LSTM_layer(object):
       self.wg.input_shape = (self.input_shape[0], w, h, self.outputs)
       self.wo.input_shape = (self.input_shape[0], w, h, self.outputs)
 
-      self.cell = np.empty(shape=self.uf.out_shape, dtype=float)
-      self.output = np.empty(shape=self.uf.out_shape, dtype=float)
+      self.cell = np.empty(shape=self.uf.out_shape, dtype=self.dtype)
+      self.output = np.empty(shape=self.uf.out_shape, dtype=self.dtype)
 
     else:
       self.input_shape = None
@@ -162,10 +164,10 @@ class LSTM_layer(object):
       self.wg.input_shape = (b, w, h, self.outputs)
       self.wo.input_shape = (b, w, h, self.outputs)
 
-      self.state = np.zeros(shape=(self.batch, w, h, self.outputs), dtype=float)
+      self.state = np.zeros(shape=(self.batch, w, h, self.outputs), dtype=self.dtype)
 
-      self.output = np.empty(shape=self.uf.out_shape, dtype=float)
-      self.cell = np.empty(shape=self.uf.out_shape, dtype=float)
+      self.output = np.empty(shape=self.uf.out_shape, dtype=self.dtype)
+      self.cell = np.empty(shape=self.uf.out_shape, dtype=self.dtype)
       self.delta = None
       self.optimizer = None
 
@@ -217,7 +219,7 @@ class LSTM_layer(object):
                            self.wo.bias.ravel(), self.wo.weights.ravel()], axis=0).tolist()
 
 
-  def forward(self, inpt, copy=False):
+  def forward(self, inpt, copy=False, trainable=True):
     '''
     Forward function of the LSTM layer. It computes the matrix product
       between inpt and weights, add bias and activate the result with the
@@ -227,22 +229,23 @@ class LSTM_layer(object):
     ----------
       inpt : numpy array with shape (batch, w, h, c). Input batch of images of the layer
       shortcut : boolean, default False. Enable/Disable internal shortcut connection.
+      trainable : boolean, default True. If False (inference) the deltas are not allocated.
 
     Returns
     ----------
     LSTM_layer object
     '''
 
-    self.uf.output = np.empty(shape=self.uf.out_shape, dtype=float)
-    self.ui.output = np.empty(shape=self.ui.out_shape, dtype=float)
-    self.ug.output = np.empty(shape=self.ug.out_shape, dtype=float)
-    self.uo.output = np.empty(shape=self.uo.out_shape, dtype=float)
-    self.wf.output = np.empty(shape=self.wf.out_shape, dtype=float)
-    self.wi.output = np.empty(shape=self.wi.out_shape, dtype=float)
-    self.wg.output = np.empty(shape=self.wg.out_shape, dtype=float)
-    self.wo.output = np.empty(shape=self.wo.out_shape, dtype=float)
+    self.uf.output = np.empty(shape=self.uf.out_shape, dtype=self.dtype)
+    self.ui.output = np.empty(shape=self.ui.out_shape, dtype=self.dtype)
+    self.ug.output = np.empty(shape=self.ug.out_shape, dtype=self.dtype)
+    self.uo.output = np.empty(shape=self.uo.out_shape, dtype=self.dtype)
+    self.wf.output = np.empty(shape=self.wf.out_shape, dtype=self.dtype)
+    self.wi.output = np.empty(shape=self.wi.out_shape, dtype=self.dtype)
+    self.wg.output = np.empty(shape=self.wg.out_shape, dtype=self.dtype)
+    self.wo.output = np.empty(shape=self.wo.out_shape, dtype=self.dtype)
 
-    h = np.zeros(shape=self.out_shape, dtype=float)
+    h = np.zeros(shape=self.out_shape, dtype=self.dtype)
     c = 0.
 
     for idx in self.batches:
@@ -275,16 +278,23 @@ class LSTM_layer(object):
       self.cell[idx, ...] = c
       self.output[idx, ...] = h_slice
 
-    self.uf.delta = np.zeros(shape=self.uf.out_shape, dtype=float)
-    self.ui.delta = np.zeros(shape=self.ui.out_shape, dtype=float)
-    self.ug.delta = np.zeros(shape=self.ug.out_shape, dtype=float)
-    self.uo.delta = np.zeros(shape=self.uo.out_shape, dtype=float)
-    self.wf.delta = np.zeros(shape=self.wf.out_shape, dtype=float)
-    self.wi.delta = np.zeros(shape=self.wi.out_shape, dtype=float)
-    self.wg.delta = np.zeros(shape=self.wg.out_shape, dtype=float)
-    self.wo.delta = np.zeros(shape=self.wo.out_shape, dtype=float)
+    if not trainable:
+      for layer in (self.uf, self.ui, self.ug, self.uo, self.wf, self.wi, self.wg, self.wo):
+        layer.delta = None
+
+      self.delta = None
+      return self
+
+    self.uf.delta = np.zeros(shape=self.uf.out_shape, dtype=self.dtype)
+    self.ui.delta = np.zeros(shape=self.ui.out_shape, dtype=self.dtype)
+    self.ug.delta = np.zeros(shape=self.ug.out_shape, dtype=self.dtype)
+    self.uo.delta = np.zeros(shape=self.uo.out_shape, dtype=self.dtype)
+    self.wf.delta = np.zeros(shape=self.wf.out_shape, dtype=self.dtype)
+    self.wi.delta = np.zeros(shape=self.wi.out_shape, dtype=self.dtype)
+    self.wg.delta = np.zeros(shape=self.wg.out_shape, dtype=self.dtype)
+    self.wo.delta = np.zeros(shape=self.wo.out_shape, dtype=self.dtype)
 
-    self.delta = np.zeros(shape=self.out_shape, dtype=float)
+    self.delta = np.zeros(shape=self.out_shape, dtype=self.dtype)
 
     return self
 
@@ -331,7 +341,7 @@ class LSTM_layer(object):
 
     check_is_fitted(self, 'delta')
 
-    dh = np.zeros(shape=self.out_shape, dtype=float)
+    dh = np.zeros(shape=self.out_shape, dtype=self.dtype)
     prev_cell = None
     prev_state = None
 
@@ -15,6 +15,8 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 class Maxpool_layer(BaseLayer):
 
+  _backward_cache = ('indexes', )
+
   def __init__(self, size, stride=None, pad=False, input_shape=None, **kwargs):
 
     '''
@@ -141,7 +143,7 @@ class Maxpool_layer(BaseLayer):
     self.pad_left   = pad_h >> 1
     self.pad_right  = pad_h - self.pad_left
 
-  def _pad(self, inpt):
+  def _pad(self, inpt, name='pad'):
     '''
     Padd every image in a batch with np.nan following keras SAME padding
     See also:
@@ -150,17 +152,24 @@ class Maxpool_layer(BaseLayer):
     Parameters
     ----------
       inpt : numpy array, input images in the format (batch, w, h, c)
+      name : str, name of the persistent buffer which stores the padded array
 
     Returns
     -------
       padded array.
     '''
 
-    # return the nan-padded image, in the same format as inpt (batch, width + pad_w, height + pad_h, channels)
-    return np.pad(inpt, pad_width=((0, 0), (self.pad_top, self.pad_bottom), (self.pad_left, self.pad_right), (0, 0)),
-                  mode='constant', constant_values=(np.nan, np.nan))
+    # the padded image, in the same format as inpt (batch, width + pad_w, height + pad_h, channels), is a
+    # persistent buffer of the layer: the nan border is set only when it is allocated
+    b, w, h, c = inpt.shape
+    shape = (b, w + self.pad_top + self.pad_bottom, h + self.pad_left + self.pad_right, c)
+
+    mat_pad = self._buffer(name, shape, init=np.nan)
+    mat_pad[:, self.pad_top : self.pad_top + w, self.pad_left : self.pad_left + h, :] = inpt
+
+    return mat_pad
 
-  def forward(self, inpt):
+  def forward(self, inpt, trainable=True):
     '''
     Forward function of the maxpool layer: It slides a kernel over every input image and return
     the maximum value of every sub-window.
@@ -171,6 +180,8 @@ class Maxpool_layer(BaseLayer):
     Parameters
     ----------
       inpt : input images in the format (batch, input_w, input_h, input_c)
+      trainable : boolean, default True. If False (inference) the indexes of the
+        maxima and the delta are not computed
 
     Returns
     -------
@@ -182,7 +193,7 @@ class Maxpool_layer(BaseLayer):
     kx , ky  = self.size
     st1, st2 = self.stride
     _, w, h, _ = self.input_shape
-    inpt = inpt.astype('float64')
+    inpt = inpt.astype(self.dtype, copy=False)
 
     if self.pad:
       mat_pad = self._pad(inpt)
@@ -195,7 +206,12 @@ class Maxpool_layer(BaseLayer):
 
     # final shape (batch, out_w, out_h, c)
 
-    self.output = np.nanmax(view, axis=(4,5))
+    self.output = self._buffer('output', view.shape[:4])
+    self._map_batch(lambda s : np.nanmax(view[s], axis=(4, 5), out=self.output[s]), len(view))
+
+    if not trainable:
+      self._release_cache()
+      return self
 
     # New shape for view, to retrieve indexes
     new_shape = view.shape[:4] + (kx*ky, )
@@ -208,7 +224,7 @@ class Maxpool_layer(BaseLayer):
     except TypeError: # retro-compatibility for Numpy version older than 1.16
       self.indexes = np.unravel_index(self.indexes.ravel(), dims=(kx, ky))
 
-    self.delta = np.zeros(shape=self.out_shape, dtype=float)
+    self.delta = self._buffer('delta', self.out_shape, fill=0.)
 
     return self
 
@@ -230,11 +246,10 @@ class Maxpool_layer(BaseLayer):
 
     check_is_fitted(self, 'delta')
     self._check_dims(shape=self.input_shape, arr=delta, func='Backward')
-    delta[:] = delta.astype('float64')
 
     # Padding delta in order to create another view
     if self.pad:
-      mat_pad = self._pad(delta)
+      mat_pad = self._pad(delta, name='delta_pad')
     else:
       mat_pad = delta
 
@@ -242,17 +257,22 @@ class Maxpool_layer(BaseLayer):
     net_delta_view = self._asStride(mat_pad)
 
     b, w, h, c = self.output.shape
+    _ , w_pad, h_pad, _ = mat_pad.shape
+    size = w * h * c
 
-    # those indexes are usefull to access 'Atomically'(one at a time) every element in net_delta_view
-    for (i, j, k, l), m, o, D in zip(np.ndindex(b, w, h, c), self.indexes[0], self.indexes[1], np.nditer(self.delta)):
-      net_delta_view[i, j, k, l, m, o] += D
+    def kernel (s):
+      batch = range(b)[s]
+      indexes = slice(batch.start * size, batch.stop * size)
 
-    # Here delta is correctly modified
-    if self.pad:
-      _ , w_pad, h_pad, _ = mat_pad.shape
-      delta[:] = mat_pad[:, self.pad_top : w_pad-self.pad_bottom, self.pad_left : h_pad - self.pad_right, :]
-    else:
-      delta[:] = mat_pad
+      # those indexes are usefull to access 'Atomically'(one at a time) every element in net_delta_view
+      for (i, j, k, l), m, o, D in zip(np.ndindex(len(batch), w, h, c), self.indexes[0][indexes], self.indexes[1][indexes], np.nditer(self.delta[s])):
+        net_delta_view[batch.start + i, j, k, l, m, o] += D
+
+      # Here delta is correctly modified
+      if self.pad:
+        delta[s] = mat_pad[s, self.pad_top : w_pad-self.pad_bottom, self.pad_left : h_pad - self.pad_right, :]
+
+    self._map_batch(kernel, b)
 
     return self
 
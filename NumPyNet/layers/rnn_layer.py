@@ -18,6 +18,8 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 class RNN_layer(object):
 
+  dtype = float
+
   def __init__(self, outputs, steps, activation=Activations, input_shape=None, weights=None, bias=None, **kwargs):
     '''
     RNN layer
@@ -77,7 +79,7 @@ class RNN_layer(object):
       self.self_layer   = Connected_layer(self.outputs, self.activation, weights=weights[1], bias=bias[1])(self.input_layer)
       self.output_layer = Connected_layer(self.outputs, self.activation, weights=weights[2], bias=bias[2])(self.self_layer)
 
-      self.state = np.zeros(shape=(self.batch, w, h, self.outputs), dtype=float)
+      self.state = np.zeros(shape=(self.batch, w, h, self.outputs), dtype=self.dtype)
 
     else:
       self.batch = None
@@ -123,7 +125,7 @@ class RNN_layer(object):
     self.self_layer   = Connected_layer(self.outputs, self.activation)(self.input_layer)
     self.output_layer = Connected_layer(self.outputs, self.activation)(self.self_layer)
 
-    self.state = np.zeros(shape=(self.batch, w, h, self.outputs), dtype=float)
+    self.state = np.zeros(shape=(self.batch, w, h, self.outputs), dtype=self.dtype)
 
     self.output, self.delta = (None, None)
 
@@ -173,6 +175,9 @@ class RNN_layer(object):
     Parameters
     ----------
       inpt : numpy array with shape (batch, w, h, c). Input batch of images of the layer
+      copy : boolean, default True. If True the activation functions make a copy of their input
+      trainable : boolean, default True. If False (inference) the previous state and the
+        deltas used by the backward are not stored
 
     Returns
     ----------
@@ -181,11 +186,14 @@ class RNN_layer(object):
 
     if trainable:
       self.prev_state = self.state.copy()
-      self.state = np.zeros_like(self.state)
+    else:
+      self.prev_state = None
+
+    self.state = np.zeros_like(self.state)
 
-    self.input_layer.output = np.zeros(shape=self.input_layer.out_shape, dtype=float)
-    self.self_layer.output = np.zeros(shape=self.self_layer.out_shape, dtype=float)
-    self.output_layer.output = np.zeros(shape=self.output_layer.out_shape, dtype=float)
+    self.input_layer.output = np.zeros(shape=self.input_layer.out_shape, dtype=self.dtype)
+    self.self_layer.output = np.zeros(shape=self.self_layer.out_shape, dtype=self.dtype)
+    self.output_layer.output = np.zeros(shape=self.output_layer.out_shape, dtype=self.dtype)
 
     for idx in self.batches:
 
@@ -205,9 +213,12 @@ class RNN_layer(object):
       self.output_layer.output[idx, ...] = self.output_layer.activation(z, copy=copy).reshape(-1, 1, 1, self.output_layer.outputs)
 
 
-    self.input_layer.delta = np.zeros(shape=self.input_layer.out_shape, dtype=float)
-    self.self_layer.delta = np.zeros(shape=self.self_layer.out_shape, dtype=float)
-    self.output_layer.delta = np.zeros(shape=self.output_layer.out_shape, dtype=float)
+    if trainable:
+      self.input_layer.delta = np.zeros(shape=self.input_layer.out_shape, dtype=self.dtype)
+      self.self_layer.delta = np.zeros(shape=self.self_layer.out_shape, dtype=self.dtype)
+      self.output_layer.delta = np.zeros(shape=self.output_layer.out_shape, dtype=self.dtype)
+    else:
+      self.input_layer.delta, self.self_layer.delta, self.output_layer.delta = (None, None, None)
 
     self.output = self.output_layer.output
     self.delta = self.output_layer.delta
@@ -81,7 +81,7 @@ class Route_layer(BaseLayer):
     self._build(previous_layer)
     return self
 
-  def forward(self, network):
+  def forward(self, network, trainable=True):
     '''
     Concatenate along chosen axis the outputs of selected network layers
     In main CNN applications, like YOLOv3, the concatenation happens long channels axis
@@ -89,6 +89,7 @@ class Route_layer(BaseLayer):
     Parameters
     ----------
       network : Network object type.
+      trainable : boolean, default True. If False (inference) the delta is not allocated.
 
     Returns
     -------
@@ -96,7 +97,10 @@ class Route_layer(BaseLayer):
     '''
 
     self.output = np.concatenate([network[layer_idx].output for layer_idx in self.input_layers], axis=self.axis)
-    self.delta  = np.zeros(shape=self.out_shape, dtype=float)
+    if trainable:
+      self.delta = self._buffer('delta', self.out_shape, fill=0.)
+    else:
+      self._release_cache()
 
     return self
 
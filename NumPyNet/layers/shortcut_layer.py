@@ -93,7 +93,7 @@ class Shortcut_layer(BaseLayer):
     self.iy, self.jy, self.ky = zip(*idx)
 
 
-  def forward(self, inpt, prev_output, copy=False):
+  def forward(self, inpt, prev_output, copy=False, trainable=True):
     '''
     Forward function of the Shortcut layer: activation of the linear combination between input.
 
@@ -101,6 +101,7 @@ class Shortcut_layer(BaseLayer):
     ----------
       inpt        : array of shape (batch, w, h, c), first input of the layer.
       prev_output : array of shape (batch, w, h, c), second input of the layer.
+      trainable   : boolean, default True. If False (inference) the delta is not allocated.
 
     Returns
     -------
@@ -138,7 +139,10 @@ class Shortcut_layer(BaseLayer):
       self.output[:, self.ix, self.jx, self.kx] = self.alpha * self.output[:, self.ix, self.jx, self.kx] + self.beta * prev_output[:, self.iy, self.jy, self.ky]
 
     self.output = self.activation(self.output, copy=copy)
-    self.delta = np.zeros(shape=self.out_shape, dtype=float)
+    if trainable:
+      self.delta = self._buffer('delta', self.out_shape, fill=0.)
+    else:
+      self._release_cache()
 
     return self
 
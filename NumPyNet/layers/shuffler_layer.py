@@ -98,7 +98,7 @@ class Shuffler_layer(BaseLayer):
     # for the concatenate in the backward function
     return delta.transpose(3, 0, 1, 2)
 
-  def forward(self, inpt):
+  def forward(self, inpt, trainable=True):
     '''
     Forward function of the shuffler layer: it recieves as input an image in
     the format ('batch' not yet , in_w, in_h, in_c) and it produce an output
@@ -107,6 +107,7 @@ class Shuffler_layer(BaseLayer):
     Parameters
     ----------
       inpt : input batch of images to be reorganized, with format (batch, in_w, in_h, in_c)
+      trainable : boolean, default True. If False (inference) the delta is not allocated.
 
     Returns
     -------
@@ -120,11 +121,15 @@ class Shuffler_layer(BaseLayer):
     # The function phase shift receives only in_c // out_c channels at a time
     # the concatenate stitches together every output of the function.
 
-    self.output = np.concatenate([self._phase_shift(inpt[..., range(i, c, channel_out)], self.scale)
-                                  for i in range(channel_out)], axis=3)
+    self.output = self._buffer('output', (len(inpt), ) + self.out_shape[1:])
+    self._map_batch(lambda s : np.concatenate([self._phase_shift(inpt[s][..., range(i, c, channel_out)], self.scale)
+                                               for i in range(channel_out)], axis=3, out=self.output[s]), len(inpt))
 
     # output shape = (batch, in_w * scale, in_h * scale, in_c // scale**2)
-    self.delta = np.zeros(shape=self.out_shape, dtype=float)
+    if trainable:
+      self.delta = self._buffer('delta', self.out_shape, fill=0.)
+    else:
+      self._release_cache()
 
     return self
 
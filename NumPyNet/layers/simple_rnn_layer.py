@@ -70,14 +70,14 @@ class SimpleRNN_layer(BaseLayer):
 
     if self.weights is None:
       scale = np.sqrt(2 / (w * h * c * self.outputs))
-      self.weights = np.random.normal(loc=scale, scale=1., size=(w * h * c, self.outputs))
+      self.weights = np.random.normal(loc=scale, scale=1., size=(w * h * c, self.outputs)).astype(self.dtype)
 
     if self.recurrent_weights is None:
       scale = np.sqrt(2 / (self.outputs * self.outputs))
-      self.recurrent_weights = np.random.normal(loc=scale, scale=1., size=(self.outputs, self.outputs))
+      self.recurrent_weights = np.random.normal(loc=scale, scale=1., size=(self.outputs, self.outputs)).astype(self.dtype)
 
     if self.bias is None:
-      self.bias = np.zeros(shape=(self.outputs, ), dtype=float)
+      self.bias = np.zeros(shape=(self.outputs, ), dtype=self.dtype)
 
     if self.return_sequence:
       self._out_shape = (b - self.steps, 1, 1, self.outputs * self.steps)
@@ -170,14 +170,14 @@ class SimpleRNN_layer(BaseLayer):
 
     return np.swapaxes(view, 0, 1)
 
-  def forward (self, inpt, copy=False):
+  def forward (self, inpt, copy=False, trainable=True):
     '''
     Forward of the RNN layer
     '''
 
-    inpt = inpt.astype('float64')
+    inpt = inpt.astype(self.dtype, copy=False)
     self.X = self._asStride(inpt.reshape(-1, np.prod(inpt.shape[1:])))
-    self.states = np.zeros(shape=(self.steps, self.X.shape[1], self.outputs))
+    self.states = np.zeros(shape=(self.steps, self.X.shape[1], self.outputs), dtype=self.dtype)
 
     for i, _input in enumerate(self.X) :
 
@@ -199,7 +199,7 @@ class SimpleRNN_layer(BaseLayer):
       self.output = np.swapaxes(self.states, 0, 1)
 
     self.output = self.output.reshape(self.X.shape[1], 1, 1, -1)
-    self.delta  = np.zeros_like(self.output)
+    self.delta  = np.zeros_like(self.output) if trainable else None
 
     return self
 
@@ -43,7 +43,7 @@ class Softmax_layer(BaseLayer):
     batch, out_width, out_height, out_channels = self.out_shape
     return 'softmax x entropy                                   {0:>4d} x{1:>4d} x{2:>4d} x{3:>4d}'.format(batch, out_width, out_height, out_channels)
 
-  def forward(self, inpt, truth=None) :
+  def forward(self, inpt, truth=None, trainable=True) :
     '''
     Forward function of the Softmax Layer.
 
@@ -52,6 +52,8 @@ class Softmax_layer(BaseLayer):
       inpt  : numpy array of shape (batch, w, h, c), input array
       truth : numpy array of shape (batch, w, h, c), default is None, target vector.
         if a value is passed, the function compute the cross entropy cost
+      trainable : boolean, default True. If False (inference) and no truth is given,
+        the delta is not allocated
 
     Returns
     -------
@@ -60,19 +62,28 @@ class Softmax_layer(BaseLayer):
 
     self._check_dims(shape=self.out_shape, arr=inpt, func='Forward')
 
+    # the exponentials are computed in place in the output buffer
+    output = self._buffer('output', inpt.shape)
+
     if self.spatial:
-      self.output = np.exp(inpt - inpt.max(axis=-1, keepdims=True))
-      s = 1. / self.output.sum(axis=-1, keepdims=True)
-      self.output *= s
+      np.subtract(inpt, inpt.max(axis=-1, keepdims=True), out=output)
+      np.exp(output, out=output)
+      s = 1. / output.sum(axis=-1, keepdims=True)
+      output *= s
 
     else :
 
       shape = inpt.shape
       inpt = inpt.reshape(shape[0], -1)
+      output = output.reshape(inpt.shape)
+
+      np.subtract(inpt, inpt.max(axis=1, keepdims=True), out=output)
+      output *= self.temperature
+      np.exp(output, out=output)
+      output *= 1. / output.sum(axis=1, keepdims=True)
+      output = output.reshape(shape)
 
-      self.output = np.exp((inpt - inpt.max(axis=1, keepdims=True) ) * self.temperature)
-      self.output *= 1. / self.output.sum(axis=1, keepdims=True)
-      self.output = self.output.reshape(shape)
+    self.output = output
 
     # value of delta if truth is None
     # self.delta = np.zeros(shape=self.out_shape, dtype=float)
@@ -82,9 +93,12 @@ class Softmax_layer(BaseLayer):
       out = np.clip(self.output, 1e-8, 1. - 1e-8)
       self.cost = - np.sum(truth * np.log(out))
       # self.delta = out - truth  # one hot-encoded case (single 1 for every output array)
-      self.delta = out * truth.sum(axis=(1, 2, 3), keepdims=True) - truth # general case?
+      self.delta = np.multiply(out, truth.sum(axis=(1, 2, 3), keepdims=True), out=self._buffer('delta', out.shape))
+      self.delta -= truth # general case?
+    elif trainable:
+      self.delta  = self._buffer('delta', self.out_shape)
     else:
-      self.delta  = np.empty(shape=self.out_shape)
+      self._release_cache()
 
     return self
 
@@ -82,11 +82,11 @@ class Upsample_layer(BaseLayer):
     batch, w,  h,  c  = inpt.shape     # number of rows/columns
     b,     ws, hs, cs = inpt.strides   # row/column strides
 
-    inpt = inpt.astype('float64')
+    inpt = inpt.astype(self.dtype, copy=False)
     x = as_strided(inpt, (batch, w, self.stride[0], h, self.stride[1], c), (b, ws, 0, hs, 0, cs)) # view a as larger 4D array
     return x.reshape(batch, w * self.stride[0], h * self.stride[1], c)                            # create new 2D array
 
-  def forward(self, inpt):
+  def forward(self, inpt, trainable=True):
     '''
     Forward of the upsample layer, apply a bilinear upsample/downsample to
     the input according to the sign of stride
@@ -94,6 +94,7 @@ class Upsample_layer(BaseLayer):
     Parameters
     ----------
       inpt: numpy array. Input image to be up/down-sampled
+      trainable: bool, default True. If False (inference) the delta is not allocated.
 
     Returns
     -------
@@ -102,13 +103,15 @@ class Upsample_layer(BaseLayer):
 
     self._check_dims(shape=self.input_shape, arr=inpt, func='Forward')
 
-    if self.reverse: # Downsample
-      self.output = self._downsample(inpt) * self.scale
+    resample = self._downsample if self.reverse else self._upsample
 
-    else:            # Upsample
-      self.output = self._upsample(inpt) * self.scale
+    self.output = self._buffer('output', (len(inpt), ) + self.out_shape[1:])
+    self._map_batch(lambda s : np.multiply(resample(inpt[s]), self.scale, out=self.output[s]), len(inpt))
 
-    self.delta = np.zeros(shape=inpt.shape, dtype=float)
+    if trainable:
+      self.delta = self._buffer('delta', inpt.shape, fill=0.)
+    else:
+      self._release_cache()
 
     return self
 
@@ -18,6 +18,8 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 class Yolo_layer(object):
 
+  dtype = float
+
   def __init__(self, input_shape, anchors, max_grid,
                      warmup_batches,
                      ignore_thresh,
@@ -222,7 +224,7 @@ class Yolo_layer(object):
     #        index, avg_iou, avg_cat, avg_obj, avg_noobj, recall50, recall75, count))
 
     self.cost = loss * self.grid_scale
-    self.delta = np.zeros(shape=self.out_shape, dtype=float)
+    self.delta = np.zeros(shape=self.out_shape, dtype=self.dtype)
 
     return self
 
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+
+import tracemalloc
+import numpy as np
+
+from NumPyNet.parallel import PARAMETERS
+from NumPyNet.parallel import GRADIENTS
+
+__author__ = ['Mattia Ceccarelli', 'Nico Curti']
+__email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
+
+
+# categories of the arrays owned by the layers
+CATEGORIES = ('weights', 'updates', 'optimizer', 'outputs', 'deltas', 'workspace')
+
+UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
+
+def format_bytes (nbytes):
+  '''
+  Human readable size
+  '''
+  for unit in UNITS[:-1]:
+    if abs(nbytes) < 1024.:
+      return '{:.1f} {}'.format(nbytes, unit)
+    nbytes /= 1024.
+
+  return '{:.1f} {}'.format(nbytes, UNITS[-1])
+
+
+def _arrays (value):
+  '''
+  Return the numpy arrays stored in value (array, list or tuple of arrays)
+  '''
+  if isinstance(value, np.ndarray):
+    return [value]
+
+  if isinstance(value, (list, tuple)):
+    return [v for v in value if isinstance(v, np.ndarray)]
+
+  return []
+
+
+def _base (array):
+  '''
+  Array which owns the memory of the given one (the views do not own memory)
+  '''
+  while isinstance(array.base, np.ndarray):
+    array = array.base
+
+  return array
+
+
+def layer_memory (layer, sublayers, seen=None):
+  '''
+  Bytes of the arrays currently owned by the layer (and by its internal layers)
+  split in the CATEGORIES:
+
+    weights   : parameters and rolling statistics
+    updates   : gradients of the parameters
+    optimizer : states of the optimizers (momenta, caches)
+    outputs   : outputs
+    deltas    : deltas
+    workspace : the other persistent buffers (padded inputs, im2col columns,
+                masks, normalized inputs) and the arrays stored for the backward
+
+  Each memory block is counted once (the views are not counted), also across
+  layers if the same seen set is given.
+
+  Parameters
+  ----------
+    layer : layer object
+
+    sublayers : list of layers
+      Layers which own the parameters of the given one (ref. Network._sublayers)
+
+    seen : set (default = None)
+      Identifiers of the memory blocks already counted
+
+  Returns
+  -------
+    memory : dict of bytes for each category (and the total)
+  '''
+  seen = set() if seen is None else seen
+  memory = dict.fromkeys(CATEGORIES + ('total', ), 0)
+
+  def count (category, value):
+    for array in _arrays(value):
+      base = _base(array)
+
+      if id(base) not in seen:
+        seen.add(id(base))
+        memory[category] += base.nbytes
+        memory['total'] += base.nbytes
+
+  owners = [layer] + [sublayer for sublayer in sublayers if sublayer is not layer]
+
+  for owner in owners:
+
+    attrs = owner.__dict__
+    buffers = attrs.get('_buffers', {})
+    optimizer = attrs.get('optimizer', None)
+
+    for param in PARAMETERS:
+      count('weights', attrs.get(param))
+
+    for param in PARAMETERS:
+      count('updates', attrs.get(GRADIENTS[param]))
+
+    if optimizer is not None:
+      for value in optimizer.__dict__.values():
+        count('optimizer', value)
+
+    count('outputs', attrs.get('output'))
+    count('outputs', buffers.get('output'))
+    count('deltas', attrs.get('delta'))
+    count('deltas', buffers.get('delta'))
+
+    for value in buffers.values():
+      count('workspace', value)
+
+    for value in attrs.values():
+      count('workspace', value)
+
+  return memory
+
+
+class PeakTracer (object):
+
+  def __init__ (self):
+    '''
+    Peak of the memory allocated by a sequence of steps, traced by tracemalloc
+    (the numpy arrays are traced too). The memory is measured with respect to
+    the one allocated when the tracer starts.
+    '''
+    self.peak = 0
+    self._started = False
+
+  def __enter__ (self):
+    self._started = not tracemalloc.is_tracing()
+
+    if self._started:
+      tracemalloc.start()
+
+    self._baseline = tracemalloc.get_traced_memory()[0]
+    return self
+
+  def __exit__ (self, *args):
+    if self._started:
+      tracemalloc.stop()
+
+  def step (self, func, *args, **kwargs):
+    '''
+    Call func and return (result, transient), where transient is the peak of the
+    memory allocated by func in excess of the one allocated before it
+    '''
+    if hasattr(tracemalloc, 'reset_peak'): # python >= 3.9
+      tracemalloc.reset_peak()
+      current = tracemalloc.get_traced_memory()[0]
+    else: # the peak cannot be reset: the transient is the growth of the peak
+      current = tracemalloc.get_traced_memory()[1]
+
+    result = func(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+
+    self.peak = max(self.peak, peak - self._baseline)
+
+    return (result, max(peak - current, 0))
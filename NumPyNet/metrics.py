@@ -10,6 +10,46 @@ __author__ = ['Mattia Ceccarelli', 'Nico Curti']
 __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 
+def _accuracy (y_true, y_pred):
+  return np.equal(y_true, y_pred)
+
+
+def _square_error (y_true, y_pred):
+  diff = y_true - y_pred
+  diff *= diff
+  return diff
+
+
+def _absolute_error (y_true, y_pred):
+  return np.abs(y_true - y_pred)
+
+
+def _logcosh (y_true, y_pred):
+  return np.log(np.cosh(y_true - y_pred))
+
+
+def _hellinger (y_true, y_pred):
+  diff = np.sqrt(y_true) - np.sqrt(y_pred)
+  diff *= diff
+  return diff
+
+
+def _intersection_union (y_true, y_pred, labels=None):
+  '''
+  Return the dictionary {label : (intersection, union)} of the given labels (by default the ones of y_true)
+  '''
+  counts = {}
+
+  for val in (set(y_true.ravel()) if labels is None else labels):
+
+    pred_i = y_pred == val
+    lbl_i  = y_true == val
+
+    counts[val] = (np.sum(np.logical_and(lbl_i, pred_i)), np.sum(np.logical_or(lbl_i, pred_i)))
+
+  return counts
+
+
 def mean_accuracy_score (y_true, y_pred):
   '''
   Compute average accuracy score of a classification.
@@ -27,7 +67,7 @@ def mean_accuracy_score (y_true, y_pred):
     score : float
       Average accuracy between the two inputs
   '''
-  return np.mean(np.equal(y_true, y_pred))
+  return np.mean(_accuracy(y_true, y_pred))
 
 
 def mean_square_error (y_true, y_pred):
@@ -47,9 +87,7 @@ def mean_square_error (y_true, y_pred):
     score : float
       Average square error between the two inputs
   '''
-  diff = y_true - y_pred
-  diff *= diff
-  return np.mean(diff)
+  return np.mean(_square_error(y_true, y_pred))
 
 
 def mean_absolute_error (y_true, y_pred):
@@ -69,8 +107,7 @@ def mean_absolute_error (y_true, y_pred):
     score : float
       Average absolute error between the two inputs
   '''
-  diff = np.abs(y_true - y_pred)
-  return np.mean(diff)
+  return np.mean(_absolute_error(y_true, y_pred))
 
 
 def mean_logcosh (y_true, y_pred):
@@ -90,8 +127,7 @@ def mean_logcosh (y_true, y_pred):
     score : float
       Average logcosh error between the two inputs
   '''
-  diff = np.log(np.cosh(y_true - y_pred))
-  return np.mean(diff)
+  return np.mean(_logcosh(y_true, y_pred))
 
 
 def mean_hellinger (y_true, y_pred):
@@ -111,9 +147,7 @@ def mean_hellinger (y_true, y_pred):
     score : float
       Average hellinger error between the two inputs
   '''
-  diff = np.sqrt(y_true) - np.sqrt(y_pred)
-  diff *= diff
-  return np.mean(diff)
+  return np.mean(_hellinger(y_true, y_pred))
 
 
 def mean_iou_score (y_true, y_pred):
@@ -138,20 +172,171 @@ def mean_iou_score (y_true, y_pred):
       Average IoU between the two inputs
   '''
 
-  unique_labels = set(y_true.ravel())
-  num_unique_labels = len(unique_labels)
+  I, U = zip(*_intersection_union(y_true, y_pred).values())
+
+  return np.mean(np.asarray(I, dtype=float) / np.asarray(U, dtype=float))
+
+
+class RunningMetric (object):
+
+  def __init__ (self, func):
+    '''
+    Metric accumulated over the batches (ref. Network.fit), without keeping
+    the predictions: the result is the mean of the metric of the batches
+    weighted by their number of samples. The metrics of this module are
+    accumulated exactly by the subclasses (ref. running_metric).
+
+    Parameters
+    ----------
+      func : function
+        Metric function func (y_true, y_pred)
+    '''
+    self.func = func
+    self.__name__ = getattr(func, '__name__', type(func).__name__)
+    self.reset()
+
+  def reset (self):
+    '''
+    Clear the accumulated values
+    '''
+    self.total = 0.
+    self.count = 0
 
-  I = np.empty(shape=(num_unique_labels, ), dtype=float)
-  U = np.empty(shape=(num_unique_labels, ), dtype=float)
+  def update (self, y_true, y_pred):
+    '''
+    Accumulate the metric of a batch
+    '''
+    self.total += self.func(y_true, y_pred) * len(y_true)
+    self.count += len(y_true)
 
-  for i, val in enumerate(unique_labels):
+  def result (self):
+    '''
+    Metric of the accumulated batches (nan if empty)
+    '''
+    return self.total / self.count if self.count else np.nan
 
-    pred_i = y_pred == val
-    lbl_i  = y_true == val
 
-    I[i] = np.sum(np.logical_and(lbl_i, pred_i))
-    U[i] = np.sum(np.logical_or(lbl_i, pred_i))
+class RunningMean (RunningMetric):
+
+  def __init__ (self, func, elementwise):
+    '''
+    Running mean of an elementwise metric: the result is the same of func
+    on the concatenation of the batches.
+
+    Parameters
+    ----------
+      func : function
+        Metric function (it gives the name)
+
+      elementwise : function
+        Elementwise values of the metric (y_true, y_pred)
+    '''
+    self.elementwise = elementwise
+    super(RunningMean, self).__init__(func)
+
+  def update (self, y_true, y_pred):
+    values = self.elementwise(y_true, y_pred)
+    self.total += np.sum(values)
+    self.count += np.size(values)
+
+
+class RunningIoU (RunningMetric):
+
+  def __init__ (self, func, labels=None):
+    '''
+    Running mean IoU: the intersections and unions of each label are accumulated.
+    The predictions are rounded to the nearest integer label, so the outputs
+    of the network do not add a class for each distinct value.
+
+    Parameters
+    ----------
+      func : function
+        Metric function (it gives the name)
+
+      labels : array-like (default = None)
+        Labels of the classes: only their counts are accumulated. By default
+        the labels of the truth and the rounded predictions are counted
+    '''
+    self.classes = set(labels) if labels is not None else None
+    super(RunningIoU, self).__init__(func)
+
+  def reset (self):
+    self.counts = {}
+    self.labels = set()
+
+  def update (self, y_true, y_pred):
+    y_pred = np.rint(y_pred)
+    labels = set(np.unique(y_true))
+    self.labels.update(labels)
+
+    # also the labels only predicted in this batch enlarge the unions
+    if self.classes is None:
+      labels.update(np.unique(y_pred))
+    else:
+      labels = self.classes
+
+    for val, (intersection, union) in _intersection_union(y_true, y_pred, labels).items():
+      I, U = self.counts.get(val, (0, 0))
+      self.counts[val] = (I + intersection, U + union)
+
+  def result (self):
+    labels = self.labels if self.classes is None else self.labels & self.classes
+
+    if not labels:
+      return np.nan
+
+    I, U = zip(*(self.counts[val] for val in labels))
+    return np.mean(np.asarray(I, dtype=float) / np.asarray(U, dtype=float))
+
+
+_ELEMENTWISE = {mean_accuracy_score : _accuracy,
+                mean_square_error   : _square_error,
+                mean_absolute_error : _absolute_error,
+                mean_logcosh        : _logcosh,
+                mean_hellinger      : _hellinger,
+               }
+
+
+def running_metric (func):
+  '''
+  Return the accumulator of the given metric function
+  '''
+  if func is mean_iou_score:
+    return RunningIoU(func)
+
+  if func in _ELEMENTWISE:
+    return RunningMean(func, _ELEMENTWISE[func])
+
+  return RunningMetric(func)
+
+
+class History (object):
+
+  def __init__ (self):
+    '''
+    Results of the training epochs (ref. Network.fit): the dictionary history
+    stores the list of the values of each key (loss, metrics and the ones of the
+    validation with the val_ prefix), one for each epoch.
+    '''
+    self.epoch = []
+    self.history = {}
+
+  def append (self, results):
+    '''
+    Store the results of an epoch
+    '''
+    self.epoch.append(len(self.epoch))
+
+    for key, value in results.items():
+      self.history.setdefault(key, []).append(value)
 
-  return np.mean(I / U)
+  def __getitem__ (self, key):
+    return self.history[key]
 
+  def __len__ (self):
+    return len(self.epoch)
 
+  def __str__ (self):
+    return '\n'.join('Epoch {:d}: {}'.format(epoch, ' '.join('{}: {:1.3f}'.format(key, values[epoch])
+                                                          for key, values in self.history.items()))
+                     for epoch in self.epoch)
@@ -12,7 +12,10 @@ import sys
 
 import inspect
 import platform
+import warnings
 import numpy as np
+from collections import namedtuple
+from itertools import islice
 from time import time as now
 from tqdm import tqdm
 
@@ -38,10 +41,16 @@ from NumPyNet.layers.softmax_layer import Softmax_layer
 from NumPyNet.layers.upsample_layer import Upsample_layer
 from NumPyNet.layers.yolo_layer import Yolo_layer
 
+from NumPyNet.activations import Linear
 from NumPyNet.optimizer import Optimizer
+from NumPyNet import parallel
+from NumPyNet import memory
+from NumPyNet.data import MemmapDataset
+from NumPyNet.metrics import History
+from NumPyNet.metrics import running_metric
+from NumPyNet.profiler import span
 
 from NumPyNet.parser import net_config
-from NumPyNet.exception import DataVariableError
 from NumPyNet.exception import LayerError
 from NumPyNet.exception import MetricsError
 from NumPyNet.exception import NetworkError
@@ -53,6 +62,12 @@ __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 CRLF = '\r\x1B[K' if platform.system() != 'Windows' else '\r'
 
+# Static execution plan of a model (ref. Network._build_plan):
+#   forward  : closures step(y, truth, trainable) which return the layer output
+#   backward : closures step() in reversed order, with resolved input and delta
+#   update   : bound update methods of the trainable layers
+ExecutionPlan = namedtuple('ExecutionPlan', ['forward', 'backward', 'update'])
+
 class Network(object):
 
   LAYERS = {'activation'    :  Activation_layer,
@@ -78,11 +93,39 @@ class Network(object):
             'yolo'          :  Yolo_layer,
             }
 
-  def __init__(self, batch, input_shape=None, train=None):
+  def __init__(self, batch, input_shape=None, train=None, dtype=float, subdivisions=1):
     '''
+    Network model.
+
+    Parameters
+    ----------
+      batch : int
+        Number of samples of each training step (one update of the parameters)
+
+      input_shape : tuple (default = None)
+        Shape of a single input sample as (width, height, channels)
+
+      train : bool (default = None)
+        Training flag
+
+      dtype : numpy dtype (default = float)
+        Floating point precision of the whole model. It is propagated to the
+        weights, outputs, deltas and optimizer states of every layer, so
+        float32 halves the memory traffic of each step.
+
+      subdivisions : int (default = 1)
+        Number of micro-batches of each batch (as in the darknet cfg files):
+        the layers are built for batch // subdivisions samples and the
+        gradients of the micro-batches are accumulated before the update,
+        so the peak memory does not depend on the batch size.
     '''
     self.batch = batch
+    self.subdivisions = subdivisions
     self.train = train
+    self.dtype = np.dtype(dtype).type
+
+    if batch % subdivisions:
+      raise ValueError('Network model : the batch size ({:d}) must be a multiple of the subdivisions ({:d})'.format(batch, subdivisions))
 
     if input_shape is not None:
 
@@ -93,13 +136,19 @@ class Network(object):
       except:
         raise ValueError('Network model : incorrect input_shape. Expected a 3D array (width, height, channel). Given {}'.format(input_shape))
 
-      self._net = [ Input_layer(input_shape=(self.batch, self.w, self.h, self.c)) ]
+      self._net = [ Input_layer(input_shape=(self.micro_batch, self.w, self.h, self.c)) ]
+      self._set_dtype(self._net[0])
 
     else:
       self._net = []
 
     self.metrics = None
+    self.history = None
     self._fitted = False
+    self._plan = None
+    self._threads = None
+    self._checkpoints = ()
+    self._profiler = None
 
 
   def add(self, layer):
@@ -129,8 +178,115 @@ class Network(object):
     else:
       self._net.append(layer(self._net[-1]))
 
+    self._set_dtype(self._net[-1])
+    self._set_threads(self._net[-1])
+    self._plan = None
+
+    return self
+
+  def _sublayers(self, layer):
+    '''
+    Return the list of layers which own the parameters of the given one:
+    the recurrent layers wrap a set of internal connected layers.
+    '''
+    if isinstance(layer, RNN_layer):
+      return [layer.input_layer, layer.self_layer, layer.output_layer]
+
+    if isinstance(layer, LSTM_layer):
+      return [layer.uf, layer.ui, layer.ug, layer.uo,
+              layer.wf, layer.wi, layer.wg, layer.wo]
+
+    return [layer]
+
+  def _set_dtype(self, layer):
+    '''
+    Apply the network dtype policy to the given layer: the layer (and its
+    internal layers) allocate outputs and deltas with the network dtype and
+    the already initialized parameters are converted once.
+    '''
+    layer.dtype = self.dtype
+
+    for sublayer in self._sublayers(layer):
+
+      sublayer.dtype = self.dtype
+
+      for param in parallel.PARAMETERS:
+        value = getattr(sublayer, param, None)
+
+        if isinstance(value, np.ndarray):
+          setattr(sublayer, param, value.astype(self.dtype, copy=False))
+
+    # arrays allocated by the layers before the policy is applied
+    # (e.g. the output and the state of the recurrent layers, the loss of the cost)
+    for attr in ('output', 'cell', 'state', 'loss'):
+      value = getattr(layer, attr, None)
+
+      if isinstance(value, np.ndarray):
+        setattr(layer, attr, value.astype(self.dtype, copy=False))
+
+    return layer
+
+  def set_num_threads(self, num_threads, blas_threads=None):
+    '''
+    Set the intra-op thread pool of the layers: the kernels of the pooling,
+    activation, batchnorm, upsample and shuffler layers split the batch axis
+    in chunks processed concurrently.
+
+    Parameters
+    ----------
+      num_threads : int
+        Number of threads. If 1 (or None) the pool is disabled, if -1 all the cpus are used
+
+      blas_threads : int (default = None)
+        Number of BLAS threads, by default cpu_count // num_threads so
+        the two pools do not oversubscribe the cores (ref. NumPyNet.parallel.ThreadPool)
+    '''
+    if self._threads is not None:
+      self._threads.shutdown()
+
+    if num_threads is None or num_threads == 1:
+      self._threads = None
+    else:
+      self._threads = parallel.ThreadPool(num_threads, blas_threads=blas_threads)
+
+    for layer in self:
+      self._set_threads(layer)
+
+    return self
+
+  def set_profiler(self, profiler):
+    '''
+    Set the profiler of the wall time of the forward, backward and update
+    of each layer (ref. NumPyNet.profiler.Profiler). The timed functions are
+    compiled in the execution plan, so the model without profiler has no overhead.
+
+    Parameters
+    ----------
+      profiler : Profiler object or None
+        Profiler which records the times. If None the profiling is disabled
+
+    Examples
+    --------
+
+    >>> profiler = Profiler(warmup=1, steps=10)
+    >>> model.set_profiler(profiler)
+    >>> model.fit(X, y, max_iter=1)
+    >>> profiler.summary()
+    '''
+    self._profiler = profiler
+    self._plan = None
+
     return self
 
+  def _set_threads(self, layer):
+    '''
+    Share the thread pool with the layers which split their kernels (ref. BaseLayer._map_batch)
+    '''
+    if hasattr(layer, '_map_batch'):
+      layer._pool = self._threads
+
+    return layer
+
   def __iter__(self):
     self.layer_index = 0
     return self
@@ -147,13 +303,102 @@ class Network(object):
     return self.__next__()
 
 
-  def summary(self):
+  def summary(self, X=None, y=None):
     '''
-    Print the network model summary
+    Print the network model summary, with the memory currently allocated by
+    each layer (ref. memory_usage). If a batch X (and its labels y) is given,
+    the peak memory of the inference and of the training are measured too
+    (ref. memory_profile)
     '''
-    print('layer       filters  size              input                output')
-    for i, layer in enumerate(self._net):
-      print('{:>4d} {}'.format(i, layer), end='\n') # flush=True
+    profile = self.memory_profile(X, y) if X is not None else None
+    usage = self.memory_usage()
+    layers = ['{:>4d} {}'.format(i, layer) for i, layer in enumerate(self._net)]
+    width = max(map(len, layers))
+
+    columns = ''.join('{:>11s}'.format(category) for category in memory.CATEGORIES)
+    print('layer       filters  size              input                output'.ljust(width) + columns)
+    for line, layer_usage in zip(layers, usage):
+      print(line.ljust(width) + ''.join('{:>11s}'.format(memory.format_bytes(layer_usage[category]))
+                                        for category in memory.CATEGORIES), end='\n') # flush=True
+
+    total = sum(layer_usage['total'] for layer_usage in usage)
+    print('Total memory: {}'.format(memory.format_bytes(total)))
+
+    if profile is not None:
+      print('Peak memory: inference {} (+{} transient), training {} (+{} transient)'.format(
+            memory.format_bytes(profile['resident'] + profile['forward']), memory.format_bytes(profile['forward']),
+            memory.format_bytes(profile['resident'] + profile['train']), memory.format_bytes(profile['train'])))
+
+  def memory_usage(self):
+    '''
+    Return the memory currently allocated by each layer (with its internal layers)
+    as a list of dictionaries of bytes, one for each layer, with the keys
+    weights, updates, optimizer, outputs, deltas, workspace and total
+    (ref. NumPyNet.memory.layer_memory). The persistent buffers are allocated
+    by the first forward/backward, so the usage of a trained model is the resident
+    memory of the training.
+    '''
+    seen = set()
+    return [memory.layer_memory(layer, self._sublayers(layer), seen=seen) for layer in self]
+
+  def memory_profile(self, X, y=None):
+    '''
+    Measure with tracemalloc the memory allocated by an inference forward and by
+    a training step (forward and backward, without the update of the parameters)
+    on the batch X, in excess of the resident one.
+
+    Parameters
+    ----------
+      X : array
+        Batch of input samples (with the micro-batch size)
+
+      y : array (default = None)
+        Labels of the samples, required by the cost layers in training
+
+    Returns
+    -------
+      profile : dict with the keys
+        resident : bytes allocated by the layers before the measure
+        forward  : peak of the bytes allocated by the inference forward
+        train    : peak of the bytes allocated by the training forward and backward
+        layers   : list of dictionaries with the peak of the bytes allocated by the
+                   forward, training forward and backward of each layer
+    '''
+    plan = self._plan or self._build_plan()
+    resident = sum(layer_usage['total'] for layer_usage in self.memory_usage())
+    layers = [dict.fromkeys(('forward', 'train_forward', 'backward'), 0) for _ in self]
+
+    # the measure does not change the state of the model
+    statistics = self._statistics(self._net)
+    state = np.random.get_state()
+
+    X = X.astype(self.dtype, copy=False)
+    y = y.astype(self.dtype, copy=False) if y is not None else None
+
+    try:
+
+      with memory.PeakTracer() as tracer:
+        out = X
+        for i, step in enumerate(plan.forward):
+          out, layers[i]['forward'] = tracer.step(step, out, y, False)
+
+      forward = tracer.peak
+
+      with memory.PeakTracer() as tracer:
+        out = X
+        for i, step in enumerate(plan.forward):
+          out, layers[i]['train_forward'] = tracer.step(step, out, y, True)
+
+        for i, step in zip(reversed(range(self.num_layers)), plan.backward):
+          _, layers[i]['backward'] = tracer.step(step)
+
+      train = tracer.peak
+
+    finally:
+      np.random.set_state(state)
+      self._restore_statistics(statistics)
+
+    return {'resident' : resident, 'forward' : forward, 'train' : train, 'layers' : layers}
 
 
   def load(self, cfg_filename, weights=None):
@@ -164,13 +409,16 @@ class Network(object):
     model = net_config(cfg_filename)
 
     self.batch = model.get('net0', 'batch', 1)
+    self.subdivisions = model.get('net0', 'subdivisions', 1)
     self.w = model.get('net0', 'width', 416)
     self.h = model.get('net0', 'height', 416)
     self.c = model.get('net0', 'channels', 3)
     # TODO: add other network parameters
 
-    input_shape = (self.batch, self.w, self.h, self.c)
+    input_shape = (self.micro_batch, self.w, self.h, self.c)
     self._net = [ Input_layer(input_shape=input_shape) ]
+    self._checkpoints = ()
+    self._set_dtype(self._net[0])
 
     print('layer     filters    size              input                output')
 
@@ -181,6 +429,7 @@ class Network(object):
       if layer_t == 'shortcut':
         _from = model.get(layer, 'from', 0)
         self._net.append( self.LAYERS[layer_t](input_shape=input_shape, **params)([self._net[-1], self._net[_from]]) )
+        self._net[-1].index = _from % (len(self._net) - 1) # absolute index of the second input layer
 
       elif layer_t == 'route':
         _layers = model.get(layer, 'layers', [])
@@ -189,6 +438,8 @@ class Network(object):
       else:
         self._net.append( self.LAYERS[layer_t](input_shape=input_shape, **params)(self._net[-1]) )
 
+      self._set_dtype(self._net[-1])
+      self._set_threads(self._net[-1])
       input_shape = self._net[-1].out_shape
 
       print('{:>4d} {}'.format(i, self._net[-1]), end='\n') # flush=True
@@ -198,6 +449,8 @@ class Network(object):
       #   self._net.append( BatchNorm_layer()(self._net[-1]) )
       #   print('{:>4d} {}'.format(i, self._net[-1]), flush=True, end='\n')
 
+    self._plan = None
+
     if weights is not None:
       self.load_weights(weights)
 
@@ -205,12 +458,16 @@ class Network(object):
 
   def load_weights(self, weights_filename):
     '''
-    Load weight from filename in binary fmt
+    Load weight from filename in binary fmt.
+    The weights are stored in double precision and they are converted once
+    to the network dtype, so every layer takes a view of the same buffer.
     '''
     with open(weights_filename, 'rb') as fp:
 
-      major, minor, revision = np.fromfile(fp, dtype=np.int, count=3)
-      full_weights = np.fromfile(fp, dtype=np.float, count=-1)
+      major, minor, revision = np.fromfile(fp, dtype=int, count=3)
+      full_weights = np.fromfile(fp, dtype=float, count=-1)
+
+    full_weights = full_weights.astype(self.dtype, copy=False)
 
     pos = 0
     for layer in self:
@@ -231,8 +488,8 @@ class Network(object):
       if hasattr(layer, 'save_weights'):
         full_weights += layer.save_weights()
 
-    full_weights = np.asarray(full_weights, dtype=np.float)
-    version = np.array([1, 0, 0], dtype=np.int)
+    full_weights = np.asarray(full_weights, dtype=float)
+    version = np.array([1, 0, 0], dtype=int)
 
     with open(filename, 'wb') as fp:
       version.tofile(fp, sep='')
@@ -249,8 +506,15 @@ class Network(object):
 
     self.__dict__.clear()
     self.__dict__.update(tmp_dict)
+    self.__dict__.setdefault('dtype', float) # models dumped before the dtype policy
+    self.__dict__.setdefault('subdivisions', 1)
+    self.__dict__.setdefault('history', None)
 
     self._fitted = True
+    self._plan = None
+    self._threads = None
+    self._profiler = None
+    self.__dict__.setdefault('_checkpoints', ())
 
     return self
 
@@ -259,17 +523,37 @@ class Network(object):
     '''
     Dump the current network model as pickle
     '''
+    # the execution plan is made by closures, the thread pool and the profiler are not dumped
+    model = {k : v for k, v in self.__dict__.items() if k not in ('_plan', '_threads', '_profiler')}
+
     with open(model_filename, 'wb') as fp:
-      pickle.dump(self.__dict__, fp, 2)
+      pickle.dump(model, fp, 2)
 
     return self
 
-  def compile(self, optimizer=Optimizer, metrics=None):
+  def compile(self, optimizer=Optimizer, metrics=None, dtype=None):
     '''
+    Set the optimizer (and the metrics) of the model.
+
+    Parameters
+    ----------
+      optimizer : Optimizer object
+        Optimizer copied into each trainable layer
+
+      metrics : list of functions (default = None)
+        Metrics evaluated during the training
+
+      dtype : numpy dtype (default = None)
+        If given, it overrides the dtype policy of the model (ref. __init__)
     '''
 
+    if dtype is not None:
+      self.dtype = np.dtype(dtype).type
+
     for layer in self:
 
+      self._set_dtype(layer)
+
       if hasattr(layer, 'optimizer'):
         layer.optimizer = copy(optimizer)
 
@@ -291,6 +575,224 @@ class Network(object):
     if metrics is not None:
       self._check_metrics(metrics)
 
+    self._build_plan()
+
+  def _build_plan(self):
+    '''
+    Compile the static execution plan of the model.
+    The signatures of the layer functions are inspected only here: the plan
+    stores the closures with the resolved arguments (previous layer, route and
+    shortcut sources, truth, network) replayed by _forward, _backward and _update.
+    The plan is invalidated when the list of layers changes.
+    '''
+    forward  = [self._forward_step(layer) for layer in self]
+    backward = [self._backward_step(i) for i in reversed(range(1, self.num_layers))]
+    updated  = [i for i, layer in enumerate(self._net) if i > 0 and hasattr(layer, 'update')]
+    update   = [self._net[i].update for i in updated]
+
+    if self.num_layers > 1:
+      first = self._net[0]
+      backward.append(lambda : first.backward(delta=first.delta))
+
+    for start, stop in self._checkpoints:
+      self._checkpoint(forward, backward, start, stop)
+
+    if self._profiler is not None:
+      # the recomputation of a checkpoint segment is timed as the backward of its last layer
+      profiler = self._profiler
+      forward  = [profiler.wrap('forward', i, self._net[i], step) for i, step in enumerate(forward)]
+      backward = [profiler.wrap('backward', self.num_layers - 1 - k, self._net[self.num_layers - 1 - k], step)
+                  for k, step in enumerate(backward)]
+      update   = [profiler.wrap('update', i, self._net[i], step) for i, step in zip(updated, update)]
+
+    self._plan = ExecutionPlan(forward=tuple(forward), backward=tuple(backward), update=tuple(update))
+
+    return self._plan
+
+  def _sources(self):
+    '''
+    Return the dictionary {layer index : indexes of the route/shortcut layers which use its output}
+    '''
+    sources = {}
+
+    for i, layer in enumerate(self._net):
+      for source in getattr(layer, 'input_layers', ()):
+        sources.setdefault(source, set()).add(i)
+
+      if isinstance(layer, Shortcut_layer):
+        sources.setdefault(layer.index, set()).add(i)
+
+    return sources
+
+  def set_checkpoints(self, segments):
+    '''
+    Set the activation checkpointing segments of the training: the layers of a
+    segment release their outputs, deltas and backward arrays at the end of its
+    forward (except the output of the last one, which is the input of the next
+    layer), and the segment forward is recomputed by the backward, from the
+    output of the layer before the segment. The peak memory of the training
+    scales with the largest segment, at the cost of a second forward.
+    The random state (dropout masks) is replayed by the recomputation and the
+    rolling statistics (batchnorm) are not updated twice.
+    The released layers drop also their persistent buffers (ref. BaseLayer._buffer), so
+    the layers of the segments allocate them again at each training step.
+    The recurrent layers (LSTM and RNN) keep their internal layers and states:
+    they can be only the last layer of a segment.
+
+    Parameters
+    ----------
+      segments : list of (start, stop) layer indexes, or int
+        Segments of layers [start, stop). An integer is the length of the
+        consecutive segments which cover the model. An empty list disables the checkpointing
+    '''
+    if isinstance(segments, int):
+      segments = [(i, min(i + segments, self.num_layers)) for i in range(1, self.num_layers, segments)]
+
+    segments = sorted(tuple(segment) for segment in segments)
+    sources = self._sources()
+    end = 1
+
+    for start, stop in segments:
+
+      if start < end or stop <= start or stop > self.num_layers:
+        raise NetworkError('Network model : invalid checkpoint segment ({:d}, {:d}). The segments must be ordered, disjoint and without the input layer'.format(start, stop))
+
+      for i in range(start, stop - 1):
+
+        if isinstance(self._net[i], (LSTM_layer, RNN_layer)):
+          raise NetworkError('Network model : the recurrent {} layer cannot be released inside a checkpoint segment'.format(self._net[i].__class__.__name__))
+
+        if any(not start <= j < stop for j in sources.get(i, ())):
+          raise NetworkError('Network model : the output of the layer {:d} is used outside of the checkpoint segment ({:d}, {:d})'.format(i, start, stop))
+
+      end = stop
+
+    self._checkpoints = tuple(segments)
+    self._plan = None
+
+    return self
+
+  def _checkpoint(self, forward, backward, start, stop):
+    '''
+    Wrap (in place) the plan steps of the checkpoint segment [start, stop):
+    the first forward step stores the random state and the truth, the last one
+    releases the arrays of the segment and the backward step of the last layer
+    recomputes the segment forward before it.
+    '''
+    layers = self._net[start : stop]
+    source = self._net[start - 1]
+    steps = forward[start : stop]
+    first, last = (forward[start], forward[stop - 1])
+    last_backward = backward[self.num_layers - stop]
+    record = {}
+
+    def begin(y, truth, trainable):
+      if trainable:
+        record.update(state=np.random.get_state(), truth=truth)
+      return first(y, truth, trainable)
+
+    forward[start] = begin
+    last = forward[stop - 1] if start == stop - 1 else last
+
+    def release(y, truth, trainable):
+      y = last(y, truth, trainable)
+
+      if trainable:
+        for layer in layers[:-1]:
+          layer._release_cache()
+          layer.output = None
+          layer.__dict__.pop('_buffers', None)
+
+        for attr in getattr(layers[-1], '_backward_cache', ()):
+          setattr(layers[-1], attr, None)
+
+      return y
+
+    forward[stop - 1] = release
+
+    def recompute():
+      delta = layers[-1].delta.copy() # already filled by the next layers
+      statistics = self._statistics(layers)
+      state = np.random.get_state()
+
+      np.random.set_state(record['state'])
+      y = source.output
+      for step in steps:
+        y = step(y, record['truth'], True)
+
+      np.random.set_state(state)
+      layers[-1].delta[...] = delta
+      self._restore_statistics(statistics)
+
+      last_backward()
+
+    backward[self.num_layers - stop] = recompute
+
+  def _statistics(self, layers):
+    '''
+    Return a copy of the rolling statistics of the given layers, updated by the training forward
+    '''
+    return [(sublayer, attr, getattr(sublayer, attr).copy()) for layer in layers for sublayer in self._sublayers(layer)
+            for attr in parallel.STATISTICS if getattr(sublayer, attr, None) is not None]
+
+  def _restore_statistics(self, statistics):
+    '''
+    Restore the rolling statistics copied by _statistics
+    '''
+    for sublayer, attr, value in statistics:
+      setattr(sublayer, attr, value)
+
+  def _forward_step(self, layer):
+    '''
+    Return the forward closure step(y, truth, trainable) of the given layer
+    '''
+    forward = layer.forward
+    args = forward.__code__.co_varnames
+
+    # keyword arguments of the inference and of the training modes
+    modes = ({'trainable' : False}, {'trainable' : True}) if 'trainable' in args else ({}, {})
+
+    if 'network' in args:
+      call = lambda y, truth, mode : forward(network=self, **mode)
+
+    elif 'prev_output' in args:
+      source = self._net[layer.index]
+      call = lambda y, truth, mode : forward(inpt=y, prev_output=source.output, **mode)
+
+    elif 'truth' in args:
+      call = lambda y, truth, mode : forward(inpt=y, truth=truth, **mode) if truth is not None else forward(inpt=y, **mode)
+
+    else:
+      call = lambda y, truth, mode : forward(inpt=y, **mode)
+
+    def step(y, truth, trainable):
+      call(y, truth, modes[trainable])
+      return layer.output
+
+    return step
+
+  def _backward_step(self, i):
+    '''
+    Return the backward closure step() of the i-th layer
+    '''
+    layer = self._net[i]
+    prev  = self._net[i - 1]
+    backward = layer.backward
+    args = backward.__code__.co_varnames
+
+    if 'inpt' in args:
+      return lambda : backward(inpt=prev.output, delta=prev.delta)
+
+    elif 'network' in args:
+      return lambda : backward(delta=prev.delta, network=self)
+
+    elif 'prev_delta' in args:
+      source = self._net[layer.index]
+      return lambda : backward(delta=prev.delta, prev_delta=source.delta)
+
+    else:
+      return lambda : backward(delta=prev.delta)
+
 
   def _check_metrics(self, metrics):
     '''
@@ -322,134 +824,420 @@ class Network(object):
 
   def _evaluate_metrics(self, y_true, y_pred):
     '''
+    Return the dictionary {name : score} of the metrics of the model on the given predictions
     '''
 
     results = {func.__name__ : func(y_true, y_pred) for func in self.metrics}
     #print(' '.join(' {}: {:1.3f}'.format(k, v) for k, v in results.items()))
 
+    return results
 
-  def fit(self, X, y, max_iter=100, shuffle=True, verbose=True):
+  def _validate(self, validation_data, samples=None):
     '''
+    Inference on the validation samples (X, y) or dataset (or on a random subset of them)
+    and return the dictionary of the loss (mean over the batches) and of the metrics
     '''
+    if isinstance(validation_data, MemmapDataset):
+      X, y = (validation_data.data, validation_data.labels)
+    else:
+      X, y = validation_data
+
+    if samples is not None and samples < len(X):
+      idx = np.sort(np.random.choice(len(X), size=samples, replace=False))
+      X, y = (X[idx, ...], y[idx, ...])
+
+    y_pred = None
+    loss = None
+
+    for i, (output, loss) in enumerate(self.predict_iter(X, truth=y)):
+      # the outputs are allocated once from the shape of the first batch
+      if y_pred is None:
+        y_pred = np.empty(shape=(len(X), ) + output.shape[1:], dtype=output.dtype)
+
+      y_pred[i * self.micro_batch : i * self.micro_batch + len(output)] = output
+
+    results = {'loss' : loss / (i + 1)} if loss is not None else {}
+    results.update(self._evaluate_metrics(y, y_pred) if self.metrics is not None else {})
+
+    return results
+
+
+  def fit(self, X, y=None, max_iter=100, shuffle=True, verbose=True, n_jobs=1, validation_data=None, validation_samples=None):
+    '''
+    Train the model on the given samples
+
+    Parameters
+    ----------
+      X : array-like or MemmapDataset
+        Input samples, or the dataset of samples and labels read from disk
+        (ref. NumPyNet.data.MemmapDataset)
+
+      y : array-like (default = None)
+        Labels of the samples (not used with a dataset)
+
+      max_iter : int (default = 100)
+        Number of epochs
+
+      shuffle : bool or str (default = True)
+        If True, shuffle the order of the batches at each epoch: the batches are
+        contiguous blocks of samples, read as views (suitable for memmap arrays).
+        If 'epoch', permute the samples at each epoch in a contiguous buffer
+        allocated once (a copy of the dataset), so the batches change at each
+        epoch and they are still read as views. If False, the order is kept.
+        With a dataset, True and 'epoch' shuffle the blocks of samples read
+        from disk (ref. MemmapDataset.batches).
+
+      verbose : bool (default = True)
+        Enable the progress bar
+
+      n_jobs : int (default = 1)
+        Number of processes of the data-parallel training: each step averages
+        the gradients of n_jobs batches (ref. NumPyNet.parallel.DataParallel).
+        The shared memory requires python >= 3.8: with older versions the
+        batches are trained serially
+
+      validation_data : tuple of arrays or MemmapDataset (default = None)
+        Samples and labels (X, y) evaluated at the end of each epoch
+
+      validation_samples : int (default = None)
+        Number of validation samples randomly drawn at each epoch, by default all
+
+    Returns
+    -------
+      history : History object
+        Results of each epoch: the mean loss of the batches and the metrics,
+        accumulated on the outputs of the training batches (so they are given by
+        the parameters before each update), and the ones of the validation (with
+        the val_ prefix). With n_jobs > 1 the metrics are accumulated on the
+        batches of the main process only.
+    '''
+
+    if shuffle not in (True, False, 'epoch'):
+      raise ValueError('Network model : shuffle must be True, False or "epoch". Given {}'.format(shuffle))
+
+    dataset = isinstance(X, MemmapDataset)
+
+    if dataset and X.labels is None:
+      raise ValueError('Network model : the dataset has no labels')
+
+    if not dataset and y is None:
+      raise ValueError('Network model : the labels are required')
 
     num_data = len(X)
     self._fitted = True
 
-    batches = np.array_split(range(num_data), indices_or_sections=num_data // self.batch)
-    lengths=[len(b) for b in batches]
-    if not all([L==self.batch for L in lengths]):
-        print("unequal batch sizes...adjusting.")
-        
-        for i,b in enumerate(batches):
-            np.random.shuffle(b)
-            batches[i]=sorted(b[:self.batch])
+    # the last batch can be partial: it is padded by the train step (ref. _train_step)
+    batches = self._batches(num_data, self.batch)
+    data, labels = (X, y)
+
+    if shuffle == 'epoch' and not dataset:
+      data = np.empty(shape=np.shape(X), dtype=self.dtype)
+      labels = np.empty(shape=np.shape(y), dtype=self.dtype)
+
+    if n_jobs != 1 and parallel.shared_memory is None:
+      warnings.warn('The data-parallel training requires python >= 3.8: the batches are trained serially')
+      n_jobs = 1
 
-    for _ in tqdm(range(max_iter),disable=not verbose):
+    trainer = parallel.DataParallel(self, n_jobs=n_jobs) if n_jobs != 1 else None
 
-      loss = 0.
-      seen = 0
+    history = History()
+    running = [running_metric(func) for func in self.metrics] if self.metrics is not None else []
 
-      if shuffle:
-        np.random.shuffle(batches)
+    try:
+
+      progress = tqdm(range(max_iter), disable=not verbose)
+
+      for _ in progress:
+
+        loss = 0.
+        seen = 0
+
+        for metric in running:
+          metric.reset()
+
+        if dataset:
+          # the batches of a group are kept together: they can not share the dataset buffers
+          pairs = X.batches(self.batch, shuffle=bool(shuffle), copy=trainer is not None)
+
+        else:
+
+          if shuffle == 'epoch':
+            order = np.random.permutation(num_data)
+            np.take(X, order, axis=0, out=data)
+            np.take(y, order, axis=0, out=labels)
+
+          elif shuffle:
+            np.random.shuffle(batches)
 
-      for i, idx in enumerate(batches):
+          pairs = ((data[idx, ...], labels[idx, ...]) for idx in batches)
 
-        _input = X[idx, ...]
-        _truth = y[idx, ...]
+        if trainer is not None:
 
-        assert(len(_input)==self.batch)
+          # each step processes a group of n_jobs batches
+          for group in iter(lambda : list(islice(pairs, trainer.n_jobs)), []):
 
-        junk = self._forward(X=_input, truth=_truth, trainable=True)
-        self._backward(X=_input, trainable=True)
+            _inputs, _truths = zip(*group)
+            loss += trainer.step(list(_inputs), list(_truths), metrics=running)
+            seen += sum(map(len, _inputs))
 
-        loss += self._get_loss()
-        seen += len(idx)
+        else:
 
+          for _input, _truth in pairs:
 
-      if self.metrics is not None:
+            loss += self._train_step(_input, _truth, metrics=running)
+            seen += len(_input)
 
-        y_pred = self.predict(X, truth=None, verbose=False)
-        self._evaluate_metrics(y, y_pred)
+        results = {'loss' : loss / len(batches)}
+        results.update({metric.__name__ : metric.result() for metric in running})
 
+        if validation_data is not None:
+          validation = self._validate(validation_data, samples=validation_samples)
+          results.update({'val_' + key : value for key, value in validation.items()})
 
+        history.append(results)
+        progress.set_postfix(results)
 
-  def fit_generator(self, Xy_generator, max_iter=100):
+    finally:
+
+      if trainer is not None:
+        trainer.close()
+
+    self.history = history
+
+    return history
+
+
+  def fit_generator(self, Xy_generator, max_iter=100, verbose=True):
     '''
-    Fit function using a train generator (ref. DataGenerator in data.py)
+    Fit function using a train generator (ref. DataGenerator in data.py).
+    The generator loads the next batches in its thread while the model is
+    trained on the current one: the training waits only if no batch is ready.
+
+    Parameters
+    ----------
+      Xy_generator : DataGenerator object
+        Generator of the batches of samples and labels
+
+      max_iter : int (default = 100)
+        Number of batches
+
+      verbose : bool (default = True)
+        Enable the progress bar
+
+    Returns
+    -------
+      history : History object
+        The loss of each batch and the stall, i.e. the seconds waited for the batch.
+        The training stops early if the generator is stopped.
+        A generator batch of a different size is split in batches of the network
+        (the loss is their mean), as in fit.
     '''
 
+    if not Xy_generator.labeled:
+      raise ValueError('Network model : the generator has no labels')
+
+    history = History()
     Xy_generator.start()
 
-    for _ in range(max_iter):
+    try:
+
+      for _ in tqdm(range(max_iter), disable=not verbose):
 
-      grabbed = False
+        tic = now()
 
-      while not grabbed:
+        with span('load_data', 'data'):
+          data, label, grabbed = Xy_generator.load_data()
 
-        data, label, grabbed = Xy_generator.load_data()
+        stall = now() - tic
 
+        if not grabbed:
+          break
 
-      self.fit(data, label, max_iter=1, shuffle=False) # data already shuffled
+        # data already shuffled: the generator batch is split in network batches
+        # (the last one can be partial and it is padded, ref. _train_step)
+        data, label = (np.asarray(data), np.asarray(label))
+        batches = self._batches(len(data), self.batch)
+        loss = sum(self._train_step(data[idx], label[idx]) for idx in batches)
 
-    Xy_generator.stop()
+        history.append({'loss' : loss / len(batches), 'stall' : stall})
+
+    finally:
+      Xy_generator.stop()
 
     self._fitted = True
+    self.history = history
+
+    return history
 
 
-  def predict(self, X, truth=None, verbose=True):
+  def predict(self, X, truth=None, verbose=True, n_jobs=1):
     '''
     Predict the given input
+
+    Parameters
+    ----------
+      X : array-like or MemmapDataset
+        Input samples, or the dataset read from disk (ref. NumPyNet.data.MemmapDataset)
+
+      truth : array-like (default = None)
+        Labels of the samples
+
+      verbose : bool (default = True)
+        Enable the print of the progress
+
+      n_jobs : int (default = 1)
+        Number of worker processes: if greater than 1 (or -1 for all the cpus)
+        the batches are split across the workers, which map the weights
+        read-only through shared memory (ref. NumPyNet.parallel).
+        The shared memory requires python >= 3.8: with older versions the
+        batches are predicted serially
     '''
     if not self._fitted:
       raise NetworkError('This Network model instance is not fitted yet. Please use the "fit" function before the predict')
 
     num_data = len(X)
-    _truth = None
 
+    # the layers are built for the micro-batches
+    batches = self._batches(num_data, self.micro_batch)
 
-    batches = np.array_split(range(num_data), indices_or_sections=num_data // self.batch)
-    
-    begin = now()
-    start = begin
+    if n_jobs != 1 and parallel.shared_memory is None:
+      warnings.warn('The multi-process predict requires python >= 3.8: the batches are predicted serially')
+      n_jobs = 1
+
+    if n_jobs != 1:
+      output, _ = parallel.predict(self, X.data if isinstance(X, MemmapDataset) else X, batches, truth=truth, n_jobs=n_jobs)
+      return output
+
+    if isinstance(X, MemmapDataset):
+      # the dataset reads ahead the next batch (ref. MemmapDataset.batches)
+      truths = self._micro_batches(truth) if truth is not None else None
+      predictions = self._predict_batches(self._micro_batches(X), None, truths)
+    else:
+      predictions = self._predict_batches(X, batches, truth)
 
-    loss = 0.
     seen = 0
 
-    output = []
+    output = None
 
     with _redirect_stdout(verbose):
-      for i, idx in enumerate(batches):
+      for predict, loss in predictions:
+
+        # the output is allocated once, instead of concatenating the batches
+        if output is None:
+          output = np.empty(shape=(num_data, ) + predict.shape[1:], dtype=predict.dtype)
+
+        output[seen : seen + len(predict)] = predict # the layers reuse their output buffers
+        seen += len(predict)
+
+    return output
+
+  def predict_iter(self, X, truth=None, out=None):
+    '''
+    Streaming predict: generator of the outputs of the batches, so the outputs
+    of large datasets are not collected in memory.
+
+    Parameters
+    ----------
+      X : array-like, MemmapDataset or iterable
+        Input samples. An array (or a memmap or a dataset) is read one micro-batch at a time,
+        an iterable (e.g. a generator which loads the data lazily) yields arrays
+        of samples of any length, regrouped in micro-batches
+
+      truth : array-like or iterable (default = None)
+        Labels of the samples, given as X
+
+      out : array-like (default = None)
+        Preallocated (or memory-mapped) array of the outputs of all the samples:
+        the outputs of each batch are written in place
+
+    Yields
+    ------
+      output : array
+        Outputs of the batch (the view of out, if it is given)
+
+      loss : float
+        Loss accumulated over the batches processed up to now (None if the
+        model has not a cost layer)
+
+    Examples
+    --------
+
+    >>> out = np.lib.format.open_memmap('output.npy', mode='w+', dtype=float, shape=(num_data, 1, 1, 10))
+    >>> for output, loss in model.predict_iter(data_generator(), out=out):
+    >>>   pass
+    >>> out.flush()
+    '''
+    if not self._fitted:
+      raise NetworkError('This Network model instance is not fitted yet. Please use the "fit" function before the predict')
+
+    inputs = self._micro_batches(X)
+    truths = self._micro_batches(truth) if truth is not None else None
+    seen = 0
+
+    for predict, loss in self._predict_batches(inputs, None, truths):
+
+      if out is not None:
+        output = out[seen : seen + len(predict)]
+        output[...] = predict
+
+      else:
+        output = predict.copy() # the layers reuse their output buffers
+
+      seen += len(predict)
+
+      yield (output, loss)
+
+  def _micro_batches(self, X):
+    '''
+    Generator of the micro-batches of the samples given as array, dataset or iterable of arrays
+    '''
+    if isinstance(X, MemmapDataset):
+      for data, _ in X.batches(self.micro_batch, shuffle=False):
+        yield data
+      return
+
+    if hasattr(X, 'shape'):
+      for i in range(0, len(X), self.micro_batch):
+        yield X[i : i + self.micro_batch]
+      return
+
+    pending = None
+
+    for chunk in X:
+      chunk = np.asarray(chunk)
+      pending = chunk if pending is None or not len(pending) else np.concatenate((pending, chunk))
+
+      while len(pending) >= self.micro_batch:
+        yield pending[:self.micro_batch]
+        pending = pending[self.micro_batch:]
 
-        _input = X[idx, ...]
-        if truth is not None:
-          _truth = truth[idx, ...]
+    if pending is not None and len(pending):
+      yield pending
 
-        predict = self._forward(X=_input, truth=_truth, trainable=False)
-        output.append(predict)
+  def _predict_batches(self, X, batches=None, truth=None):
+    '''
+    Generator of the inference outputs (the layer buffers) and of the accumulated loss
+    of the batches of samples. If batches is None, X and truth are iterables
+    of batches, otherwise arrays indexed by the batches indexes.
+    '''
+    inputs = (X[idx, ...] for idx in batches) if batches is not None else iter(X)
 
-        loss += self._get_loss()
-        seen += len(idx)
+    if truth is None:
+      truths = iter(lambda : None, 0) # endless None
+    else:
+      truths = (truth[idx, ...] for idx in batches) if batches is not None else iter(truth)
 
-        done = int(50 * (i + 1) / len(batches))
-        # print('{}{:>3d}/{:<3d} |{}{}| ({:1.1f} sec/iter) loss: {:3.3f}'.format( CRLF, 
-        #                                                                         seen,
-        #                                                                         num_data,
-        #                                                                        r'█' * done,
-        #                                                                         '-' * (50 - done),
-        #                                                                         now() - start,
-        #                                                                         loss / seen
-        #                                                                       ), end='') # flush=True,
-        # sys.stdout.flush() # compatibility with pythonn 2.7
-        start = now()
+    loss = None
 
-      # print('\n', end='') #flush=True)
-      # sys.stdout.flush() # compatibility with pythonn 2.7
+    for _input, _truth in zip(inputs, truths):
 
+      with span('predict_step', 'network'):
+        predict, cost = self._predict_step(_input, _truth)
 
-      end = now()
-      # print('Prediction on {:d} samples took {:1.1f} sec'.format(num_data, end - begin))
+      if cost is not None:
+        loss = cost if loss is None else loss + cost
 
-    return np.concatenate(output)
+      yield (predict, loss)
 
   def evaluate(self, X, truth, verbose=False):
     '''
@@ -460,58 +1248,244 @@ class Network(object):
 
     return (loss, output)
 
+  def optimize_for_inference(self):
+    '''
+    Graph optimization of a trained model for the deployment: every BatchNorm
+    layer which follows a Convolutional or a Connected layer with Linear
+    activation is folded into the weights and bias of the previous layer,
+    using its rolling statistics, and it is removed from the model.
+
+    Only the BatchNorm layers built with rolling=True are folded: the other
+    ones normalize with the statistics of the inference batch, which can not
+    be fixed in the weights. The BatchNorm layer keeps its statistics for each
+    pixel, while a convolution shares its weights among the pixels: so only
+    the layers with 1 x 1 outputs (connected layers and convolutions reducing
+    the image to a single pixel) can be folded, the spatial convolutions keep
+    their BatchNorm. The layers whose output is used by a route/shortcut are
+    kept too. The optimized model must not be trained anymore.
+    '''
+    if not self._fitted:
+      raise NetworkError('This Network model instance is not fitted yet. Please use the "fit" function before the optimization')
+
+    sources = self._sources()
+
+    removed = [i for i in range(2, self.num_layers)
+               if isinstance(self._net[i], BatchNorm_layer)
+               and i - 1 not in sources
+               and self._fold_batchnorm(self._net[i - 1], self._net[i])]
+
+    # the outputs of the removed layers are now given by the previous ones
+    index = lambda i : i - sum(r <= i for r in removed)
+
+    for layer in self:
+      if isinstance(layer, Route_layer):
+        layer.input_layers = tuple(map(index, layer.input_layers))
+      elif isinstance(layer, Shortcut_layer):
+        layer.index = index(layer.index)
+
+    self._net = [layer for i, layer in enumerate(self._net) if i not in removed]
+    self._checkpoints = ()
+    self._plan = None
+
+    return self
+
+  def _fold_batchnorm(self, layer, batchnorm):
+    '''
+    Fold the batchnorm parameters into the weights and bias of the given layer.
+    Return True if the folding is possible (ref. optimize_for_inference)
+    '''
+    if not isinstance(layer, (Convolutional_layer, Connected_layer)) or layer.activation is not Linear.activate:
+      return False
+
+    # statistics of the inference batch or for each pixel of an image
+    if not batchnorm.rolling or np.prod(batchnorm.out_shape[1:-1]) != 1:
+      return False
+
+    if batchnorm.rolling_mean is None:
+      raise LayerError('BatchNorm layer without rolling statistics: the model must be trained before the folding')
+
+    # batchnorm(x) = x * scale + shift
+    scale = batchnorm.scales / np.sqrt(batchnorm.rolling_var + batchnorm.epsil)
+    shift = batchnorm.bias - batchnorm.rolling_mean * scale
+
+    # factors along the output channels, shape (outputs, )
+    scale_c = scale.reshape(-1)
+    shift_c = shift.reshape(-1)
+
+    layer.weights = (layer.weights * scale_c).astype(self.dtype)
+    layer.bias = (layer.bias * scale_c + shift_c).astype(self.dtype)
+
+    return True
+
 
   def _forward(self, X, truth=None, trainable=True):
     '''
     Forward function.
-    Apply the forward method on all layers
+    Apply the forward method on all layers.
+    With trainable=False the layers run in inference mode: they do not allocate
+    the deltas and they release the arrays stored only for the backward.
     '''
-    # TODO: add trainable to forward and backward of each layer signature
 
-    y = X[:]
+    if trainable and len(X) != self.micro_batch:
+      raise NetworkError('Network model : the training batch has {:d} samples, while the layers buffers are built for batch={:d}'.format(len(X), self.micro_batch))
 
-    for layer in self:
+    # the only conversion of the step: layers work in the network dtype
+    y = X.astype(self.dtype, copy=False)
 
-      forward_args = layer.forward.__code__.co_varnames
+    if truth is not None:
+      truth = truth.astype(self.dtype, copy=False)
 
-      if 'truth' in forward_args and truth is not None:
-        layer.forward(inpt=y[:], truth=truth)
+    plan = self._plan or self._build_plan()
 
-      elif 'network' in forward_args:
-        layer.forward(network=self)
+    for step in plan.forward:
+      y = step(y, truth, trainable)
 
-      else :
-        layer.forward(inpt=y[:])
+    return y
 
-      y = layer.output[:]
+  def _predict_step(self, X, truth=None):
+    '''
+    Inference forward of a batch. A batch smaller than the micro-batch is padded
+    (ref. _pad) and the outputs and the loss of the padding samples are discarded.
 
-    return y
+    Returns
+    -------
+      (output, loss) : the outputs of the samples (view of the layer buffer) and the loss of the batch
+    '''
+    valid = len(X)
 
-  def _backward(self, X, trainable=True):
+    if valid < self.micro_batch:
+      X = self._pad(X, self.micro_batch)
+      truth = self._pad(truth, self.micro_batch) if truth is not None else None
+
+    output = self._forward(X=X, truth=truth, trainable=False)
+
+    return (output[:valid], self._mask_padding(valid))
+
+  @staticmethod
+  def _batches(num_data, size):
     '''
-    BackPropagate the error
+    Slices of the samples split in contiguous batches of the given size (the last one
+    can be smaller): the batches are read as views, without copies
     '''
+    return [slice(i, min(i + size, num_data)) for i in range(0, num_data, size)]
 
-    for i in reversed(range(1, self.num_layers)):
+  @staticmethod
+  def _pad(X, size):
+    '''
+    Fill a partial batch up to size samples, repeating its samples cyclically
+    (so the padding does not alter the range of the inputs)
+    '''
+    return np.take(X, np.arange(size) % len(X), axis=0)
+
+  def _mask_padding(self, valid):
+    '''
+    Discard the padding samples of the last forward, which follow the first valid
+    samples: their deltas are set to zero (so they do not contribute to the gradients)
+    and the cost is computed on the valid samples only. The cost of the yolo layer
+    is not recomputed.
+
+    Returns
+    -------
+      loss : the loss of the valid samples (ref. _get_loss)
+    '''
+    for layer in self._net[1:]:
+
+      if not hasattr(layer, 'cost'):
+        continue
+
+      delta = getattr(layer, 'delta', None)
+      loss = getattr(layer, 'loss', None)
+
+      if isinstance(delta, np.ndarray) and len(delta) > valid:
+        delta[valid:] = 0.
+
+      if isinstance(loss, np.ndarray) and loss.ndim and len(loss) > valid:
+        # the cost layer averages the loss, the softmax and logistic layers sum it
+        layer.cost = np.mean(loss[:valid]) if isinstance(layer, Cost_layer) else np.sum(loss[:valid])
 
-      input = self._net[i - 1].output[:]
-      delta = self._net[i - 1].delta[:]
+    return self._get_loss()
 
-      backward_args = self._net[i].backward.__code__.co_varnames
+  def _backward(self, X, trainable=True, update=True):
+    '''
+    BackPropagate the error and update the parameters of the layers
+    (if update is False the gradients are only computed)
+    '''
+    plan = self._plan or self._build_plan()
+
+    for step in plan.backward:
+      step()
+
+    if update:
+      self._update()
+
+  def _train_step(self, X, y, update=True, metrics=()):
+    '''
+    Training step on a batch: forward and backward of its micro-batches
+    (ref. subdivisions), with the gradients summed over the micro-batches
+    as for the whole batch, and a single update of the parameters.
+    A partial batch is padded up to the batch size (ref. _pad): the padding
+    samples do not contribute to the gradients and to the loss, the micro-batches
+    made only of padding are skipped. Notice that the padding samples are
+    included in the batchnorm statistics.
+    The running metrics (ref. NumPyNet.metrics.RunningMetric) are updated
+    with the outputs of the valid samples.
+
+    Returns
+    -------
+      loss : the sum of the micro-batches losses
+    '''
+    loss = 0.
+    gradients = self._gradients() if self.subdivisions > 1 else ()
+    accumulated = None
+    valid = len(X)
 
-      if 'inpt' in backward_args:
-        self._net[i].backward(inpt=input[:], delta=delta[:])
+    if valid < self.batch:
+      X, y = (self._pad(X, self.batch), self._pad(y, self.batch))
 
-      elif 'network' in backward_args:
-        self._net[i].backward(delta=delta[:], network=self)
+    for i in range(0, valid, self.micro_batch):
 
+      _input = X[i : i + self.micro_batch]
+
+      with span('train_step', 'network'):
+        output = self._forward(X=_input, truth=y[i : i + self.micro_batch], trainable=True)
+        loss += self._mask_padding(valid - i)
+
+        for metric in metrics:
+          metric.update(y[i : min(i + self.micro_batch, valid)], output[:valid - i])
+
+        self._backward(X=_input, trainable=True, update=False)
+
+      if accumulated is None:
+        accumulated = [getattr(sublayer, name).copy() for sublayer, name in gradients]
       else:
-        self._net[i].backward(delta=delta[:])
+        for total, (sublayer, name) in zip(accumulated, gradients):
+          total += getattr(sublayer, name)
+
+    for total, (sublayer, name) in zip(accumulated, gradients):
+      setattr(sublayer, name, total)
+
+    if update:
+      with span('optimizer', 'update'):
+        self._update()
+
+    return loss
+
+  def _gradients(self):
+    '''
+    Return the list of (layer, gradient name) of the trainable parameters
+    of the layers (and of their internal layers)
+    '''
+    return [(sublayer, parallel.GRADIENTS[param]) for layer in self for sublayer in self._sublayers(layer)
+            for param in parallel.parameters(sublayer) if param not in parallel.STATISTICS]
 
-      if hasattr(self._net[i], 'update'):
-        self._net[i].update()
+  def _update(self):
+    '''
+    Update the parameters of the trainable layers with their optimizers
+    '''
+    plan = self._plan or self._build_plan()
 
-    self._net[0].backward(delta=delta[:])
+    for update in plan.update:
+      update()
 
 
   def _get_loss(self):
@@ -541,6 +1515,13 @@ class Network(object):
     '''
     return (self.w, self.h, self.c)
 
+  @property
+  def micro_batch(self):
+    '''
+    Number of samples of each forward/backward (ref. subdivisions)
+    '''
+    return self.batch // self.subdivisions
+
   @property
   def num_layers(self):
     '''
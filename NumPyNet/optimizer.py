@@ -28,7 +28,7 @@ class Optimizer (object):
     '''
     '''
     self.lr *= 1. / (self.decay * self.iterations + 1.)
-    self.lr  = np.clip(self.lr, self.lr_min, self.lr_max)
+    self.lr  = float(np.clip(self.lr, self.lr_min, self.lr_max)) # python scalar: it does not upcast float32 params
 
   def __str__ (self):
     return self.__class__.__name__
@@ -66,7 +66,7 @@ class Momentum (Optimizer):
   def update (self, params, gradients):
 
     if self.velocity is None:
-      self.velocity = [np.zeros(shape=p.shape, dtype=float) for p in params]
+      self.velocity = [np.zeros(shape=p.shape, dtype=p.dtype) for p in params]
 
     for i, (v, p, g) in enumerate(zip(self.velocity, params, gradients)):
       v  = self.momentum * v - self.lr * g # np.clip(g, -1., 1.)
@@ -92,7 +92,7 @@ class NesterovMomentum (Optimizer):
   def update (self, params, gradients):
 
     if self.velocity is None:
-      self.velocity = [np.zeros(shape=p.shape, dtype=float) for p in params]
+      self.velocity = [np.zeros(shape=p.shape, dtype=p.dtype) for p in params]
 
     for i, (v, p, g) in enumerate(zip(self.velocity, params, gradients)):
       v  = self.momentum * v - self.lr * g # np.clip(g, -1., 1.)
@@ -118,7 +118,7 @@ class Adagrad (Optimizer):
   def update (self, params, gradients):
 
     if self.cache is None:
-      self.cache = [np.zeros(shape=p.shape, dtype=float) for p in params]
+      self.cache = [np.zeros(shape=p.shape, dtype=p.dtype) for p in params]
 
     for i, (c, p, g) in enumerate(zip(self.cache, params, gradients)):
 
@@ -148,7 +148,7 @@ class RMSprop (Optimizer):
   def update (self, params, gradients):
 
     if self.cache is None:
-      self.cache = [np.zeros(shape=p.shape, dtype=float) for p in params]
+      self.cache = [np.zeros(shape=p.shape, dtype=p.dtype) for p in params]
 
     for i, (c, p, g) in enumerate(zip(self.cache, params, gradients)):
 
@@ -178,10 +178,10 @@ class Adadelta (Optimizer):
   def update (self, params, gradients):
 
     if self.cache is None:
-      self.cache = [np.zeros(shape=p.shape, dtype=float) for p in params]
+      self.cache = [np.zeros(shape=p.shape, dtype=p.dtype) for p in params]
 
     if self.delta is None:
-      self.delta = [np.zeros(shape=p.shape, dtype=float) for p in params]
+      self.delta = [np.zeros(shape=p.shape, dtype=p.dtype) for p in params]
 
     for i, (c, d, p, g) in enumerate(zip(self.cache, self.delta, params, gradients)):
 
@@ -216,14 +216,14 @@ class Adam (Optimizer):
   def update (self, params, gradients):
     self.iterations += 1
 
-    a_t = self.lr * np.sqrt(1 - np.power(self.beta2, self.iterations)) / \
-          (1 - np.power(self.beta1, self.iterations))
+    a_t = float(self.lr * np.sqrt(1 - np.power(self.beta2, self.iterations)) / \
+                (1 - np.power(self.beta1, self.iterations)))
 
     if self.ms is None:
-      self.ms = [np.zeros(shape=p.shape, dtype=float) for p in params]
+      self.ms = [np.zeros(shape=p.shape, dtype=p.dtype) for p in params]
 
     if self.vs is None:
-      self.vs = [np.zeros(shape=p.shape, dtype=float) for p in params]
+      self.vs = [np.zeros(shape=p.shape, dtype=p.dtype) for p in params]
 
     for i, (m, v, p, g) in enumerate(zip(self.ms, self.vs, params, gradients)):
 
@@ -257,13 +257,13 @@ class Adamax (Optimizer):
   def update (self, params, gradients):
     self.iterations += 1
 
-    a_t = self.lr / (1 - np.power(self.beta1, self.iterations))
+    a_t = float(self.lr / (1 - np.power(self.beta1, self.iterations)))
 
     if self.ms is None:
-      self.ms = [np.zeros(shape=p.shape, dtype=float) for p in params]
+      self.ms = [np.zeros(shape=p.shape, dtype=p.dtype) for p in params]
 
     if self.vs is None:
-      self.vs = [np.zeros(shape=p.shape, dtype=float) for p in params]
+      self.vs = [np.zeros(shape=p.shape, dtype=p.dtype) for p in params]
 
     for i, (m, v, p, g) in enumerate(zip(self.ms, self.vs, params, gradients)):
       m = self.beta1 * m + (1 - self.beta1) * g
@@ -0,0 +1,540 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import pickle
+import weakref
+import warnings
+import numpy as np
+from copy import copy
+from collections import deque
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+
+  from multiprocessing import shared_memory
+
+except ImportError: # python < 3.8
+
+  shared_memory = None
+
+try:
+
+  from threadpoolctl import threadpool_limits
+
+except ImportError:
+
+  threadpool_limits = None
+
+__author__ = ['Mattia Ceccarelli', 'Nico Curti']
+__email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
+
+
+# parameters of the layers (and of their internal layers)
+PARAMETERS = ('weights', 'recurrent_weights', 'bias', 'scales', 'rolling_mean', 'rolling_var')
+
+# statistics updated by the forward of the layers (averaged as the gradients by the data-parallel training)
+STATISTICS = ('rolling_mean', 'rolling_var')
+
+# gradient of each parameter
+GRADIENTS = {'weights'           : 'weights_update',
+             'recurrent_weights' : 'recurrent_weights_update',
+             'bias'              : 'bias_update',
+             'scales'            : 'scales_update',
+             'rolling_mean'      : 'rolling_mean',
+             'rolling_var'       : 'rolling_var',
+             }
+
+# arrays of the layers which are not required by a worker in inference mode
+TRANSIENTS = ('delta', 'optimizer', 'weights_update', 'recurrent_weights_update', 'bias_update', 'scales_update')
+
+ALIGNMENT = 64 # bytes
+
+
+def parameters (layer):
+  '''
+  Names of the trainable arrays (and statistics) of the layer: the entries of
+  PARAMETERS with the matching gradient attribute. The normalization layers
+  (e.g. L2Norm_layer) store their scales only as a backward cache, without
+  a scales_update, so they are not parameters.
+  '''
+  return [param for param in PARAMETERS
+          if isinstance(getattr(layer, param, None), np.ndarray) and hasattr(layer, GRADIENTS[param])]
+
+
+class SharedParameters (object):
+
+  def __init__ (self, network, slots=0):
+    '''
+    Copy of the network parameters in a single shared memory block.
+    The workers rebuild the model from a skeleton (the pickled network without
+    parameters and buffers) and they map the parameters read-only as views of
+    the shared block, so the weights are never copied per worker.
+
+    Parameters
+    ----------
+      network : Network object
+        The model to share
+
+      slots : int (default = 0)
+        Number of gradient slots: a second block with the same layout of the
+        parameters, where each training worker writes its gradients
+    '''
+
+    if shared_memory is None:
+      raise NotImplementedError('Shared memory parameters require python >= 3.8')
+
+    # layout of the block: (layer index, sublayer index, parameter, offset, shape, dtype)
+    self.layout = []
+    arrays = []
+    size = 0
+
+    for i, layer in enumerate(network):
+      for j, sublayer in enumerate(network._sublayers(layer)):
+        for param in parameters(sublayer):
+          value = getattr(sublayer, param)
+
+          self.layout.append((i, j, param, size, value.shape, value.dtype.str))
+          arrays.append(value)
+          size += -(-value.nbytes // ALIGNMENT) * ALIGNMENT
+
+    self.size = size
+    self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    self.gradients = shared_memory.SharedMemory(create=True, size=max(size * slots, 1)) if slots else None
+
+    self.update(network)
+
+    self.skeleton = pickle.dumps(self._skeleton(network), protocol=pickle.HIGHEST_PROTOCOL)
+
+  @property
+  def name (self):
+    return self.shm.name
+
+  @staticmethod
+  def view (buffer, entry, base=0):
+    '''
+    Array of the layout entry in the given shared buffer
+    '''
+    _, _, _, offset, shape, dtype = entry
+    return np.ndarray(shape=shape, dtype=dtype, buffer=buffer, offset=base + offset)
+
+  @staticmethod
+  def sublayers (network, layout):
+    '''
+    Owner layer of each layout entry
+    '''
+    layers = list(network)
+    return [network._sublayers(layers[i])[j] for i, j, _, _, _, _ in layout]
+
+  def update (self, network):
+    '''
+    Copy the current parameters of the network in the shared block
+    '''
+    for entry, sublayer in zip(self.layout, self.sublayers(network, self.layout)):
+      self.view(self.shm.buf, entry)[...] = getattr(sublayer, entry[2])
+
+  def _skeleton (self, network):
+    '''
+    Shallow copy of the network without parameters, buffers and backward arrays.
+    The metrics and the history are not used by the workers: they are dropped,
+    so the model can be shared also with lambda or closure metrics.
+    '''
+    skeleton = copy(network)
+    skeleton._plan = None
+    skeleton._threads = None
+    skeleton._profiler = None
+    skeleton.metrics = None
+    skeleton.history = None
+    skeleton._net = []
+
+    for layer in network:
+
+      clone = self._strip(layer)
+
+      for sublayer in network._sublayers(layer):
+        if sublayer is not layer:
+          for k, v in clone.__dict__.items():
+            if v is sublayer:
+              clone.__dict__[k] = self._strip(sublayer)
+
+      skeleton._net.append(clone)
+
+    return skeleton
+
+  @staticmethod
+  def _strip (layer):
+    '''
+    Shallow copy of the layer without the arrays not required by the inference.
+    The output is dropped only if it is a persistent buffer (rebound by the forward):
+    the recurrent layers write in place their preallocated outputs.
+    '''
+    removed = PARAMETERS + TRANSIENTS + tuple(getattr(layer, '_backward_cache', ()))
+    buffers = layer.__dict__.get('_buffers', {}).values()
+
+    if any(np.shares_memory(layer.output, buffer) for buffer in buffers if layer.output is not None):
+      removed += ('output', )
+
+    clone = copy(layer)
+    clone.__dict__ = {k : (None if k in removed else v) for k, v in layer.__dict__.items() if k != '_buffers'}
+
+    return clone
+
+  @staticmethod
+  def attach (skeleton, name, layout, private=()):
+    '''
+    Rebuild the network in the worker from the skeleton and the shared block.
+    The parameters in private are copied, since the worker modifies them.
+
+    Returns
+    -------
+      (network, shm) : the model and the shared memory handle (which must be
+        kept alive as long as the model is used)
+    '''
+    shm = shared_memory.SharedMemory(name=name)
+
+    network = pickle.loads(skeleton)
+
+    for entry, sublayer in zip(layout, SharedParameters.sublayers(network, layout)):
+      value = SharedParameters.view(shm.buf, entry)
+
+      if entry[2] in private:
+        value = value.copy()
+      else:
+        value.flags.writeable = False
+
+      setattr(sublayer, entry[2], value)
+
+    return (network, shm)
+
+  def close (self):
+    '''
+    Release the shared memory blocks
+    '''
+    for shm in (self.shm, self.gradients):
+      if shm is not None:
+        shm.close()
+        shm.unlink()
+
+
+class ThreadPool (object):
+
+  def __init__ (self, num_threads, blas_threads=None):
+    '''
+    Intra-op thread pool of the layers kernels: the batch axis is split in
+    num_threads chunks processed concurrently (the NumPy kernels release the GIL).
+    The pool is idle while the BLAS functions run (conv and connected products),
+    but the BLAS threads keep spinning after each call: the BLAS threads are
+    limited so that num_threads * blas_threads does not exceed the cores.
+    The limit is process-wide: it is restored by shutdown, or when the pool
+    is garbage collected (or at the exit of the interpreter).
+
+    Parameters
+    ----------
+      num_threads : int
+        Number of threads (chunks of the batch). If -1 all the cpus are used
+
+      blas_threads : int (default = None)
+        Number of BLAS threads. By default cpu_count // num_threads.
+        The limit requires the threadpoolctl package.
+    '''
+    cores = os.cpu_count() or 1
+
+    if num_threads < 0:
+      num_threads = cores
+
+    self.num_threads = num_threads
+    self.blas_threads = blas_threads if blas_threads is not None else max(1, cores // num_threads)
+
+    # the calling thread processes the first chunk
+    self._executor = ThreadPoolExecutor(max_workers=max(1, num_threads - 1))
+
+    if threadpool_limits is not None:
+      self._limits = threadpool_limits(limits=self.blas_threads, user_api='blas')
+
+    else:
+      self._limits = None
+
+      if blas_threads is not None:
+        warnings.warn('The limit of the BLAS threads requires the threadpoolctl package')
+
+    # the finalizer does not refer to the pool, so it can be collected
+    self._finalizer = weakref.finalize(self, ThreadPool._release, self._executor, self._limits)
+
+  @staticmethod
+  def _release (executor, limits):
+    '''
+    Stop the threads and restore the BLAS threads
+    '''
+    executor.shutdown(wait=True)
+
+    if limits is not None:
+      limits.restore_original_limits()
+
+  def map_batch (self, func, size):
+    '''
+    Call func(s) for the slices s which split the batch axis (of length size)
+    and wait for all of them
+    '''
+    chunks = min(self.num_threads, size)
+
+    if chunks < 2:
+      func(slice(None))
+      return
+
+    bounds = np.linspace(0, size, chunks + 1).astype(int)
+    slices = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    futures = [self._executor.submit(func, s) for s in slices[1:]]
+    func(slices[0])
+
+    for future in futures:
+      future.result()
+
+  def shutdown (self):
+    '''
+    Stop the threads and restore the BLAS threads (only the first call has effect)
+    '''
+    self._finalizer()
+
+
+# state of the worker processes
+_worker = {}
+
+def _init_worker (skeleton, name, layout, out_name, out_shape, out_dtype):
+  '''
+  Initializer of the predict workers: attach weights and output arrays
+  '''
+  network, shm = SharedParameters.attach(skeleton, name, layout)
+
+  out_shm = shared_memory.SharedMemory(name=out_name)
+
+  _worker.update(network=network,
+                 shm=shm,
+                 out_shm=out_shm,
+                 output=np.ndarray(shape=out_shape, dtype=out_dtype, buffer=out_shm.buf))
+
+def _init_trainer (skeleton, name, layout, gradients_name, size):
+  '''
+  Initializer of the training workers: attach weights and gradients slots
+  '''
+  network, shm = SharedParameters.attach(skeleton, name, layout, private=STATISTICS)
+
+  gradients = shared_memory.SharedMemory(name=gradients_name)
+
+  _worker.update(network=network,
+                 shm=shm,
+                 gradients=gradients,
+                 layout=layout,
+                 size=size,
+                 sublayers=SharedParameters.sublayers(network, layout))
+
+def _train_batch (slot, X, y):
+  '''
+  Forward and backward of a batch in the worker: the gradients (and the
+  statistics updated by the forward) are written in the given slot
+  '''
+  network, layout, sublayers = (_worker['network'], _worker['layout'], _worker['sublayers'])
+  shm, gradients = (_worker['shm'].buf, _worker['gradients'].buf)
+
+  # the statistics are private, refreshed with the shared values
+  for entry, sublayer in zip(layout, sublayers):
+    if entry[2] in STATISTICS:
+      getattr(sublayer, entry[2])[...] = SharedParameters.view(shm, entry)
+
+  loss = network._train_step(X, y, update=False)
+
+  for entry, sublayer in zip(layout, sublayers):
+    SharedParameters.view(gradients, entry, base=slot * _worker['size'])[...] = getattr(sublayer, GRADIENTS[entry[2]])
+
+  return loss
+
+def _predict_batch (idx, X, truth):
+  '''
+  Predict a batch in the worker, writing the result in the shared output
+  '''
+  network = _worker['network']
+  output, loss = network._predict_step(X, truth)
+  _worker['output'][idx, ...] = output
+
+  return loss
+
+
+def predict (network, X, batches, truth=None, n_jobs=2):
+  '''
+  Batch-parallel prediction of the network over n_jobs worker processes.
+  The batches are dispatched to the workers in order, keeping at most
+  2 * n_jobs of them in flight (so lazy inputs like memmap arrays are read
+  only when required), and each worker writes its outputs in place in a
+  shared output array.
+
+  Parameters
+  ----------
+    network : Network object
+      The fitted model
+
+    X : array-like
+      Input samples
+
+    batches : list of slices (or arrays)
+      Indexes of the samples of each batch
+
+    truth : array-like (default = None)
+      Labels of the samples
+
+    n_jobs : int (default = 2)
+      Number of worker processes. If -1 all the cpus are used
+
+  Returns
+  -------
+    (output, loss) : the array of the predictions and the sum of the batches losses
+  '''
+
+  if n_jobs < 0:
+    n_jobs = os.cpu_count() or 1
+
+  out_shape = (len(X), ) + tuple(network._net[-1].out_shape[1:])
+  out_dtype = np.dtype(network.dtype)
+
+  params = SharedParameters(network)
+  out_shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(out_shape)) * out_dtype.itemsize, 1))
+
+  loss = 0.
+
+  try:
+
+    pool = mp.Pool(processes=n_jobs, initializer=_init_worker,
+                   initargs=(params.skeleton, params.name, params.layout, out_shm.name, out_shape, out_dtype.str))
+
+    try:
+
+      pending = deque()
+
+      for idx in batches:
+
+        _truth = truth[idx, ...] if truth is not None else None
+        pending.append(pool.apply_async(_predict_batch, (idx, X[idx, ...], _truth)))
+
+        if len(pending) >= 2 * n_jobs:
+          loss += pending.popleft().get() or 0.
+
+      while pending:
+        loss += pending.popleft().get() or 0.
+
+    finally:
+      pool.terminate()
+      pool.join()
+
+    output = np.ndarray(shape=out_shape, dtype=out_dtype, buffer=out_shm.buf).copy()
+
+  finally:
+    params.close()
+    out_shm.close()
+    out_shm.unlink()
+
+  return (output, loss)
+
+
+class DataParallel (object):
+
+  def __init__ (self, network, n_jobs=2):
+    '''
+    Synchronous data-parallel training of the network over n_jobs processes
+    (the main process included). Each step processes n_jobs batches, one per
+    process: the workers write their gradients (and the rolling statistics)
+    in their shared memory slot, the main process averages them with its
+    own ones and it applies the optimizer step once. The updated parameters
+    are copied in the shared block mapped read-only by the workers.
+
+    The layers initialize lazily some parameters (e.g. the batchnorm scales
+    and statistics), so the first step is processed by the main process alone,
+    batch by batch, and the workers are started after it.
+    Notice that the batchnorm statistics are computed on the single batches.
+
+    Parameters
+    ----------
+      network : Network object
+        The compiled model
+
+      n_jobs : int (default = 2)
+        Number of processes. If -1 all the cpus are used
+    '''
+
+    if n_jobs < 0:
+      n_jobs = os.cpu_count() or 1
+
+    self.network = network
+    self.n_jobs = n_jobs
+    self.params = None
+    self.pool = None
+
+  def _start (self):
+    '''
+    Share the parameters and start the workers
+    '''
+    self.params = SharedParameters(self.network, slots=self.n_jobs - 1)
+    self.sublayers = SharedParameters.sublayers(self.network, self.params.layout)
+
+    self.pool = mp.Pool(processes=self.n_jobs - 1, initializer=_init_trainer,
+                        initargs=(self.params.skeleton, self.params.name, self.params.layout,
+                                  self.params.gradients.name, self.params.size))
+
+  def step (self, X, y, metrics=()):
+    '''
+    Training step on a list of (at most n_jobs) batches.
+    The running metrics are updated with the outputs of the batches of the main process.
+
+    Returns
+    -------
+      loss : the sum of the batches losses
+    '''
+    network = self.network
+    loss = 0.
+
+    if self.pool is None:
+
+      for _input, _truth in zip(X, y):
+        loss += network._train_step(_input, _truth, metrics=metrics)
+
+      self._start()
+
+      return loss
+
+    results = [self.pool.apply_async(_train_batch, (slot, _input, _truth))
+               for slot, (_input, _truth) in enumerate(zip(X[1:], y[1:]))]
+
+    loss += network._train_step(X[0], y[0], update=False, metrics=metrics)
+    loss += sum(result.get() for result in results)
+
+    # average of the gradients and statistics of all the processes
+    gradients = self.params.gradients.buf
+
+    for entry, sublayer in zip(self.params.layout, self.sublayers):
+      name = GRADIENTS[entry[2]]
+      value = np.array(getattr(sublayer, name), dtype=network.dtype)
+
+      for slot in range(len(results)):
+        value += SharedParameters.view(gradients, entry, base=slot * self.params.size)
+
+      value *= 1. / len(X)
+      setattr(sublayer, name, value)
+
+    network._update()
+    self.params.update(network)
+
+    return loss
+
+  def close (self):
+    '''
+    Stop the workers and release the shared memory
+    '''
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool.join()
+      self.params.close()
+
+    self.pool = None
+    self.params = None
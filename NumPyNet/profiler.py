@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import threading
+from contextlib import contextmanager
+from time import perf_counter as now
+
+__author__ = ['Mattia Ceccarelli', 'Nico Curti']
+__email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
+
+
+PHASES = ('forward', 'backward', 'update')
+
+# floating point operations of the backward (delta and weights gradients)
+# with respect to the ones of the forward
+BACKWARD_FLOPS = 2
+
+# tracer which records the spans of the threads (ref. Tracer.start)
+_tracer = None
+
+
+@contextmanager
+def _null_span ():
+  yield
+
+
+def span (name, cat):
+  '''
+  Context manager which records the enclosed block as an event of the
+  active tracer (ref. Tracer.start). Without a tracer it does nothing.
+
+  Parameters
+  ----------
+    name : str
+      Name of the event
+
+    cat : str
+      Category of the event (network, data, video)
+  '''
+  tracer = _tracer
+  return tracer.span(name, cat) if tracer is not None else _null_span()
+
+
+class Profiler (object):
+
+  def __init__ (self, warmup=1, steps=None):
+    '''
+    Wall time of the forward, backward and update of each layer of a network
+    model (ref. Network.set_profiler), accumulated over the steps.
+    A step starts with the forward of the input layer.
+
+    Parameters
+    ----------
+      warmup : int (default = 1)
+        Number of steps not recorded: the first step allocates the buffers of the layers
+
+      steps : int (default = None)
+        Number of recorded steps, by default all the steps after the warmup
+    '''
+    self.warmup = warmup
+    self.steps = steps
+    self.reset()
+
+  def reset (self):
+    '''
+    Clear the recorded times
+    '''
+    self.times = {}
+    self.calls = {}
+    self.layers = {}
+    self.step = -1 # index of the current step
+    self.recorded = 0
+
+  @property
+  def recording (self):
+    '''
+    Check if the current step is in the recorded window
+    '''
+    return self.step >= self.warmup and (self.steps is None or self.step < self.warmup + self.steps)
+
+  def wrap (self, phase, index, layer, func):
+    '''
+    Return the function func of the given layer, timed as the phase of the layer index
+    '''
+    key = (index, phase)
+    self.layers[index] = layer
+    first = index == 0 and phase == 'forward'
+
+    def timed (*args):
+
+      if first:
+        self.step += 1
+        self.recorded += self.recording
+
+      if not self.recording:
+        return func(*args)
+
+      tic = now()
+      result = func(*args)
+      self._record(key, tic, now())
+
+      return result
+
+    return timed
+
+  def _record (self, key, tic, toc):
+    '''
+    Accumulate the time of a call of the (layer index, phase)
+    '''
+    self.times[key] = self.times.get(key, 0.) + toc - tic
+    self.calls[key] = self.calls.get(key, 0) + 1
+
+  @staticmethod
+  def flops (layer, phase):
+    '''
+    Floating point operations of the phase of the layer on a batch (None if not available)
+    '''
+    flops = getattr(layer, 'flops', None)
+
+    if flops is None or phase == 'update':
+      return None
+
+    flops *= layer.out_shape[0]
+
+    return flops * BACKWARD_FLOPS if phase == 'backward' else flops
+
+  def report (self):
+    '''
+    Return the list of the recorded (layer, phase) sorted by time as dictionaries with the keys
+
+      index   : index of the layer
+      layer   : name of the layer
+      phase   : forward, backward or update
+      calls   : number of calls
+      time    : mean time for step (seconds)
+      percent : percentage of the total time of the step
+      gflops  : achieved GFLOP/s (None if the layer does not provide its flops)
+    '''
+    total = sum(self.times.values())
+    steps = max(self.recorded, 1)
+    rows = []
+
+    for (index, phase), time in self.times.items():
+      layer = self.layers[index]
+      calls = self.calls[(index, phase)]
+      flops = self.flops(layer, phase)
+
+      rows.append({'index'   : index,
+                   'layer'   : str(layer).split()[0],
+                   'phase'   : phase,
+                   'calls'   : calls,
+                   'time'    : time / steps,
+                   'percent' : 100. * time / total if total else 0.,
+                   'gflops'  : flops * calls / time * 1e-9 if flops is not None and time > 0. else None,
+                  })
+
+    return sorted(rows, key=lambda row : row['time'], reverse=True)
+
+  def summary (self, top=None):
+    '''
+    Print the recorded times sorted by time
+
+    Parameters
+    ----------
+      top : int (default = None)
+        Number of rows printed, by default all
+    '''
+    rows = self.report()
+
+    print('Profile of {:d} steps: {:.3f} ms/step'.format(self.recorded, 1e3 * sum(row['time'] for row in rows)))
+    print('layer               phase      calls    ms/step        %    GFLOP/s')
+
+    for row in rows[:top]:
+      gflops = '{:>10.3f}'.format(row['gflops']) if row['gflops'] is not None else '{:>10s}'.format('-')
+      print('{index:>4d} {layer:<14s} {phase:<10s} {calls:>5d} {ms:>10.3f} {percent:>8.2f}'.format(ms=1e3 * row['time'], **row) + gflops)
+
+
+class Tracer (Profiler):
+
+  def __init__ (self, filename, warmup=0, steps=None):
+    '''
+    Timeline of the training and inference steps in the Chrome trace-event
+    format (chrome://tracing, https://ui.perfetto.dev).
+    The forward, backward and update of each layer are recorded as the ones
+    of the Profiler (ref. Network.set_profiler), the other spans (train steps,
+    data loading of the DataGenerator and frame reading of the VideoCapture
+    threads) are recorded by the tracer started with Tracer.start.
+    The gaps between the layer events in a step are the Python overhead.
+
+    Parameters
+    ----------
+      filename : str
+        Output JSON file, written by stop
+
+      warmup : int (default = 0)
+        Number of steps not recorded (the spans are recorded from the last warmup step)
+
+      steps : int (default = None)
+        Number of recorded steps, by default all the steps after the warmup
+
+    Examples
+    --------
+
+    >>> tracer = Tracer('trace.json', warmup=1, steps=10)
+    >>> model.set_profiler(tracer)
+    >>> with tracer:
+    >>>   model.fit_generator(generator, max_iter=20)
+    '''
+    self.filename = filename
+    self._origin = now()
+    super(Tracer, self).__init__(warmup=warmup, steps=steps)
+
+  def reset (self):
+    '''
+    Clear the recorded times and events
+    '''
+    super(Tracer, self).reset()
+    self.events = []
+    self._threads = {}
+
+  @property
+  def tracing (self):
+    '''
+    Check if the spans are recorded: from the last warmup step (which loads the
+    data of the first recorded step) up to the end of the recorded window
+    '''
+    return self.step >= self.warmup - 1 and (self.steps is None or self.step < self.warmup + self.steps)
+
+  def _event (self, name, cat, tic, toc):
+    '''
+    Append a complete event of the current thread (times in microseconds)
+    '''
+    thread = threading.current_thread()
+    self._threads[thread.ident] = thread.name
+
+    self.events.append({'name' : name, 'cat' : cat, 'ph' : 'X',
+                        'ts' : 1e6 * (tic - self._origin), 'dur' : 1e6 * (toc - tic),
+                        'pid' : os.getpid(), 'tid' : thread.ident})
+
+  def _record (self, key, tic, toc):
+    '''
+    Accumulate the time of a call of the (layer index, phase) and record its event
+    '''
+    super(Tracer, self)._record(key, tic, toc)
+
+    index, phase = key
+    name = '{:d} {} {}'.format(index, str(self.layers[index]).split()[0], phase)
+    self._event(name, 'update' if phase == 'update' else 'network', tic, toc)
+
+  @contextmanager
+  def span (self, name, cat):
+    '''
+    Record the enclosed block as an event (ref. span), if it ends in the traced window
+    '''
+    tic = now()
+    try:
+      yield
+    finally:
+      if self.tracing:
+        self._event(name, cat, tic, now())
+
+  def start (self):
+    '''
+    Set the tracer as the active one, which records the spans of all the threads
+    '''
+    global _tracer
+    _tracer = self
+    return self
+
+  def stop (self):
+    '''
+    Remove the active tracer and write the trace file
+    '''
+    global _tracer
+
+    if _tracer is self:
+      _tracer = None
+
+    self.save()
+
+  def save (self, filename=None):
+    '''
+    Write the recorded events as Chrome trace-event JSON
+    '''
+    metadata = [{'name' : 'thread_name', 'ph' : 'M', 'pid' : os.getpid(), 'tid' : tid, 'args' : {'name' : name}}
+                for tid, name in self._threads.items()]
+
+    with open(filename or self.filename, 'w') as fp:
+      json.dump({'traceEvents' : metadata + list(self.events), 'displayTimeUnit' : 'ms'}, fp)
+
+  def __enter__ (self):
+    return self.start()
+
+  def __exit__ (self, *args):
+    self.stop()
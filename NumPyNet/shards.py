@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import json
+import argparse
+import numpy as np
+from glob import glob
+
+from NumPyNet.image import Image
+from NumPyNet.profiler import span
+
+__author__ = ['Mattia Ceccarelli', 'Nico Curti']
+__email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
+
+
+FORMAT_VERSION = 1
+
+METADATA = 'meta.json'
+INDEX = 'index.npy'
+
+# alignment of the records (and of the labels) in the shard files
+ALIGNMENT = 16
+
+
+def _aligned (nbytes):
+  '''
+  Size rounded up to the alignment of the records
+  '''
+  return -(-nbytes // ALIGNMENT) * ALIGNMENT
+
+
+def _encode (sample, dtype, scale=1.):
+  '''
+  Payload of the sample: the values multiplied by scale and converted to dtype
+  (rounded and clipped to the range of integer types)
+  '''
+  sample = np.asarray(sample.get() if isinstance(sample, Image) else sample)
+
+  if scale != 1.:
+    sample = sample * scale
+
+  if np.issubdtype(dtype, np.integer):
+    info = np.iinfo(dtype)
+    sample = np.clip(np.rint(sample), info.min, info.max)
+
+  return np.require(sample, dtype=dtype, requirements='C')
+
+
+class ShardWriter (object):
+
+  def __init__ (self, path, dtype=np.uint8, scale=1., label_dtype=np.float32, shard_size=64 * 2**20):
+    '''
+    Pack preprocessed samples (and labels) in shard files of (at most) shard_size
+    bytes, with an index of the offsets and shapes of the samples (ref. ShardReader).
+    The directory of the dataset contains the shard files, the index (index.npy)
+    and the metadata (meta.json).
+
+    Parameters
+    ----------
+      path : str
+        Directory of the dataset, created if it does not exist
+
+      dtype : numpy type (default = np.uint8)
+        Type of the samples payload (e.g. np.uint8 or np.float16)
+
+      scale : float (default = 1.)
+        Factor of the values before the conversion to dtype, e.g. 255 for images
+        in [0, 1] stored as uint8 (the reader divides by scale)
+
+      label_dtype : numpy type (default = np.float32)
+        Type of the labels payload
+
+      shard_size : int (default = 64 MB)
+        Maximum size of a shard file in bytes (a larger sample gets its own shard)
+
+    Examples
+    --------
+
+    >>> with ShardWriter('train_shards', dtype=np.uint8, scale=255.) as writer:
+    >>>   for filename, label in zip(filenames, labels):
+    >>>     writer.write(Image(filename), label)
+    '''
+    if shard_size <= 0:
+      raise ValueError('ShardWriter : shard_size must be positive. Given {}'.format(shard_size))
+
+    self.path = path
+    self.dtype = np.dtype(dtype)
+    self.scale = float(scale)
+    self.label_dtype = np.dtype(label_dtype)
+    self.shard_size = shard_size
+
+    if not os.path.exists(path):
+      os.makedirs(path)
+
+    self._shards = []
+    self._records = []
+    self._labeled = None
+    self._ndim = None
+    self._fp = None
+    self._size = 0
+
+  def _next_shard (self):
+    '''
+    Close the current shard file and open the next one
+    '''
+    if self._fp is not None:
+      self._fp.close()
+
+    self._shards.append('shard-{:05d}.bin'.format(len(self._shards)))
+    self._fp = open(os.path.join(self.path, self._shards[-1]), 'wb')
+    self._size = 0
+
+  def write (self, data, label=None):
+    '''
+    Append a sample (and its label) to the dataset. All the samples must have
+    the same number of dimensions (and the labels too), with any shape.
+    '''
+    labeled = label is not None
+
+    if self._labeled is None:
+      self._labeled = labeled
+
+    elif labeled != self._labeled:
+      raise ValueError('ShardWriter : the samples must be all labeled or all unlabeled')
+
+    data = _encode(data, self.dtype, self.scale)
+    label = _encode(label, self.label_dtype) if labeled else np.empty(shape=(0, ), dtype=self.label_dtype)
+
+    ndim = (data.ndim, label.ndim)
+
+    if self._ndim is None:
+      self._ndim = ndim
+
+    elif ndim != self._ndim:
+      raise ValueError('ShardWriter : the samples must have {:d} dimensions and the labels {:d}. Given {:d} and {:d}'.format(*(self._ndim + ndim)))
+
+    size = _aligned(data.nbytes) + _aligned(label.nbytes)
+
+    if self._fp is None or (self._size and self._size + size > self.shard_size):
+      self._next_shard()
+
+    offset = self._size
+
+    for payload in (data, label):
+      self._fp.write(payload.tobytes())
+      self._fp.write(b'\0' * (_aligned(payload.nbytes) - payload.nbytes))
+
+    self._size += size
+    self._records.append((len(self._shards) - 1, offset, data.shape, label.shape))
+
+  def close (self):
+    '''
+    Close the last shard and write the index and the metadata
+    '''
+    if self._fp is not None:
+      self._fp.close()
+      self._fp = None
+
+    data_ndim, label_ndim = self._ndim or (0, 0)
+
+    index = np.empty(shape=(len(self._records), ), dtype=[('shard', np.uint32), ('offset', np.uint64),
+                                                          ('shape', np.uint32, (data_ndim, )),
+                                                          ('label_shape', np.uint32, (label_ndim, ))])
+    for i, record in enumerate(self._records):
+      index[i] = record
+
+    np.save(os.path.join(self.path, INDEX), index)
+
+    metadata = {'version'     : FORMAT_VERSION,
+                'num_samples' : len(self._records),
+                'dtype'       : self.dtype.str,
+                'scale'       : self.scale,
+                'label_dtype' : self.label_dtype.str if self._labeled else None,
+                'shards'      : self._shards,
+                }
+
+    with open(os.path.join(self.path, METADATA), 'w') as fp:
+      json.dump(metadata, fp, indent=2)
+
+  def __enter__ (self):
+    return self
+
+  def __exit__ (self, *args):
+    self.close()
+
+
+class ShardReader (object):
+
+  def __init__ (self, path, dtype=np.float32):
+    '''
+    Reader of a dataset packed by ShardWriter, with random access to the samples
+    (the shard files are memory-mapped) and sequential streaming of the shards.
+    The reader can be given to the loader processes of the DataGenerator: the
+    shards are mapped again by each process.
+
+    Parameters
+    ----------
+      path : str
+        Directory of the dataset
+
+      dtype : numpy type (default = np.float32)
+        Type of the decoded samples (the payload divided by the scale of the
+        writer). If None the payload is returned as stored
+    '''
+    with open(os.path.join(path, METADATA)) as fp:
+      metadata = json.load(fp)
+
+    if metadata['version'] != FORMAT_VERSION:
+      raise ValueError('ShardReader : unsupported format version. Given {}'.format(metadata['version']))
+
+    self.path = path
+    self.dtype = np.dtype(dtype) if dtype is not None else None
+    self.scale = metadata['scale']
+    self.shards = metadata['shards']
+    self.index = np.load(os.path.join(path, INDEX))
+
+    self._payload = (np.dtype(metadata['dtype']),
+                     np.dtype(metadata['label_dtype']) if metadata['label_dtype'] is not None else None)
+    self._maps = {}
+
+  @property
+  def labeled (self):
+    return self._payload[1] is not None
+
+  def __len__ (self):
+    return len(self.index)
+
+  def __repr__ (self):
+    return '{}({!r})'.format(self.__class__.__name__, self.path)
+
+  def __getstate__ (self):
+    # the memory maps are not pickled: each process maps the shards
+    state = self.__dict__.copy()
+    state['_maps'] = {}
+    return state
+
+  def _map (self, shard):
+    '''
+    Memory map of the shard file, opened at the first access
+    '''
+    buffer = self._maps.get(shard)
+
+    if buffer is None:
+      buffer = self._maps[shard] = np.memmap(os.path.join(self.path, self.shards[shard]), dtype=np.uint8, mode='r')
+
+    return buffer
+
+  def _decode (self, buffer, offset, record, copy=False):
+    '''
+    Decode the sample (and its label) of the index record stored at offset of the buffer.
+    Without a decoding type the payload is a view of the buffer, unless copy.
+    '''
+    dtype, label_dtype = self._payload
+    shape = tuple(int(s) for s in record['shape'])
+    size = int(np.prod(shape)) * dtype.itemsize
+
+    data = np.frombuffer(buffer, dtype=dtype, count=size // dtype.itemsize, offset=offset).reshape(shape)
+
+    if self.dtype is not None:
+      data = data.astype(self.dtype)
+
+      if self.scale != 1.:
+        data *= 1. / self.scale
+
+    elif copy:
+      data = data.copy()
+
+    if label_dtype is None:
+      return data
+
+    label_shape = tuple(int(s) for s in record['label_shape'])
+    label = np.frombuffer(buffer, dtype=label_dtype, count=int(np.prod(label_shape)),
+                          offset=offset + _aligned(size)).reshape(label_shape)
+
+    return (data, label.copy())
+
+  def __getitem__ (self, index):
+    '''
+    Random access: the sample (data, label) of the given index (data if the dataset has no labels)
+    '''
+    record = self.index[index]
+    return self._decode(self._map(int(record['shard'])), int(record['offset']), record)
+
+  def stream (self, shuffle=False):
+    '''
+    Sequential reading of the dataset: each shard file is read with a single
+    contiguous read in a buffer allocated once, and its samples are decoded in order.
+
+    Parameters
+    ----------
+      shuffle : bool (default = False)
+        Read the shards in random order and permute the samples of each shard
+
+    Yields
+    ------
+      The samples (data, label), or data if the dataset has no labels
+    '''
+    shards = self.index['shard']
+    order = np.random.permutation(len(self.shards)) if shuffle else range(len(self.shards))
+    sizes = [os.path.getsize(os.path.join(self.path, shard)) for shard in self.shards]
+    buffer = np.empty(shape=(max(sizes, default=0), ), dtype=np.uint8)
+
+    for shard in order:
+
+      with span('read_shard', 'data'):
+        with open(os.path.join(self.path, self.shards[shard]), 'rb') as fp:
+          fp.readinto(memoryview(buffer)[:sizes[shard]])
+
+      records = np.flatnonzero(shards == shard)
+
+      if shuffle:
+        np.random.shuffle(records)
+
+      for i in records:
+        record = self.index[i]
+        # the buffer is overwritten by the next shard
+        yield self._decode(buffer, int(record['offset']), record, copy=True)
+
+  def close (self):
+    '''
+    Release the memory maps of the shards
+    '''
+    self._maps = {}
+
+
+def _load_image (filename, size=None):
+  '''
+  Image of the file in [0, 1], resized to size (width, height) if given
+  '''
+  image = Image(filename)
+  return image.resize(dsize=size) if size is not None else image.get()
+
+
+def pack_images (path, filenames, labels=None, size=None, dtype=np.uint8, shard_size=64 * 2**20):
+  '''
+  Pack the image files (and labels) in a sharded dataset (ref. ShardWriter).
+  The images are stored in [0, 255] if dtype is integer, else in [0, 1].
+
+  Parameters
+  ----------
+    path : str
+      Directory of the dataset
+
+    filenames : list of str
+      Image files
+
+    labels : array-like (default = None)
+      Labels of the images
+
+    size : tuple (default = None)
+      Resize the images to (width, height)
+
+    dtype : numpy type (default = np.uint8)
+      Type of the payload
+
+    shard_size : int (default = 64 MB)
+      Maximum size of a shard file in bytes
+
+  Returns
+  -------
+    num_samples : number of packed images
+  '''
+  scale = 255. if np.issubdtype(dtype, np.integer) else 1.
+  labels = labels if labels is not None else [None] * len(filenames)
+
+  with ShardWriter(path, dtype=dtype, scale=scale, shard_size=shard_size) as writer:
+    for filename, label in zip(filenames, labels):
+      writer.write(_load_image(filename, size), label)
+
+  return len(filenames)
+
+
+def parse_args ():
+
+  description = 'NumPyNet tool to pack image files in a sharded dataset'
+
+  parser = argparse.ArgumentParser(description = description)
+  parser.add_argument('--source_path',
+                      dest='source_path',
+                      required=True,
+                      type=str,
+                      action='store',
+                      help='Directory of the image files'
+                      )
+  parser.add_argument('--source_extension',
+                      dest='source_extension',
+                      required=False,
+                      type=str,
+                      action='store',
+                      help='Extension of the image files',
+                      default=''
+                      )
+  parser.add_argument('--label_file',
+                      dest='label_file',
+                      required=False,
+                      type=str,
+                      action='store',
+                      help='File of the labels, one for each (sorted) image file',
+                      default=None
+                      )
+  parser.add_argument('--output',
+                      dest='output',
+                      required=True,
+                      type=str,
+                      action='store',
+                      help='Directory of the packed dataset'
+                      )
+  parser.add_argument('--dtype',
+                      dest='dtype',
+                      required=False,
+                      type=str,
+                      action='store',
+                      help='Type of the payload',
+                      choices=['uint8', 'float16', 'float32'],
+                      default='uint8'
+                      )
+  parser.add_argument('--size',
+                      dest='size',
+                      required=False,
+                      type=int,
+                      nargs=2,
+                      action='store',
+                      help='Resize the images to width height',
+                      default=None
+                      )
+  parser.add_argument('--shard_size',
+                      dest='shard_size',
+                      required=False,
+                      type=int,
+                      action='store',
+                      help='Maximum size of a shard in MB',
+                      default=64
+                      )
+
+  args = parser.parse_args()
+
+  return args
+
+
+def main ():
+
+  args = parse_args()
+
+  filenames = sorted(glob(os.path.join(args.source_path, '*{}'.format(args.source_extension))))
+  labels = None
+
+  if args.label_file is not None:
+
+    with open(args.label_file) as fp:
+      labels = fp.read().splitlines()
+
+    # convert to unique numbers (ref. DataGenerator)
+    _, labels = np.unique(labels, return_inverse=True)
+
+  num_samples = pack_images(args.output, filenames, labels=labels, size=tuple(args.size) if args.size else None,
+                            dtype=np.dtype(args.dtype), shard_size=args.shard_size * 2**20)
+
+  print('Packed {:d} samples in {}'.format(num_samples, args.output))
+
+
+if __name__ == '__main__':
+
+  main()
@@ -10,6 +10,8 @@ import numpy as np
 from enum import Enum
 from io import StringIO
 from inspect import isclass
+from threading import Condition
+from collections import deque
 from contextlib import contextmanager
 
 from NumPyNet import activations
@@ -296,3 +298,85 @@ def _redirect_stdout (verbose):
       yield new_target
   finally:
     sys.stdout = old_target
+
+
+class BoundedQueue (object):
+
+  def __init__ (self, maxsize):
+    '''
+    Bounded FIFO queue between threads, which can be closed: the producers
+    wait while the queue is full and the consumers while it is empty, and they
+    are woken up as soon as an item is removed or inserted, or the queue is closed.
+    After the close no item is inserted and the remaining ones can still be taken.
+
+    Parameters
+    ----------
+      maxsize : int
+        Maximum number of items
+    '''
+    self.maxsize = maxsize
+    self.closed = False
+    self._items = deque()
+    self._cond = Condition()
+
+  def put (self, item):
+    '''
+    Insert an item, waiting for a free place. Return False if the queue is closed.
+    '''
+    with self._cond:
+
+      while len(self._items) >= self.maxsize and not self.closed:
+        self._cond.wait()
+
+      if self.closed:
+        return False
+
+      self._items.append(item)
+      self._cond.notify_all()
+
+    return True
+
+  def get (self, timeout=None):
+    '''
+    Remove the first item, waiting until it is available (at most timeout seconds).
+
+    Returns
+    -------
+      (item, grabbed) : the item and True, or (None, False) if the queue is closed
+                        and empty (or after the timeout)
+    '''
+    with self._cond:
+
+      if not self._cond.wait_for(lambda : self._items or self.closed, timeout=timeout) or not self._items:
+        return (None, False)
+
+      item = self._items.popleft()
+      self._cond.notify_all()
+
+    return (item, True)
+
+  def wait (self, timeout=None):
+    '''
+    Wait until an item is available or the queue is closed (at most timeout seconds).
+    Return True if there are items.
+    '''
+    with self._cond:
+      self._cond.wait_for(lambda : self._items or self.closed, timeout=timeout)
+      return len(self._items) > 0
+
+  def close (self):
+    '''
+    Close the queue and wake up all the waiting threads
+    '''
+    with self._cond:
+      self.closed = True
+      self._cond.notify_all()
+
+  def qsize (self):
+    return len(self._items)
+
+  def empty (self):
+    return not self._items
+
+  def full (self):
+    return len(self._items) >= self.maxsize
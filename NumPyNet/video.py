@@ -8,16 +8,10 @@ import cv2
 import time
 from threading import Thread
 
-try:
-
-  from queue import Queue
-
-except ImportError:
-
-  from Queue import Queue
-
 from NumPyNet.image import Image
+from NumPyNet.utils import BoundedQueue
 from NumPyNet.exception import VideoError
+from NumPyNet.profiler import span
 
 __author__ = ['Mattia Ceccarelli', 'Nico Curti']
 __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
@@ -47,8 +41,8 @@ class VideoCapture (object):
     if self._stream is None or not self._stream.isOpened():
       raise VideoError('Can not open or find camera. Given: {}'.format(cam_index))
 
-    self._queue = Queue(maxsize=queue_size)
-    self._thread = Thread(target=self._update, args=())
+    self._queue = BoundedQueue(maxsize=queue_size)
+    self._thread = Thread(target=self._update, args=(), name='VideoCapture')
     self._thread.daemon = True
 
     self._num_frames = 0
@@ -67,28 +61,26 @@ class VideoCapture (object):
   def _update (self):
     '''
     Infinite loop of frame reading.
-    Each frame is inserted into the private queue.
+    Each frame is inserted into the private queue, as soon as there is
+    a free place (the reading waits while the queue is full).
     '''
 
     self._start = time.time()
 
     while not self._stopped:
 
-      if not self._queue.full():
+      with span('read_frame', 'video'):
         (grabbed, frame) = self._stream.read()
 
-        if not grabbed:
-          self._stopped = True
-
-        else:
-          self._num_frames += 1
-
-          self._queue.put(frame)
+      if not grabbed:
+        self._stopped = True
 
-      else:
-
-        time.sleep(.1)
+      # wait for a free place (False if stopped)
+      elif self._queue.put(frame):
+        self._num_frames += 1
 
+    # wake up the consumer: the read frames can still be used
+    self._queue.close()
     self._stream.release()
 
   def read (self):
@@ -96,20 +88,21 @@ class VideoCapture (object):
     Get a frame as Image object
     '''
     im = Image()
-    return im.from_frame(self._queue.get())
 
-  def running (self):
-    '''
-    Check if new frames are available
-    '''
+    with span('wait_frame', 'video'):
+      frame, grabbed = self._queue.get()
 
-    tries = 0
+    if not grabbed:
+      raise VideoError('No more frames: the video capture is stopped')
 
-    while self._queue.qsize() == 0 and not self._stopped and tries < 5:
-      time.sleep(.1)
-      tries += 1
+    return im.from_frame(frame)
 
-    return self._queue.qsize() > 0
+  def running (self, timeout=.5):
+    '''
+    Check if new frames are available, waiting at most timeout seconds
+    (it returns as soon as a frame is read or the capture is stopped)
+    '''
+    return self._queue.wait(timeout=timeout)
 
 
   def stop (self):
@@ -118,6 +111,7 @@ class VideoCapture (object):
     '''
 
     self._stopped = True
+    self._queue.close()
     self._thread.join()
     self._end = time.time()
 
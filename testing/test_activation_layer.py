@@ -202,3 +202,39 @@ class TestActivationLayer:
     # Check dimension and delta
     assert delta_keras.shape == delta.shape
     np.testing.assert_allclose(delta_keras, delta, atol=1e-4, rtol=1e-4)
+
+
+  @given(batch = st.integers(min_value=1, max_value=15 ),
+         w     = st.integers(min_value=1, max_value=100),
+         h     = st.integers(min_value=1, max_value=100),
+         c     = st.integers(min_value=1, max_value=10 ),
+         act_fun = st.sampled_from([Relu, Leaky, Logistic, Linear, Tanh])
+         )
+  @settings(max_examples=20,
+            deadline=None)
+  def test_inplace (self, batch, w, h, c, act_fun):
+
+    inpt = np.random.uniform(low=-1., high=1., size=(batch, w, h, c)).astype(float)
+    delta = np.random.uniform(low=-1., high=1., size=(batch, w, h, c)).astype(float)
+
+    assert act_fun.inplace
+
+    out = act_fun.activate(inpt, copy=True)
+    grad = delta * act_fun.gradient(out, copy=True)
+
+    # fused epilogue: the input array is activated in place, the mask is stored for the gradient
+    x = inpt.copy()
+    mask = np.empty(shape=x.shape, dtype=bool) if act_fun.use_mask else None
+    fused_out = act_fun.activate_inplace(x, mask=mask)
+
+    assert np.shares_memory(fused_out, x)
+    np.testing.assert_allclose(fused_out, out, atol=1e-8, rtol=1e-5)
+
+    fused_grad = delta.copy()
+    act_fun.gradient_inplace(fused_grad, fused_out, mask=mask, workspace=np.empty_like(x))
+    np.testing.assert_allclose(fused_grad, grad, atol=1e-8, rtol=1e-5)
+
+    # without the stored mask the gradient is evaluated on the output
+    fused_grad = delta.copy()
+    act_fun.gradient_inplace(fused_grad, fused_out)
+    np.testing.assert_allclose(fused_grad, grad, atol=1e-8, rtol=1e-5)
@@ -136,6 +136,12 @@ class TestBatchnormLayer:
     assert x_norm.shape == numpynet.x.shape
     np.testing.assert_allclose(numpynet.x_norm, x_norm, rtol=1e-5, atol=1e-8)
 
+    # Inference mode: same output without the backward arrays
+    numpynet.forward(inpt=inpt, trainable=False)
+    np.testing.assert_allclose(numpynet.output, forward_out_numpynet, rtol=1e-5, atol=1e-8)
+    assert numpynet.x is None and numpynet.x_norm is None
+    assert numpynet.delta is None
+
 
   @given(b = st.integers(min_value=3, max_value=15 ),
          w = st.integers(min_value=50, max_value=300), # numerical instability for small dimensions!
@@ -0,0 +1,235 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+
+from NumPyNet.data import DataGenerator
+from NumPyNet.data import MemmapDataset
+from NumPyNet.data import SampleCache
+
+import time
+import numpy as np
+
+__author__ = ['Mattia Ceccarelli', 'Nico Curti']
+__email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
+
+
+class TestData:
+  '''
+  Test the data loading utilities
+
+  -data generator loader processes with reproducible order and seeds
+  -data generator ring of preallocated batches
+  -data generator stopped without polling
+  -memory-mapped dataset with block shuffling
+  -LRU cache of the loaded samples with memory budget and disk spill
+  '''
+
+  def test_generator_workers (self, tmpdir):
+
+    np.random.seed(123)
+    sources, labels = (tmpdir.mkdir('data'), tmpdir.mkdir('labels'))
+
+    for i in range(10):
+      np.save(str(sources.join('{:d}.npy'.format(i))), np.full(shape=(2, 2, 1), fill_value=i, dtype=float))
+      np.save(str(labels.join('{:d}.npy'.format(i))), np.full(shape=(1, 1, 1), fill_value=i, dtype=float))
+
+    def load (source, label, noise=False):
+      data = np.load(source)
+      return (data + np.random.uniform(size=data.shape) if noise else data, np.load(label))
+
+    def batches (num_workers, num_batches=6, **kwargs):
+      gen = DataGenerator(load_func=load, batch_size=3, source_path=str(sources), label_path=str(labels),
+                          source_extension='.npy', label_extension='.npy', num_workers=num_workers, **kwargs).start()
+      loaded = [gen.load_data()[:2] for _ in range(num_batches)]
+      gen.stop()
+
+      return [(np.asarray(data), np.asarray(label)) for data, label in loaded]
+
+    serial = batches(num_workers=0)
+    parallel = batches(num_workers=2)
+
+    # same order of the serial loading, with the data of each label
+    for (data, label), (other, other_label) in zip(serial, parallel):
+      np.testing.assert_array_equal(data, other)
+      np.testing.assert_array_equal(label, other_label)
+      np.testing.assert_array_equal(data[:, 0, 0, 0], label[:, 0, 0, 0])
+
+    # the preprocessing does not depend on the workers (the thread loading included)
+    noisy = batches(num_workers=0, noise=True)
+
+    for workers in (2, 3):
+      for (data, label), (other_data, _) in zip(noisy, batches(num_workers=workers, noise=True)):
+        np.testing.assert_array_equal(data, other_data)
+        assert not np.allclose(data, label[:, :1, :1].repeat(2, axis=1).repeat(2, axis=2))
+
+  def test_generator_ring (self, tmpdir, monkeypatch):
+
+    np.random.seed(123)
+    sources, labels = (tmpdir.mkdir('data'), tmpdir.mkdir('labels'))
+
+    for i in range(10):
+      np.save(str(sources.join('{:d}.npy'.format(i))), np.full(shape=(2, 2, 1), fill_value=i, dtype=float))
+      np.save(str(labels.join('{:d}.npy'.format(i))), np.full(shape=(1, 1, 1), fill_value=i, dtype=float))
+
+    def load (source, label):
+      return (np.load(source), np.load(label))
+
+    def batches (num_workers, ring, num_batches=8):
+      gen = DataGenerator(load_func=load, batch_size=3, source_path=str(sources), label_path=str(labels),
+                          source_extension='.npy', label_extension='.npy', num_workers=num_workers, ring=ring).start()
+      loaded = []
+
+      for _ in range(num_batches):
+        data, label, grabbed = gen.load_data()
+        assert grabbed
+        # the batch is kept until the next load
+        loaded.append((data, label, np.array(data), np.array(label)))
+
+      gen.stop()
+      return loaded
+
+    reference = batches(num_workers=0, ring=False)
+
+    for num_workers in (0, 2):
+      loaded = batches(num_workers=num_workers, ring=True)
+
+      for (data, label, _, _), (ring_data, ring_label, data_copy, label_copy) in zip(reference, loaded):
+        assert isinstance(ring_data, np.ndarray) and ring_data.shape == (3, 2, 2, 1) and ring_data.flags.c_contiguous
+        np.testing.assert_array_equal(data_copy, np.asarray(data))
+        np.testing.assert_array_equal(label_copy, np.asarray(label))
+
+      # the slots are reused
+      assert any(np.shares_memory(loaded[0][0], data) for data, _, _, _ in loaded[1:])
+      assert not np.shares_memory(loaded[0][0], loaded[1][0])
+
+    # without shared memory (python < 3.8) the batches of the loaders are copied in the ring
+    monkeypatch.setattr('NumPyNet.data.shared_memory', None)
+
+    for (data, label, _, _), (_, _, data_copy, label_copy) in zip(reference, batches(num_workers=2, ring=True)):
+      np.testing.assert_array_equal(data_copy, np.asarray(data))
+      np.testing.assert_array_equal(label_copy, np.asarray(label))
+
+  def test_generator_stop (self, tmpdir):
+
+    sources = tmpdir.mkdir('data')
+
+    for i in range(4):
+      np.save(str(sources.join('{:d}.npy'.format(i))), np.full(shape=(2, 2, 1), fill_value=i, dtype=float))
+
+    # no fixed sleep in start and stop: the stop wakes the thread blocked on the full queue
+    tic = time.time()
+    gen = DataGenerator(load_func=np.load, batch_size=2, source_path=str(sources), source_extension='.npy').start()
+    data, grabbed = gen.load_data()
+    gen.stop()
+
+    assert grabbed and np.asarray(data).shape == (2, 2, 2, 1)
+    assert time.time() - tic < .5
+    assert not gen._thread.is_alive()
+
+  def test_memmap_dataset (self, tmpdir):
+
+    np.random.seed(123)
+    X = np.random.uniform(size=(10, 6, 6, 2))
+    y = np.random.uniform(size=(10, 1, 1, 2))
+
+    data, labels = (str(tmpdir.join('data.npy')), str(tmpdir.join('labels.npy')))
+
+    for filename, array in ((data, X), (labels, y)):
+      out = np.lib.format.open_memmap(filename, mode='w+', dtype=array.dtype, shape=array.shape)
+      out[...] = array
+      out.flush()
+      del out
+
+    dataset = MemmapDataset(data, labels, block_size=4)
+    assert isinstance(dataset.data, np.memmap) and len(dataset) == 10
+
+    # the ordered batches are views of the memmaps
+    batches = list(dataset.batches(4))
+    assert [len(_input) for _input, _ in batches] == [4, 4, 2]
+    assert all(isinstance(_input, np.memmap) and isinstance(_truth, np.memmap) for _input, _truth in batches)
+    np.testing.assert_array_equal(np.concatenate([_input for _input, _ in batches]), X)
+
+    # block shuffling: each sample once, the batches are drawn from a single block of 4 samples
+    batches = [(np.array(_input), np.array(_truth)) for _input, _truth in dataset.batches(2, shuffle=True)]
+    order = [np.flatnonzero((X == sample).all(axis=(1, 2, 3)))[0] for _input, _ in batches for sample in _input]
+
+    assert sorted(order) == list(range(len(X)))
+    assert all(len({o // 4 for o in order[i : i + 2]}) == 1 for i in range(0, len(X), 2))
+    np.testing.assert_array_equal(np.concatenate([_truth for _, _truth in batches]), y[order])
+
+  def test_sample_cache (self, tmpdir):
+
+    # least recently used eviction within the budget of 2 samples
+    sample = np.zeros(shape=(4, ), dtype=float)
+    cache = SampleCache(max_bytes=2 * sample.nbytes, path=str(tmpdir.join('cache')))
+
+    cache.put('a', sample)
+    cache.put('b', (sample + 1, sample[:0]))
+    assert cache.get('a') is sample
+
+    cache.put('c', sample + 2)
+    assert len(cache) == 2 and cache.nbytes == 2 * sample.nbytes
+    assert cache.stats()['evictions'] == 1
+
+    # the evicted sample is read back from the disk cache
+    data, label = cache.get('b')
+    np.testing.assert_array_equal(data, sample + 1)
+    assert label.shape == (0, )
+    assert cache.get('d') is None
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['disk_hits'], stats['misses']) == (1, 1, 1)
+
+    np.random.seed(123)
+    sources, labels = (tmpdir.mkdir('data'), tmpdir.mkdir('labels'))
+
+    for i in range(6):
+      np.save(str(sources.join('{:d}.npy'.format(i))), np.full(shape=(2, 2, 1), fill_value=i, dtype=float))
+      np.save(str(labels.join('{:d}.npy'.format(i))), np.full(shape=(1, 1, 1), fill_value=i, dtype=float))
+
+    calls = []
+
+    def load (source, label, scale=1.):
+      calls.append(source)
+      return (scale * np.load(source), np.load(label))
+
+    def batches (num_batches=6, **kwargs):
+      gen = DataGenerator(load_func=load, batch_size=3, source_path=str(sources), label_path=str(labels),
+                          source_extension='.npy', label_extension='.npy', scale=2., **kwargs).start()
+      loaded = []
+
+      for _ in range(num_batches):
+        data, label, grabbed = gen.load_data()
+        assert grabbed
+        loaded.append((np.array(data), np.array(label)))
+
+      gen.stop()
+      return (loaded, gen)
+
+    reference, _ = batches()
+
+    # each file is loaded once, the next epochs are read from the cache
+    del calls[:]
+    loaded, gen = batches(cache=2**20)
+
+    assert sorted(calls) == sorted(set(calls)) and len(calls) == 6
+    assert gen.cache.stats()['hits'] >= 12 and gen.cache.stats()['misses'] == 6
+    assert all(key[2] == gen._cache_key for key in gen.cache._samples)
+    assert 'scale=2.0' in gen._cache_key
+
+    for (data, label), (cached_data, cached_label) in zip(reference, loaded):
+      np.testing.assert_array_equal(data, cached_data)
+      np.testing.assert_array_equal(label, cached_label)
+
+    # the loader processes and the ring give the same batches (the loaders can
+    # miss a sample still in loading: the next batch is dispatched in advance)
+    for kwargs in ({'num_workers' : 2}, {'num_workers' : 2, 'ring' : True}, {'ring' : True}):
+      loaded, gen = batches(cache=SampleCache(max_bytes=2**20), **kwargs)
+
+      assert len(gen.cache) == 6 and gen.cache.stats()['hits'] >= 6
+
+      for (data, label), (cached_data, cached_label) in zip(reference, loaded):
+        np.testing.assert_array_equal(data, cached_data)
+        np.testing.assert_array_equal(label, cached_label)
@@ -103,6 +103,12 @@ class TestDropoutLayer:
 
     np.testing.assert_allclose(layer.delta, np.zeros(shape=(b, w, h, c), dtype=float), rtol=1e-5, atol=1e-8)
 
+    # Inference mode: the dropout is the identity
+    layer.forward(inpt=inpt, trainable=False)
+    np.testing.assert_allclose(layer.output, inpt, rtol=1e-5, atol=1e-8)
+    assert layer.rnd is None
+    assert layer.delta is None
+
 
   @given(b = st.integers(min_value=1, max_value=15 ),
          w = st.integers(min_value=1, max_value=100),
@@ -12,6 +12,8 @@ from NumPyNet.metrics import mean_absolute_error
 from NumPyNet.metrics import mean_logcosh
 from NumPyNet.metrics import mean_hellinger
 from NumPyNet.metrics import mean_iou_score
+from NumPyNet.metrics import running_metric
+from NumPyNet.metrics import RunningIoU
 
 import numpy as np
 import pytest
@@ -119,3 +121,52 @@ class TestMetrics:
     res_tf = metric.result().numpy()
 
     np.testing.assert_allclose(res_tf, res_py, atol=1e-8, rtol=1e-5)
+
+  @given(size  = st.integers(min_value=10, max_value=100),
+         batch = st.integers(min_value=1,  max_value=10))
+  @settings(max_examples=10, deadline=None)
+  def test_running_metric (self, size, batch):
+    y_true = np.random.choice([0., 1., 2.], size=(size, 3))
+    y_pred = np.random.choice([0., 1., 2.], size=(size, 3))
+    labels = np.random.uniform(low=0., high=1., size=(size, 3))
+
+    funcs = (mean_accuracy_score, mean_square_error, mean_absolute_error, mean_logcosh, mean_hellinger, mean_iou_score)
+
+    for func in funcs:
+      # the accumulated metric is the one of the whole set
+      for truth, pred in ((y_true, y_pred), (labels, labels[::-1])):
+        metric = running_metric(func)
+
+        for i in range(0, size, batch):
+          metric.update(truth[i : i + batch], pred[i : i + batch])
+
+        if func is mean_iou_score and truth is labels:
+          continue # the labels are not classes
+
+        np.testing.assert_allclose(metric.result(), func(truth, pred), atol=1e-8, rtol=1e-5)
+        assert metric.__name__ == func.__name__
+
+    # custom metrics are weighted by the batch size
+    metric = running_metric(lambda y_true, y_pred : np.max(np.abs(y_true - y_pred)))
+    metric.update(labels[:5], labels[:5] + 1.)
+    metric.update(labels[5:], labels[5:] + 3.)
+
+    np.testing.assert_allclose(metric.result(), (5 + (size - 5) * 3.) / size)
+
+    metric.reset()
+    assert np.isnan(metric.result())
+
+    # the outputs of the network are rounded to the labels: no class for each value
+    metric = running_metric(mean_iou_score)
+
+    for i in range(0, size, batch):
+      metric.update(y_true[i : i + batch], y_true[i : i + batch] + np.random.uniform(low=-.3, high=.3, size=y_true[i : i + batch].shape))
+
+    assert metric.result() == 1. and len(metric.counts) <= 3
+
+    # only the given labels are counted
+    metric = RunningIoU(mean_iou_score, labels=[0., 1.])
+    metric.update(y_true, y_pred)
+
+    assert set(metric.counts) <= {0., 1.}
+    np.testing.assert_allclose(metric.result(), np.mean([metric.counts[val][0] / metric.counts[val][1] for val in metric.labels & {0., 1.}]))
@@ -5,20 +5,106 @@ from __future__ import division
 from __future__ import print_function
 
 from NumPyNet.metrics import mean_accuracy_score
+from NumPyNet.metrics import mean_square_error
 from NumPyNet.optimizer import Adam
 from NumPyNet.network import Network
+from NumPyNet.profiler import Profiler
+from NumPyNet.profiler import Tracer
+from NumPyNet.profiler import span
+from NumPyNet.data import DataGenerator
+from NumPyNet.data import MemmapDataset
 from NumPyNet.exception import MetricsError
+from NumPyNet.exception import NetworkError
+from NumPyNet.parallel import shared_memory
+from NumPyNet.layers.connected_layer import Connected_layer
+from NumPyNet.layers.convolutional_layer import Convolutional_layer
+from NumPyNet.layers.batchnorm_layer import BatchNorm_layer
+from NumPyNet.layers.maxpool_layer import Maxpool_layer
+from NumPyNet.layers.dropout_layer import Dropout_layer
+from NumPyNet.layers.activation_layer import Activation_layer
+from NumPyNet.layers.cost_layer import Cost_layer
+from NumPyNet.layers.lstm_layer import LSTM_layer
+from NumPyNet.layers.rnn_layer import RNN_layer
+from NumPyNet.layers.avgpool_layer import Avgpool_layer
+from NumPyNet.layers.l2norm_layer import L2Norm_layer
 
+import gc
+import json
+import time
+import numpy as np
 import pytest
+from copy import deepcopy
+from threading import Thread
 
 __author__ = ['Mattia Ceccarelli', 'Nico Curti']
 __email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
 
 
+def samples (num_samples, input_shape=(6, 6, 2), outputs=2):
+  '''
+  Random (seeded) samples and labels of the tests
+  '''
+  np.random.seed(123)
+  X = np.random.uniform(size=(num_samples, ) + input_shape)
+  y = np.random.uniform(size=(num_samples, 1, 1, outputs))
+
+  return (X, y)
+
+
+def conv_layer ():
+  '''
+  Convolutional layer used by the tests
+  '''
+  return Convolutional_layer(filters=3, size=3, stride=1, pad=True, activation='Relu')
+
+
+def build (layers=(), batch=4, input_shape=(6, 6, 2), outputs=2, metrics=None, **kwargs):
+  '''
+  Compiled model of the tests (with seeded weights): the given layers followed
+  by a linear connected layer of the given outputs (if any) and the mse cost.
+  The other arguments are given to the Network (e.g. subdivisions or dtype).
+  '''
+  np.random.seed(42)
+
+  model = Network(batch=batch, input_shape=input_shape, **kwargs)
+
+  for layer in layers:
+    model.add(layer)
+
+  if outputs is not None:
+    model.add(Connected_layer(outputs=outputs, activation='Linear'))
+
+  model.add(Cost_layer(cost_type='mse'))
+  model.compile(optimizer=Adam(), metrics=metrics)
+
+  return model
+
+
 class TestNetwork:
   '''
   Tests:
     - add default metrics
+    - dtype policy propagated to parameters, outputs, deltas and optimizer states
+    - inference mode does not store deltas and backward arrays
+    - persistent output/delta buffers reused across the batches
+    - static execution plan built by compile and invalidated by add
+    - batchnorm folding for inference
+    - multi-process predict with shared memory weights
+    - serial predict without shared memory
+    - intra-op thread pool along the batch axis
+    - data-parallel training with averaged gradients
+    - serial training without shared memory
+    - gradient accumulation over the subdivisions of the batch
+    - activation checkpointing segments recomputed in backward
+    - per-layer memory accounting and peak memory
+    - per-layer timing profiler of forward, backward and update
+    - chrome trace of the steps and of the data threads
+    - streaming predict on arrays, memmaps and lazy inputs
+    - padded and masked last partial batch
+    - zero-copy batches and epoch shuffling
+    - running metrics, validation and history of the training
+    - prefetched batches of the data generator in fit_generator
+    - memory-mapped dataset in fit and predict
   '''
 
   def test_add_metrics (self):
@@ -41,3 +127,753 @@ class TestNetwork:
     with pytest.raises(MetricsError):
       model.compile(optimizer=Adam(), metrics=[custom_metrics_wrong])
 
+
+  def test_dtype_policy (self):
+
+    X, y = samples(8, input_shape=(1, 1, 3))
+
+    model = build([Connected_layer(outputs=5, activation='Relu')], input_shape=(1, 1, 3), dtype=np.float32)
+    model.fit(X, y, max_iter=2, verbose=False)
+
+    for layer in model:
+      assert layer.output.dtype == np.float32
+      assert layer.delta.dtype == np.float32
+
+      if hasattr(layer, 'weights'):
+        assert layer.weights.dtype == np.float32
+        assert layer.bias.dtype == np.float32
+        assert all(m.dtype == np.float32 for m in layer.optimizer.ms)
+
+    out = model.predict(X, verbose=False)
+    assert out.dtype == np.float32
+
+    model.compile(optimizer=Adam(), dtype=np.float64)
+    assert all(layer.weights.dtype == np.float64 for layer in model if hasattr(layer, 'weights'))
+    assert model.predict(X, verbose=False).dtype == np.float64
+
+    # the arrays allocated by the recurrent and cost layers follow the policy
+    X, y = samples(8, input_shape=(1, 1, 3), outputs=4)
+
+    for recurrent in (LSTM_layer(outputs=4, steps=2), RNN_layer(outputs=4, steps=2, activation='Logistic')):
+
+      model = build([recurrent], input_shape=(1, 1, 3), outputs=None, dtype=np.float32)
+      model.fit(X, y, max_iter=1, verbose=False)
+
+      assert all(getattr(model[1], attr).dtype == np.float32 for attr in ('output', 'cell', 'state') if hasattr(model[1], attr))
+      assert model[2].loss.dtype == np.float32
+      assert model.predict(X, verbose=False).dtype == np.float32
+
+  def test_inference_mode (self):
+
+    X, y = samples(8)
+
+    model = build([conv_layer(), BatchNorm_layer(), Maxpool_layer(size=2, stride=2), Dropout_layer(prob=.5)])
+    model.fit(X, y, max_iter=1, verbose=False)
+    assert all(layer.delta is not None for layer in model)
+
+    out1 = model.predict(X, verbose=False)
+    out2 = model.predict(X, verbose=False)
+
+    # dropout is the identity at inference time
+    np.testing.assert_allclose(out1, out2)
+
+    assert all(layer.delta is None for layer in model)
+    assert model[1].view is None
+    assert model[2].x is None and model[2].x_norm is None
+    assert model[3].indexes is None
+    assert model[4].rnd is None
+
+  def test_persistent_buffers (self):
+
+    X, y = samples(8)
+
+    model = build([conv_layer(), BatchNorm_layer(), Maxpool_layer(size=2, stride=2, pad=True)])
+    model._fitted = True
+
+    model._forward(X[:4], truth=y[:4], trainable=True)
+    buffers = [(id(layer.output), id(layer.delta)) for layer in list(model)[1:4]]
+    out1 = model.predict(X[:4], verbose=False)
+
+    model._forward(X[4:], truth=y[4:], trainable=True)
+    assert buffers == [(id(layer.output), id(layer.delta)) for layer in list(model)[1:4]]
+
+    # predict returns a copy of the last output buffer
+    out2 = model.predict(X, verbose=False)
+    np.testing.assert_allclose(out1, out2[:4])
+
+    with pytest.raises(NetworkError):
+      model._forward(X[:3], truth=y[:3], trainable=True)
+
+  def test_execution_plan (self, tmpdir):
+
+    X, y = samples(8)
+
+    model = Network(batch=4, input_shape=(6, 6, 2))
+    model.add(conv_layer())
+    assert model._plan is None
+
+    model = build([conv_layer()])
+
+    assert len(model._plan.forward) == model.num_layers
+    assert len(model._plan.backward) == model.num_layers
+    assert len(model._plan.update) == 2
+
+    model.fit(X, y, max_iter=1, verbose=False)
+    out = model.predict(X, verbose=False)
+
+    # the plan is not dumped and it is rebuilt at the first call
+    filename = str(tmpdir.join('model.pkl'))
+    model.save_model(filename)
+
+    loaded = Network(batch=4)
+    loaded.load_model(filename)
+    assert loaded._plan is None
+
+    np.testing.assert_allclose(loaded.predict(X, verbose=False), out)
+    assert loaded._plan is not None
+
+  def test_optimize_for_inference (self):
+
+    X, y = samples(8, input_shape=(3, 3, 2))
+
+    model = build([Convolutional_layer(filters=4, size=3, stride=1, pad=False, activation='Linear'), # 1 x 1 output
+                   BatchNorm_layer(rolling=True), Activation_layer(activation='Relu'),
+                   Connected_layer(outputs=3, activation='Linear'), BatchNorm_layer(rolling=True)],
+                  input_shape=(3, 3, 2))
+    model.fit(X, y, max_iter=3, verbose=False)
+    out = model.predict(X, verbose=False)
+
+    model.optimize_for_inference()
+
+    assert model.num_layers == 6
+    assert not any(isinstance(layer, BatchNorm_layer) for layer in model)
+    np.testing.assert_allclose(model.predict(X, verbose=False), out, rtol=1e-5, atol=1e-8)
+
+    # per-pixel batchnorm factors cannot be folded into a convolution
+    model = build([Convolutional_layer(filters=4, size=3, stride=1, pad=True, activation='Linear'), BatchNorm_layer(rolling=True)],
+                  input_shape=(3, 3, 2), outputs=None)
+    model.fit(X, np.random.uniform(size=(8, 3, 3, 4)), max_iter=1, verbose=False)
+    model.optimize_for_inference()
+
+    assert isinstance(model[2], BatchNorm_layer)
+
+    # by default the inference uses the batch statistics: the layer is not folded
+    model = build([Connected_layer(outputs=3, activation='Linear'), BatchNorm_layer()], input_shape=(3, 3, 2), outputs=None)
+    model.fit(X, np.random.uniform(size=(8, 1, 1, 3)), max_iter=2, verbose=False)
+    out = model.predict(X[:4], verbose=False)
+    hidden = model[1].output[:4]
+
+    np.testing.assert_allclose(out, (hidden - hidden.mean(axis=0)) / np.sqrt(hidden.var(axis=0) + model[2].epsil) * model[2].scales + model[2].bias, rtol=1e-5, atol=1e-8)
+
+    model.optimize_for_inference()
+    assert isinstance(model[2], BatchNorm_layer)
+
+  @pytest.mark.skipif(shared_memory is None, reason='shared memory requires python >= 3.8')
+  def test_parallel_predict (self):
+
+    X, y = samples(20)
+
+    model = build([conv_layer(), BatchNorm_layer(), Maxpool_layer(size=2, stride=2)])
+    model.fit(X, y, max_iter=2, verbose=False)
+
+    out = model.predict(X, verbose=False)
+    np.testing.assert_allclose(model.predict(X, verbose=False, n_jobs=2), out)
+    np.testing.assert_allclose(model.predict(X, truth=y, verbose=False, n_jobs=3), out)
+
+    # the metrics are not shared with the workers (a lambda can not be pickled)
+    model.compile(optimizer=Adam(), metrics=[lambda y_true, y_pred : np.mean(y_true - y_pred)])
+    np.testing.assert_allclose(model.predict(X, verbose=False, n_jobs=2), out)
+    model.fit(X, y, max_iter=1, verbose=False, n_jobs=2)
+
+    # the weights of the internal layers are shared too
+    X, _ = samples(8, input_shape=(3, 1, 2))
+
+    model = build([LSTM_layer(outputs=4, steps=1)], input_shape=(3, 1, 2), outputs=None)
+    model._fitted = True
+
+    np.testing.assert_allclose(model.predict(X, verbose=False, n_jobs=2), model.predict(X, verbose=False))
+
+  def test_parallel_predict_serial (self, monkeypatch):
+
+    X, _ = samples(10)
+
+    model = build()
+    model._fitted = True
+
+    out = model.predict(X, verbose=False)
+
+    # python < 3.8
+    monkeypatch.setattr('NumPyNet.parallel.shared_memory', None)
+
+    with pytest.warns(UserWarning):
+      np.testing.assert_allclose(model.predict(X, verbose=False, n_jobs=2), out)
+
+  def test_thread_pool (self, tmpdir, monkeypatch):
+
+    X, y = samples(10)
+
+    def model (num_threads):
+
+      model = build([conv_layer(), BatchNorm_layer(), Activation_layer(activation='Logistic'),
+                     Maxpool_layer(size=2, stride=1, pad=True), Avgpool_layer(size=2, stride=2)], batch=5)
+      model.set_num_threads(num_threads)
+      model.fit(X, y, max_iter=2, shuffle=False, verbose=False)
+
+      return model
+
+    sequential = model(num_threads=1)
+    threaded = model(num_threads=3)
+
+    assert threaded[2]._pool is not None and sequential[2]._pool is None
+    np.testing.assert_allclose(threaded[1].weights, sequential[1].weights)
+    np.testing.assert_allclose(threaded.predict(X, verbose=False), sequential.predict(X, verbose=False))
+
+    # the pool is not dumped with the model
+    filename = str(tmpdir.join('model.pkl'))
+    threaded.save_model(filename)
+    loaded = Network(batch=5).load_model(filename)
+
+    assert loaded[2]._pool is None
+    np.testing.assert_allclose(loaded.predict(X, verbose=False), sequential.predict(X, verbose=False))
+
+    threaded.set_num_threads(1)
+    assert all(getattr(layer, '_pool', None) is None for layer in threaded)
+
+    # the process-wide BLAS limits are restored when the pool is dropped
+    restored = []
+
+    class limits (object):
+
+      def __init__ (self, limits, user_api):
+        pass
+
+      def restore_original_limits (self):
+        restored.append(True)
+
+    monkeypatch.setattr('NumPyNet.parallel.threadpool_limits', limits)
+
+    threaded.set_num_threads(2)
+    threaded.set_num_threads(1)
+    assert len(restored) == 1
+
+    threaded.set_num_threads(2)
+    del threaded, loaded
+    gc.collect()
+    assert len(restored) == 2
+
+  @pytest.mark.skipif(shared_memory is None, reason='shared memory requires python >= 3.8')
+  def test_data_parallel (self):
+
+    X, y = samples(16)
+
+    parallel = build([conv_layer(), BatchNorm_layer()])
+    parallel.fit(X, y, max_iter=1, shuffle=False, verbose=False, n_jobs=2)
+
+    # reference: the first step is sequential, then the gradients of two batches are averaged
+    reference = build([conv_layer(), BatchNorm_layer()])
+    reference.fit(X[:8], y[:8], max_iter=1, shuffle=False, verbose=False)
+
+    layers = [reference[1], reference[2], reference[3]]
+    params = [('weights_update', 'bias_update'), ('scales_update', 'bias_update', 'rolling_mean', 'rolling_var'), ('weights_update', 'bias_update')]
+    grads = []
+    stats = (reference[2].rolling_mean.copy(), reference[2].rolling_var.copy())
+
+    for batch in (slice(8, 12), slice(12, 16)):
+      # the statistics of each batch start from the same values
+      reference[2].rolling_mean, reference[2].rolling_var = (stats[0].copy(), stats[1].copy())
+
+      reference._forward(X[batch], truth=y[batch], trainable=True)
+      reference._backward(X[batch], update=False)
+      grads.append([[getattr(layer, p).copy() for p in names] for layer, names in zip(layers, params)])
+
+    for layer, names, g1, g2 in zip(layers, params, *grads):
+      for p, v1, v2 in zip(names, g1, g2):
+        setattr(layer, p, (v1 + v2) * .5)
+
+    reference._update()
+
+    for layer, other in zip(layers, [parallel[1], parallel[2], parallel[3]]):
+      np.testing.assert_allclose(layer.bias, other.bias, rtol=1e-5, atol=1e-8)
+
+    np.testing.assert_allclose(reference[1].weights, parallel[1].weights, rtol=1e-5, atol=1e-8)
+    np.testing.assert_allclose(reference[2].scales, parallel[2].scales, rtol=1e-5, atol=1e-8)
+    np.testing.assert_allclose(reference[2].rolling_var, parallel[2].rolling_var, rtol=1e-5, atol=1e-8)
+
+    # the recurrent sublayers are trained in parallel too
+    X, y = samples(16, input_shape=(3, 1, 2), outputs=4)
+
+    model = build([LSTM_layer(outputs=4, steps=2)], input_shape=(3, 1, 2), outputs=None)
+    weights = model[1].uf.weights.copy()
+    model.fit(X, y, max_iter=2, verbose=False, n_jobs=2)
+
+    assert not np.allclose(model[1].uf.weights, weights)
+
+    # the scales of the normalization layers are not parameters
+    X, y = samples(16, input_shape=(4, 4, 2))
+
+    model = build([L2Norm_layer()], input_shape=(4, 4, 2))
+    weights = model[2].weights.copy()
+    model.fit(X, y, max_iter=2, verbose=False, n_jobs=2)
+
+    assert not np.allclose(model[2].weights, weights)
+
+  def test_data_parallel_serial (self, monkeypatch):
+
+    X, y = samples(16)
+
+    reference = build([conv_layer()])
+    reference.fit(X, y, max_iter=1, shuffle=False, verbose=False)
+
+    # without shared memory (python < 3.8) the batches are trained serially
+    monkeypatch.setattr('NumPyNet.parallel.shared_memory', None)
+    serial = build([conv_layer()])
+
+    with pytest.warns(UserWarning):
+      serial.fit(X, y, max_iter=1, shuffle=False, verbose=False, n_jobs=2)
+
+    np.testing.assert_allclose(serial[1].weights, reference[1].weights)
+
+  def test_subdivisions (self):
+
+    X, y = samples(16)
+
+    model = lambda subdivisions : build([conv_layer(), Maxpool_layer(size=2, stride=2)], batch=8, subdivisions=subdivisions)
+
+    with pytest.raises(ValueError):
+      model(subdivisions=3)
+
+    whole = model(subdivisions=1)
+    micro = model(subdivisions=4)
+
+    assert micro.micro_batch == 2
+    assert micro[0].out_shape == (2, 6, 6, 2)
+
+    whole.fit(X, y, max_iter=2, shuffle=False, verbose=False)
+    micro.fit(X, y, max_iter=2, shuffle=False, verbose=False)
+
+    # the gradients of the micro-batches sum up to the ones of the whole batch
+    np.testing.assert_allclose(micro[1].weights, whole[1].weights, rtol=1e-5, atol=1e-8)
+    np.testing.assert_allclose(micro[3].weights, whole[3].weights, rtol=1e-5, atol=1e-8)
+    np.testing.assert_allclose(micro.predict(X, verbose=False), whole.predict(X, verbose=False), rtol=1e-5, atol=1e-8)
+
+    # the training batch must match the micro-batch
+    with pytest.raises(NetworkError):
+      micro._forward(X[:8], truth=y[:8], trainable=True)
+
+    # the scales of the normalization layers are not accumulated as parameters
+    whole = build([L2Norm_layer(axis=-1)], batch=8, subdivisions=1)
+    micro = build([L2Norm_layer(axis=-1)], batch=8, subdivisions=2)
+
+    whole.fit(X, y, max_iter=2, shuffle=False, verbose=False)
+    micro.fit(X, y, max_iter=2, shuffle=False, verbose=False)
+
+    np.testing.assert_allclose(micro[2].weights, whole[2].weights, rtol=1e-5, atol=1e-8)
+
+  def test_checkpoints (self):
+
+    X, y = samples(8)
+
+    def model (segments):
+
+      model = build([Convolutional_layer(filters=3, size=3, stride=1, pad=True, activation='Linear'), BatchNorm_layer(),
+                     Activation_layer(activation='Relu'), Dropout_layer(prob=.5), Maxpool_layer(size=2, stride=2)])
+      model.set_checkpoints(segments)
+
+      model.fit(X, y, max_iter=3, verbose=False)
+
+      return model
+
+    reference = model([])
+    checkpoint = model([(1, 5), (5, 7)])
+
+    for layer, other in zip(reference, checkpoint):
+      for param in ('weights', 'bias', 'scales', 'rolling_mean', 'rolling_var'):
+        if getattr(layer, param, None) is not None:
+          np.testing.assert_allclose(getattr(other, param), getattr(layer, param), rtol=1e-5, atol=1e-8)
+
+    # the arrays inside the segments are released after the forward
+    checkpoint._forward(X[:4], truth=y[:4], trainable=True)
+    assert all(layer.output is None and layer.delta is None for layer in list(checkpoint)[1:4])
+    assert checkpoint[5].output is None and '_buffers' not in checkpoint[5].__dict__
+    assert checkpoint[4].output is not None and checkpoint[4].rnd is None
+
+    # the recomputation replays the same dropout mask
+    output = checkpoint[4].output.copy()
+    checkpoint._backward(X[:4], update=False)
+
+    np.testing.assert_allclose(checkpoint[4].output, output)
+    assert checkpoint[1].weights_update is not None
+
+    # segments of fixed length
+    checkpoint.set_checkpoints(3)
+    assert checkpoint._checkpoints == ((1, 4), (4, 7), (7, 8))
+
+    with pytest.raises(NetworkError):
+      checkpoint.set_checkpoints([(1, 4), (3, 6)])
+
+    with pytest.raises(NetworkError):
+      checkpoint.set_checkpoints([(0, 3)])
+
+    # the recurrent layers can not be released
+    model = build([LSTM_layer(outputs=4, steps=1)], input_shape=(3, 1, 2))
+    model.set_checkpoints([(1, 2), (2, 4)])
+
+    with pytest.raises(NetworkError):
+      model.set_checkpoints([(1, 3)])
+
+  def test_memory_usage (self):
+
+    X, y = samples(8)
+
+    model = build([conv_layer(), BatchNorm_layer(), Maxpool_layer(size=2, stride=2)])
+    model.fit(X, y, max_iter=2, verbose=False)
+
+    usage = model.memory_usage()
+    assert len(usage) == model.num_layers
+
+    conv, connected = usage[1], usage[4]
+    assert conv['weights'] == model[1].weights.nbytes + model[1].bias.nbytes
+    assert conv['updates'] > 0 and conv['optimizer'] > 0
+    assert conv['outputs'] > 0 and conv['deltas'] > 0 and conv['workspace'] > 0
+    assert connected['weights'] == model[4].weights.nbytes + model[4].bias.nbytes
+    assert all(layer['total'] == sum(layer[c] for c in ('weights', 'updates', 'optimizer', 'outputs', 'deltas', 'workspace'))
+               for layer in usage)
+
+    # the profile does not change the model
+    weights = model[1].weights.copy()
+    rolling_mean = model[2].rolling_mean.copy()
+    profile = model.memory_profile(X[:4], y[:4])
+
+    np.testing.assert_allclose(model[1].weights, weights)
+    np.testing.assert_allclose(model[2].rolling_mean, rolling_mean)
+
+    assert profile['resident'] == sum(layer['total'] for layer in usage)
+    assert profile['train'] >= profile['forward'] > 0
+    assert len(profile['layers']) == model.num_layers
+    assert profile['layers'][1]['backward'] > 0
+
+  def test_profiler (self):
+
+    X, y = samples(8)
+
+    model = build([conv_layer(), Maxpool_layer(size=2, stride=2)])
+    model.set_checkpoints([(1, 3)])
+
+    profiler = Profiler(warmup=1, steps=3)
+    model.set_profiler(profiler)
+    model.fit(X, y, max_iter=3, verbose=False) # 6 steps
+
+    assert profiler.recorded == 3
+    rows = profiler.report()
+    calls = {(row['index'], row['phase']) : row['calls'] for row in rows}
+
+    assert calls[(0, 'forward')] == 3 and calls[(4, 'backward')] == 3
+    assert calls[(1, 'update')] == 3 and (2, 'update') not in calls
+    assert [row['time'] for row in rows] == sorted((row['time'] for row in rows), reverse=True)
+    assert abs(sum(row['percent'] for row in rows) - 100.) < 1e-6
+
+    conv = [row for row in rows if row['index'] == 1]
+    assert all(row['gflops'] > 0 for row in conv if row['phase'] != 'update')
+    assert all(row['gflops'] is None for row in rows if row['index'] == 2)
+
+    # the profiler is removed from the plan
+    model.set_profiler(None)
+    model.fit(X, y, max_iter=1, verbose=False)
+    assert profiler.recorded == 3
+
+  def test_tracer (self, tmpdir):
+
+    X, y = samples(8)
+
+    model = build([conv_layer()])
+
+    filename = str(tmpdir.join('trace.json'))
+    tracer = Tracer(filename, warmup=1, steps=2)
+    model.set_profiler(tracer)
+
+    def load ():
+      with span('load_batch', 'data'):
+        pass
+
+    with tracer:
+      model.fit(X, y, max_iter=2, verbose=False) # 4 steps
+
+      thread = Thread(target=load, name='DataGenerator')
+      thread.start()
+      thread.join()
+
+    with span('load_batch', 'data'): # the tracer is stopped
+      pass
+
+    with open(filename) as fp:
+      events = json.load(fp)['traceEvents']
+
+    complete = [event for event in events if event['ph'] == 'X']
+    names = [event['name'] for event in complete]
+
+    # the spans of the last warmup step and of the recorded ones
+    assert names.count('train_step') == 3
+    assert names.count('1 conv forward') == 2 and names.count('2 connected update') == 2
+    assert all(event['dur'] >= 0 for event in complete)
+    assert not any(event['name'] == 'load_batch' for event in complete) # after the window
+
+    threads = {event['args']['name'] for event in events if event['ph'] == 'M'}
+    assert 'MainThread' in threads
+
+    # spans of the other threads without the network
+    with Tracer(filename):
+      thread = Thread(target=load, name='DataGenerator')
+      thread.start()
+      thread.join()
+
+    with open(filename) as fp:
+      events = json.load(fp)['traceEvents']
+
+    assert [event['name'] for event in events if event['ph'] == 'X'] == ['load_batch']
+    assert [event['args']['name'] for event in events if event['ph'] == 'M'] == ['DataGenerator']
+
+  def test_predict_iter (self, tmpdir):
+
+    X, y = samples(12)
+
+    model = build([conv_layer()])
+    model.fit(X, y, max_iter=1, verbose=False)
+
+    expected = model.predict(X, verbose=False)
+    costs = []
+    for i in range(0, len(X), 4):
+      model._forward(X[i : i + 4], truth=y[i : i + 4], trainable=False)
+      costs.append(model._get_loss())
+
+    # array input: the outputs are not overwritten by the next batches
+    outputs, losses = zip(*model.predict_iter(X, truth=y))
+    assert [len(output) for output in outputs] == [4, 4, 4]
+    np.testing.assert_allclose(np.concatenate(outputs), expected)
+    np.testing.assert_allclose(losses, np.cumsum(costs))
+
+    # lazy input of chunks of any length into a memmap
+    def generator (data):
+      for i in range(0, len(data), 5):
+        yield data[i : i + 5]
+
+    out = np.lib.format.open_memmap(str(tmpdir.join('output.npy')), mode='w+', dtype=expected.dtype, shape=expected.shape)
+
+    for i, (output, loss) in enumerate(model.predict_iter(generator(X), truth=generator(y), out=out)):
+      assert np.shares_memory(output, out)
+
+    out.flush()
+    assert i == 2
+    np.testing.assert_allclose(loss, np.sum(costs))
+    np.testing.assert_allclose(np.load(str(tmpdir.join('output.npy'))), expected)
+
+    # without the cost layer there is no loss
+    model = Network(batch=4, input_shape=(6, 6, 2))
+    model.add(Connected_layer(outputs=2, activation='Linear'))
+    model.compile(optimizer=Adam())
+    model._fitted = True
+
+    assert [loss for _, loss in model.predict_iter(X)] == [None] * 3
+
+  def test_partial_batch (self):
+
+    X, y = samples(10)
+
+    model = build([conv_layer()], subdivisions=2)
+
+    # the padding samples do not contribute: the gradients are half the ones of the duplicated samples
+    loss = model._train_step(X[:3], y[:3], update=False)
+    updates = [model[i].weights_update.copy() for i in (1, 2)]
+
+    model.batch, model.subdivisions = (6, 3) # same micro-batch
+    model._train_step(X[[0, 1, 2, 0, 1, 2]], y[[0, 1, 2, 0, 1, 2]], update=False)
+    model.batch, model.subdivisions = (4, 2)
+
+    np.testing.assert_allclose(updates[0], model[1].weights_update / 2, rtol=1e-6, atol=1e-12)
+    np.testing.assert_allclose(updates[1], model[2].weights_update / 2, rtol=1e-6, atol=1e-12)
+
+    # the mse of the two micro-batches, the second one with the only valid sample
+    model._fitted = True
+    output = model.predict(X[:3], verbose=False)
+    np.testing.assert_allclose(loss, np.mean((output[:2] - y[:2])**2) + np.mean((output[2] - y[2])**2))
+
+    # every sample is processed once
+    model.fit(X, y, max_iter=2, verbose=False)
+
+    output = model.predict(X, verbose=False)
+    assert output.shape[0] == len(X)
+
+    np.testing.assert_allclose(output[8:], model.predict(X[[8, 9]], verbose=False))
+    np.testing.assert_allclose(output[8:], model.predict(X[[6, 7, 8, 9]], verbose=False)[2:])
+
+  def test_shuffle (self):
+
+    X, y = samples(12)
+
+    model = build()
+
+    batches = []
+    train_step = model._train_step
+
+    def record (X, y, update=True, metrics=()):
+      batches.append((X, y))
+      return train_step(X, y, update=update, metrics=metrics)
+
+    model._train_step = record
+
+    # the batches are contiguous views of the data, in shuffled order
+    model.fit(X, y, max_iter=2, shuffle=True, verbose=False)
+
+    assert len(batches) == 6
+    assert all(np.shares_memory(_input, X) and _input.flags.c_contiguous for _input, _ in batches)
+    starts = [np.flatnonzero((X == _input[0]).all(axis=(1, 2, 3)))[0] for _input, _ in batches]
+    assert sorted(starts[:3]) == [0, 4, 8]
+
+    # the samples are permuted each epoch in a buffer reused across the epochs
+    del batches[:]
+    model.fit(X, y, max_iter=2, shuffle='epoch', verbose=False)
+
+    assert all(_input.flags.c_contiguous and not np.shares_memory(_input, X) for _input, _ in batches)
+    assert np.shares_memory(batches[0][0], batches[3][0])
+
+    for epoch in (batches[:3], batches[3:]):
+      inputs = np.concatenate([_input.copy() for _input, _ in epoch])
+      truths = np.concatenate([_truth.copy() for _, _truth in epoch])
+
+      # each sample once, with its label
+      order = [np.flatnonzero((X == sample).all(axis=(1, 2, 3)))[0] for sample in inputs]
+      assert sorted(order) == list(range(len(X)))
+      np.testing.assert_allclose(truths, y[order])
+
+    with pytest.raises(ValueError):
+      model.fit(X, y, max_iter=1, shuffle='block', verbose=False)
+
+  def test_history (self):
+
+    X, y = samples(10)
+
+    model = build(subdivisions=2, metrics=[mean_square_error])
+
+    # no predict on the training set
+    predict = model.predict
+    model.predict = None
+
+    history = model.fit(X, y, max_iter=3, shuffle=False, verbose=False, validation_data=(X[:6], y[:6]))
+
+    model.predict = predict
+
+    assert history is model.history and len(history) == 3
+    assert set(history.history) == {'loss', 'mean_square_error', 'val_loss', 'val_mean_square_error'}
+    assert history['loss'][-1] < history['loss'][0]
+
+    # the running metric is the one of the outputs before each update: check the last epoch
+    model = build(subdivisions=2, metrics=[mean_square_error])
+    model.fit(X, y, max_iter=1, shuffle=False, verbose=False)
+
+    reference = deepcopy(model)
+    reference._plan = None # the closures refer to the original layers
+
+    outputs = []
+    for i in range(0, len(X), 4):
+      outputs.append(reference.predict(X[i : i + 4], verbose=False))
+      reference._train_step(X[i : i + 4], y[i : i + 4])
+
+    history = model.fit(X, y, max_iter=1, shuffle=False, verbose=False)
+    np.testing.assert_allclose(history['mean_square_error'][0], mean_square_error(y, np.concatenate(outputs)), rtol=1e-5)
+
+    # the validation on the sampled subset
+    history = model.fit(X, y, max_iter=2, verbose=False, validation_data=(X, y), validation_samples=5)
+    assert len(history['val_mean_square_error']) == 2
+
+  def test_fit_generator (self, tmpdir):
+
+    np.random.seed(123)
+    sources, labels = (tmpdir.mkdir('data'), tmpdir.mkdir('labels'))
+
+    for i in range(10):
+      np.save(str(sources.join('{:d}.npy'.format(i))), np.random.uniform(size=(6, 6, 2)))
+      np.save(str(labels.join('{:d}.npy'.format(i))), np.random.uniform(size=(1, 1, 2)))
+
+    loaded = []
+
+    def load (source, label):
+      loaded.append(source)
+      return (np.load(source), np.load(label))
+
+    generator = lambda prefetch : DataGenerator(load_func=load, batch_size=4, source_path=str(sources), label_path=str(labels),
+                                                source_extension='.npy', label_extension='.npy', prefetch=prefetch)
+
+    gen = generator(prefetch=2)
+
+    # the batches are loaded in advance up to the queue size
+    gen.start()
+    time.sleep(.5)
+    assert gen._queue.full() and len(loaded) == 12 # the third batch waits for a free slot
+
+    data, label, grabbed = gen.load_data()
+    assert grabbed and len(data) == 4 and len(label) == 4
+
+    gen.stop()
+    _, _, grabbed = gen.load_data()
+    _, _, grabbed = gen.load_data()
+    _, _, grabbed = gen.load_data()
+    assert not grabbed
+
+    with pytest.raises(ValueError):
+      generator(prefetch=0)
+
+    model = build()
+    history = model.fit_generator(generator(prefetch=2), max_iter=5, verbose=False)
+
+    assert len(history) == 5
+    assert all(stall >= 0. for stall in history['stall'])
+    assert all(np.isfinite(history['loss']))
+
+    # the generator batches are split in the batches of the network
+    generator = DataGenerator(load_func=load, batch_size=6, source_path=str(sources), label_path=str(labels),
+                              source_extension='.npy', label_extension='.npy')
+    steps = []
+    train_step = model._train_step
+    model._train_step = lambda X, y : steps.append(len(X)) or train_step(X, y)
+
+    history = model.fit_generator(generator, max_iter=2, verbose=False)
+
+    del model._train_step
+
+    assert len(history) == 2 and steps == [4, 2, 4, 2]
+    assert all(np.isfinite(history['loss']))
+
+    # the training requires the labels
+    with pytest.raises(ValueError):
+      model.fit_generator(DataGenerator(load_func=np.load, batch_size=4, source_path=str(sources), source_extension='.npy'), verbose=False)
+
+  def test_memmap_fit (self, tmpdir):
+
+    X, y = samples(10)
+
+    data, labels = (str(tmpdir.join('data.npy')), str(tmpdir.join('labels.npy')))
+
+    for filename, array in ((data, X), (labels, y)):
+      out = np.lib.format.open_memmap(filename, mode='w+', dtype=array.dtype, shape=array.shape)
+      out[...] = array
+      out.flush()
+      del out
+
+    dataset = MemmapDataset(data, labels, block_size=4)
+
+    # the training on the dataset is the one on the arrays
+    model, reference = (build(), build())
+    history = model.fit(dataset, max_iter=2, shuffle=False, verbose=False, validation_data=dataset)
+    expected = reference.fit(X, y, max_iter=2, shuffle=False, verbose=False, validation_data=(X, y))
+
+    np.testing.assert_allclose(model[1].weights, reference[1].weights)
+    np.testing.assert_allclose(history['val_loss'], expected['val_loss'])
+    np.testing.assert_allclose(model.predict(dataset, verbose=False), reference.predict(X, verbose=False))
+
+    outputs = np.concatenate([output for output, _ in model.predict_iter(dataset)])
+    np.testing.assert_allclose(outputs, reference.predict(X, verbose=False))
+
+    history = model.fit(dataset, max_iter=5, shuffle=True, verbose=False)
+    assert len(history) == 5 and np.all(np.isfinite(history['loss']))
+
+    with pytest.raises(ValueError):
+      model.fit(MemmapDataset(data), max_iter=1, verbose=False)
@@ -169,6 +169,7 @@ class TestRouteLayer :
 
     # BACKWARD
 
+    net._forward(X=input, trainable=True) # predict runs in inference mode, without deltas
     net._net[3].delta = np.ones(shape=fwd_out_numpynet.shape, dtype=float)
     net._backward(X=input)
 
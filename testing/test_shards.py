@@ -0,0 +1,141 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+
+import os
+import pickle
+
+import cv2
+
+from NumPyNet.shards import ShardWriter
+from NumPyNet.shards import ShardReader
+from NumPyNet.shards import pack_images
+from NumPyNet.data import DataGenerator
+
+import numpy as np
+import pytest
+
+__author__ = ['Mattia Ceccarelli', 'Nico Curti']
+__email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
+
+
+class TestShards:
+  '''
+  Test the sharded dataset format
+
+  -random access and streaming of the packed samples
+  -image packing tool
+  -data generator reading the shards
+  '''
+
+  def test_pack_read (self, tmpdir):
+
+    np.random.seed(123)
+    X = np.random.uniform(size=(20, 5, 3, 3))
+    y = np.arange(20, dtype=float)
+    path = str(tmpdir.join('shards'))
+
+    # each record is 48 (data) + 16 (label) bytes: 3 samples for shard
+    with ShardWriter(path, dtype=np.uint8, scale=255., shard_size=200) as writer:
+      for data, label in zip(X, y):
+        writer.write(data, label)
+
+    reader = ShardReader(path)
+
+    assert len(reader) == 20 and reader.labeled and len(reader.shards) == 7
+    assert all(os.path.getsize(os.path.join(path, shard)) <= 200 for shard in reader.shards)
+
+    for i in (0, 7, 19):
+      data, label = reader[i]
+      assert data.dtype == np.float32 and data.shape == (5, 3, 3) and label.shape == ()
+      np.testing.assert_allclose(data, X[i], atol=.5 / 255)
+      assert label == y[i]
+
+    # streaming in order and shuffled (each sample once)
+    labels = [float(label) for _, label in reader.stream()]
+    assert labels == list(y)
+
+    samples = list(reader.stream(shuffle=True))
+    order = [int(label) for _, label in samples]
+    assert sorted(order) == list(range(20)) and order != list(range(20))
+    np.testing.assert_allclose(np.stack([data for data, _ in samples]), X[order], atol=.5 / 255)
+
+    # the pickled reader maps again the shards
+    data, label = pickle.loads(pickle.dumps(reader))[3]
+    np.testing.assert_allclose(data, X[3], atol=.5 / 255)
+
+    # float16 payload of samples of different shapes, without labels
+    path = str(tmpdir.join('unlabeled'))
+
+    with ShardWriter(path, dtype=np.float16) as writer:
+      writer.write(X[0])
+      writer.write(X[1, :2])
+
+      with pytest.raises(ValueError):
+        writer.write(X[2], y[2])
+
+    reader = ShardReader(path, dtype=None)
+
+    assert not reader.labeled and reader[0].dtype == np.float16 and reader[1].shape == (2, 3, 3)
+    np.testing.assert_allclose(reader[1], X[1, :2], rtol=1e-3)
+
+  def test_pack_images (self, tmpdir):
+
+    np.random.seed(123)
+    images = tmpdir.mkdir('images')
+    filenames = []
+
+    for i in range(4):
+      filenames.append(str(images.join('{:d}.png'.format(i))))
+      cv2.imwrite(filenames[-1], np.random.randint(low=0, high=256, size=(6, 8, 3), dtype=np.uint8))
+
+    path = str(tmpdir.join('shards'))
+    assert pack_images(path, filenames, labels=[1, 0, 1, 0]) == 4
+
+    reader = ShardReader(path)
+    data, label = reader[2]
+
+    np.testing.assert_allclose(data, cv2.imread(filenames[2])[..., ::-1] / 255., atol=1e-6)
+    assert label == 1
+
+    pack_images(path, filenames, size=(4, 3), dtype=np.float16)
+    assert ShardReader(path)[0].shape == (3, 4, 3)
+
+  def test_data_generator (self, tmpdir):
+
+    np.random.seed(123)
+    X = np.random.uniform(size=(10, 2, 2, 1))
+    y = np.arange(10, dtype=float).reshape(10, 1, 1, 1)
+    path = str(tmpdir.join('shards'))
+
+    with ShardWriter(path, dtype=np.float32, shard_size=64) as writer:
+      for data, label in zip(X, y):
+        writer.write(data, label)
+
+    def batches (num_workers, num_batches=6):
+      gen = DataGenerator(load_func=None, batch_size=3, source_shards=path, num_workers=num_workers).start()
+      loaded = []
+
+      for _ in range(num_batches):
+        data, label, grabbed = gen.load_data()
+        assert grabbed
+        loaded.append((np.array(data), np.array(label)))
+
+      gen.stop()
+      return loaded
+
+    loaded = batches(num_workers=0)
+
+    # each sample with its label, in the order of the other loaders
+    for data, label in loaded:
+      assert data.shape == (3, 2, 2, 1)
+      np.testing.assert_allclose(data, X[label.ravel().astype(int)], rtol=1e-6)
+
+    for (data, label), (other_data, other_label) in zip(loaded, batches(num_workers=2)):
+      np.testing.assert_array_equal(data, other_data)
+      np.testing.assert_array_equal(label, other_label)
+
+    with pytest.raises(ValueError):
+      DataGenerator(load_func=None, batch_size=3, source_path=str(tmpdir))
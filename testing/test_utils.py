@@ -8,9 +8,12 @@ import tensorflow as tf
 
 from NumPyNet.utils import to_categorical
 from NumPyNet.utils import from_categorical
+from NumPyNet.utils import BoundedQueue
 
+import time
 import numpy as np
 import pytest
+from threading import Thread
 from hypothesis import strategies as st
 from hypothesis import given
 from hypothesis import settings
@@ -26,6 +29,7 @@ class TestUtils:
 
   -to_categorical
   -from_categorical
+  -blocking bounded queue
   '''
 
   @given(size = st.integers(min_value=10, max_value=100),
@@ -56,3 +60,38 @@ class TestUtils:
     fromlabel_np = from_categorical(categorical_np)
 
     np.testing.assert_allclose(fromlabel_tf, fromlabel_np)
+
+  def test_bounded_queue (self):
+
+    queue = BoundedQueue(maxsize=2)
+    got = []
+    consumer = Thread(target=lambda : got.append(queue.get()))
+    consumer.start()
+
+    # the consumer waits for the item
+    time.sleep(.05)
+    assert consumer.is_alive() and not got
+    assert queue.put(1)
+    consumer.join(timeout=1.)
+    assert got == [(1, True)]
+
+    # the producer waits for a free place
+    assert queue.put(2) and queue.put(3) and queue.full()
+    producer = Thread(target=lambda : got.append(queue.put(4)))
+    producer.start()
+    time.sleep(.05)
+    assert producer.is_alive()
+    assert queue.get() == (2, True)
+    producer.join(timeout=1.)
+    assert got[-1] is True
+
+    # close wakes the waiting threads, the items are still available
+    assert queue.full()
+    producer = Thread(target=lambda : got.append(queue.put(6)))
+    producer.start()
+    queue.close()
+    producer.join(timeout=1.)
+    assert got[-1] is False
+    assert queue.get() == (3, True) and queue.get() == (4, True)
+    assert queue.get() == (None, False)
+    assert not queue.wait(timeout=1.)
@@ -0,0 +1,58 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import cv2
+
+from NumPyNet.video import VideoCapture
+from NumPyNet.exception import VideoError
+
+import numpy as np
+import pytest
+
+__author__ = ['Mattia Ceccarelli', 'Nico Curti']
+__email__ = ['mattia.ceccarelli3@studio.unibo.it', 'nico.curti2@unibo.it']
+
+
+class TestVideo:
+  '''
+  Test the video capture in thread
+
+  -frames read in a bounded queue without polling
+  '''
+
+  def test_video_capture (self, tmpdir):
+
+    filename = str(tmpdir.join('video.avi'))
+    writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'MJPG'), 10, (8, 6))
+
+    for i in range(5):
+      writer.write(np.full(shape=(6, 8, 3), fill_value=40 * i, dtype=np.uint8))
+
+    writer.release()
+
+    with pytest.raises(VideoError):
+      VideoCapture(str(tmpdir.join('missing.avi')))
+
+    # the thread waits for a free place of the queue
+    cap = VideoCapture(filename, queue_size=2).start()
+    time.sleep(.1)
+    assert cap._num_frames == 2 and cap._thread.is_alive()
+
+    frames = []
+
+    while cap.running():
+      frames.append(cap.read())
+
+    # the end of the video closes the queue
+    assert len(frames) == 5 and frames[0].shape == (6, 8, 3)
+
+    with pytest.raises(VideoError):
+      cap.read()
+
+    cap.stop()
+    assert not cap._thread.is_alive()